@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+from edtslib import env
+from edtslib import benchmark
+
+if __name__ == '__main__':
+  env.configure_logging(env.global_args.log_level)
+  # The benchmark opens its own synthetic database, generating it first if need be
+  a = benchmark.Application(env.local_args, False)
+  a.run()
+  env.stop()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import argparse
+import json
+import math
+import os
+import random
+
+from . import env
+from . import galaxygen
+from . import calc
+from . import routing as rx
+from . import ship
+from . import solver
+from . import util
+from .station import Station
+from . import vector3
+
+app_name = "benchmark"
+
+log = util.get_logger(app_name)
+
+modes = ['routing', 'solver']
+default_db_file = os.path.normpath('data/synthetic.db')
+default_repeat = 3
+percentiles = [50, 90, 99]
+# Route queries and solver stops use the nearest system to each position, looking no further away than this
+nearest_system_max_ly = 500.0
+
+# Route queries covering the different regions of the default galaxy model, as (name, from, to)
+route_queries = [
+  ('bubble-short', (0.0, 0.0, 0.0), (120.0, 10.0, -80.0)),
+  ('bubble-cross', (-200.0, 0.0, 20.0), (180.0, 0.0, -40.0)),
+  ('bubble-to-halo', (0.0, 0.0, 0.0), (0.0, 0.0, 700.0)),
+  ('halo', (-900.0, 0.0, 100.0), (-350.0, 0.0, 700.0)),
+  ('void-edge', (350.0, 0.0, 100.0), (850.0, 0.0, 200.0)),
+  ('long-haul', (-1000.0, 0.0, -150.0), (1000.0, 0.0, 150.0)),
+]
+
+# Solver instances as (name, kind, number of stops, seed); every one starts and ends at Sol
+solver_instances = [
+  ('clusters-12', 'clusters', 12, 1),
+  ('clusters-40', 'clusters', 40, 2),
+  ('shell-16', 'shell', 16, 3),
+  ('shell-100', 'shell', 100, 4),
+  ('chain-30', 'chain', 30, 5),
+  ('tours-18', 'tours', 18, 6),
+  ('tours-60', 'tours', 60, 7),
+  ('clusters-500', 'clusters', 500, 8),
+]
+default_solve_time_limit = 10.0
+solver_tour_count = 2
+solver_tour_length = 4
+
+
+def get_percentile(values, percentile):
+  # Nearest-rank percentile
+  if not values:
+    return None
+  ordered = sorted(values)
+  return ordered[max(0, int(math.ceil(percentile / 100.0 * len(ordered))) - 1)]
+
+
+def get_solver_positions(kind, count, rng):
+  # Where to look for the stops of each kind of instance; these are moved to the nearest real system afterwards
+  if kind in ('clusters', 'tours'):
+    # Small groups of stops around the bubble
+    centres = [(rng.uniform(-200, 200), rng.uniform(-50, 50), rng.uniform(-200, 200)) for _ in range(max(2, count // 8))]
+    return [tuple(rng.gauss(c, 20.0) for c in centres[i % len(centres)]) for i in range(count)]
+  elif kind == 'shell':
+    # Spread evenly over a shell around Sol, flattened to fit in the galaxy's disc
+    result = []
+    for _ in range(count):
+      angle = rng.uniform(0, 2 * math.pi)
+      result.append((300.0 * math.cos(angle), rng.uniform(-80, 80), 300.0 * math.sin(angle)))
+    return result
+  elif kind == 'chain':
+    # A long line of stops heading out from Sol, given in a random order
+    result = [(1500.0 * i / count + rng.uniform(-30, 30), rng.uniform(-30, 30), 200.0 * i / count + rng.uniform(-30, 30)) for i in range(1, count + 1)]
+    rng.shuffle(result)
+    return result
+  raise ValueError("Unknown solver instance kind {}".format(kind))
+
+
+def check_solver_route(route, start, end, stops, tours):
+  # Whether the route visits every stop once, in an order which keeps to the tours
+  if route is None or route[0] != start or route[-1] != end or sorted(str(s) for s in route[1:-1]) != sorted(str(s) for s in stops):
+    return False
+  return all([s for s in route[1:-1] if s in tour] == tour for tour in tours)
+
+
+def get_fuel_usage(route, s):
+  # Returns the fuel used, and whether the route can actually be flown when refuelling at every scoopable star
+  fuel = s.tank_size
+  total = 0.0
+  flyable = True
+  for i in range(1, len(route)):
+    cost = s.cost(route[i-1].distance_to(route[i]), fuel)
+    if cost > min(fuel, s.fsd.maxfuel):
+      flyable = False
+    total += cost
+    fuel = s.tank_size if route[i].is_scoopable else fuel - cost
+  return (total, flyable)
+
+
+class Application(object):
+
+  def __init__(self, arg, hosted, state = {}):
+    ap_parents = [env.arg_parser] if not hosted else []
+    ap = argparse.ArgumentParser(description = "Benchmark EDTS against a synthetic galaxy", fromfile_prefix_chars="@", parents = ap_parents, prog = app_name)
+    ap.add_argument("mode", type=str, choices=modes, help="What to benchmark")
+    ap.add_argument(      "--synthetic-db", type=str, default=default_db_file, help="The synthetic database file to use, relative to the usual data location; created if it does not exist")
+    ap.add_argument(      "--regenerate", action='store_true', default=False, help="Regenerate the synthetic database even if it already exists")
+    ap.add_argument(      "--stars", type=int, default=galaxygen.default_star_count, help="The number of stars to put in a newly generated synthetic database")
+    ap.add_argument(      "--seed", type=int, default=galaxygen.default_seed, help="The random seed used to generate the synthetic database")
+    ap.add_argument("-n", "--repeat", type=int, default=default_repeat, help="The number of times to run each query")
+    ap.add_argument(      "--strategies", type=str, nargs='+', choices=rx.strategies, default=rx.strategies, help="The route strategies to benchmark")
+    ap.add_argument("-f", "--fsd", type=str, default="5A", help="The ship's frame shift drive in the form 'A6 or '6A'")
+    ap.add_argument("-m", "--mass", type=float, default=300.0, help="The ship's unladen mass excluding fuel")
+    ap.add_argument("-t", "--tank", type=float, default=16.0, help="The ship's fuel tank size")
+    ap.add_argument(      "--solve-modes", type=str, nargs='+', choices=solver.modes, default=solver.modes, help="The solver modes to benchmark")
+    ap.add_argument(      "--solve-time-limit", type=float, default=default_solve_time_limit, help="The maximum time in seconds to let each solve take")
+    ap.add_argument(      "--instances", type=str, nargs='+', choices=[i[0] for i in solver_instances], default=[i[0] for i in solver_instances], help="The solver instances to benchmark")
+    ap.add_argument(      "--json", metavar="filename", type=str, default=None, help="Also write the full results to a JSON file")
+    self.args = ap.parse_args(arg)
+
+  def run(self):
+    db_path = os.path.join(os.path.normpath(env.default_path), self.args.synthetic_db)
+    if self.args.regenerate and os.path.isfile(db_path):
+      os.unlink(db_path)
+    if not os.path.isfile(db_path):
+      print("Generating synthetic database with {} stars, this may take a while...".format(self.args.stars))
+      galaxygen.generate_db(db_path, self.args.stars, self.args.seed)
+    # Everything opens the database through the environment, so it has to be the synthetic one from the start
+    if env.is_started():
+      log.error("Can't benchmark once another database has been opened")
+      return
+    env.global_args.db_file = self.args.synthetic_db
+    if not env.start():
+      log.error("Could not open synthetic database {}", db_path)
+      return
+
+    if self.args.mode == 'routing':
+      results = self.run_routing()
+    elif self.args.mode == 'solver':
+      results = self.run_solver()
+
+    if self.args.json is not None:
+      with open(self.args.json, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+  def _get_nearest_system(self, envdata, pos):
+    pos = vector3.Vector3(*pos)
+    radius = 10.0
+    while True:
+      candidates = envdata.find_systems_by_aabb(pos, pos, radius, radius)
+      if any(candidates):
+        return min(candidates, key=lambda s: (s.position - pos).length)
+      if radius >= nearest_system_max_ly:
+        log.warning("No systems within {:.0f}LY of {}", nearest_system_max_ly, pos)
+        return None
+      radius = min(radius * 2, nearest_system_max_ly)
+
+  def run_routing(self):
+    s = ship.Ship(self.args.fsd, self.args.mass, self.args.tank)
+    jump_range = s.range()
+    with env.use() as envdata:
+      queries = [(name, self._get_nearest_system(envdata, a), self._get_nearest_system(envdata, b)) for name, a, b in route_queries]
+    queries = [q for q in queries if q[1] is not None and q[2] is not None]
+
+    print("Ship: {} FSD, {:.1f}T, {:.0f}T tank; jump range {:.2f}LY".format(s.fsd.drive, s.mass, s.tank_size, jump_range))
+    results = []
+    for strategy in self.args.strategies:
+      r = rx.Routing(s, route_strategy=strategy)
+      for name, sys_from, sys_to in queries:
+        timings = []
+        route = None
+        for _ in range(self.args.repeat):
+          # Every run does the same work, so the stats reported are for just the last one
+          stats = rx.RouteStats()
+          timer = util.start_timer()
+          route = r.plot(sys_from, sys_to, jump_range, stats=stats)
+          timings.append(util.get_timer(timer))
+        fuel, flyable = get_fuel_usage(route, s) if route is not None else (None, None)
+        result = {
+          'strategy': strategy, 'query': name, 'from': sys_from.name, 'to': sys_to.name, 'distance': sys_from.distance_to(sys_to),
+          'jumps': len(route) - 1 if route is not None else None, 'fuel': fuel, 'flyable': flyable,
+          'latency': dict(('p{}'.format(p), get_percentile(timings, p)) for p in percentiles),
+          'stats': stats.to_dict()
+        }
+        results.append(result)
+    self._print_routing(results)
+    return results
+
+  def _print_routing(self, results):
+    print("")
+    print("{:<8} {:<15} {:>8} {:>6} {:>8} {:>7} {}".format('strategy', 'query', 'dist', 'jumps', 'fuel', 'flyable', ' '.join('{:>8}'.format('p{}'.format(p)) for p in percentiles)))
+    for r in results:
+      print("{:<8} {:<15} {:>8.2f} {:>6} {:>8} {:>7} {}".format(
+        r['strategy'], r['query'], r['distance'],
+        r['jumps'] if r['jumps'] is not None else '-',
+        '{:.2f}'.format(r['fuel']) if r['fuel'] is not None else '-',
+        ('yes' if r['flyable'] else 'no') if r['flyable'] is not None else '-',
+        ' '.join('{:>7.3f}s'.format(r['latency']['p{}'.format(p)]) for p in percentiles)))
+
+  def _get_solver_instance(self, envdata, kind, count, seed):
+    rng = random.Random(seed)
+    sys_start = self._get_nearest_system(envdata, (0.0, 0.0, 0.0))
+    if sys_start is None:
+      return None
+    start = Station.none(sys_start)
+    stops = []
+    for pos in get_solver_positions(kind, count, rng):
+      sy = self._get_nearest_system(envdata, pos)
+      if sy is None:
+        continue
+      stop = Station.none(sy)
+      # Two positions close together can end up at the same system
+      if stop not in stops and stop != start:
+        stops.append(stop)
+    tours = []
+    if kind == 'tours':
+      chosen = rng.sample(stops, min(len(stops), solver_tour_count * solver_tour_length))
+      tours = [chosen[i:i+solver_tour_length] for i in range(0, len(chosen), solver_tour_length)]
+    return start, stops, tours
+
+  def run_solver(self):
+    s = ship.Ship(self.args.fsd, self.args.mass, self.args.tank)
+    jump_range = s.range()
+    instances = []
+    with env.use() as envdata:
+      for name, kind, count, seed in solver_instances:
+        if name in self.args.instances:
+          instance = self._get_solver_instance(envdata, kind, count, seed)
+          if instance is not None:
+            instances.append((name, kind, seed) + instance)
+
+    print("Jump range {:.2f}LY; solve time limit {}s".format(jump_range, self.args.solve_time_limit))
+    results = []
+    for name, kind, seed, start, stops, tours in instances:
+      instance_results = []
+      for mode in self.args.solve_modes:
+        # Some modes use the global random state, so give each one the same start
+        random.seed(seed)
+        # Routed mode needs routing to plot legs with; the costs reported are still the estimated ones, so all modes are compared alike
+        sv = solver.Solver(jump_range, 1.5, leg_cache=(rx.LegCache(rx.Routing(s), jump_range) if mode == solver.ROUTED else None))
+        budget = util.Budget(self.args.solve_time_limit)
+        timer = util.start_timer()
+        route, _ = sv.solve([list(t) for t in tours], list(stops), start, start, len(stops) + 2, mode, budget=budget)
+        elapsed = util.get_timer(timer)
+        valid = check_solver_route(route, start, start, stops, tours)
+        instance_results.append({
+          'instance': name, 'kind': kind, 'stops': len(stops), 'tours': len(tours), 'mode': mode,
+          'cost': calc.solve_route_cost(route, jump_range) if route is not None else None,
+          'time': elapsed, 'status': sv.status, 'valid': valid
+        })
+      # The gap is to the best valid route found by any mode in this run
+      costs = [r['cost'] for r in instance_results if r['valid']]
+      best = min(costs) if costs else None
+      for r in instance_results:
+        r['best'] = best
+        r['gap'] = (r['cost'] - best) / best if r['valid'] and best else None
+      results += instance_results
+    self._print_solver(results)
+    return results
+
+  def _print_solver(self, results):
+    print("")
+    print("{:<14} {:>5} {:<22} {:>10} {:>7} {:>8} {:<8} {}".format('instance', 'stops', 'mode', 'cost', 'gap', 'time', 'status', 'valid'))
+    for r in results:
+      print("{:<14} {:>5} {:<22} {:>10} {:>7} {:>7.3f}s {:<8} {}".format(
+        r['instance'], r['stops'], r['mode'],
+        '{:.1f}'.format(r['cost']) if r['cost'] is not None else '-',
+        '{:.2%}'.format(r['gap']) if r['gap'] is not None else '-',
+        r['time'], r['status'] or '-', 'yes' if r['valid'] else 'no'))
@@ -21,18 +21,28 @@ stop_outpost_time = 75
 stop_station_time = 90
 
 
+# Gets the straight-line factor for a leg between two positions, from a slftable.SLFTable if given one which knows the region
+def get_slf(pos_from, pos_to, jump_range, slf_table = None):
+  slf = slf_table.get(pos_from, pos_to, jump_range) if slf_table is not None else None
+  return slf if slf is not None else default_slf
+
 def jump_count(a, b, jump_range, slf = default_slf):
   _, maxjumps = jump_count_range(a, b, jump_range, slf)
   return maxjumps
 
 # Gets an estimated range of number of jumps required to jump from a to b
-def jump_count_range(a, b, jump_range, slf = default_slf):
+# Without a given factor, the one for the leg's region in slf_table is used if there is one
+def jump_count_range(a, b, jump_range, slf = None, slf_table = None):
   legdist = a.distance_to(b)
+  if slf is None and slf_table is not None and legdist > jump_range:
+    slf = get_slf(a.position, b.position, jump_range, slf_table)
+  return jump_count_range_for_distance(legdist, jump_range, slf)
 
+def jump_count_range_for_distance(legdist, jump_range, slf = None):
   minjumps = int(math.ceil(legdist / jump_range))
   # If we're doing multiple jumps, apply the straight-line factor
   if legdist > jump_range:
-    jump_range = jump_range * slf
+    jump_range = jump_range * (slf if slf is not None else default_slf)
   maxjumps = int(math.ceil(legdist / jump_range))
   return minjumps, maxjumps
 
@@ -49,9 +59,14 @@ def route_fuel_cost(route, ship, track_usage, starting_fuel = None):
 
 # The cost to go from a to b, as used in simple (non-routed) solving
 def solve_cost(a, b, jump_range, witchspace_time = default_ws_time):
-  hs_jumps = time_for_jumps(jump_count(a, b, jump_range), witchspace_time) * 2
-  hs_jdist = a.distance_to(b)
-  sc = sc_cost(b.distance if b.uses_sc else 0.0)
+  return solve_cost_for_distance(a.distance_to(b), sc_cost(b.distance if b.uses_sc else 0.0), jump_range, witchspace_time)
+
+# The same as solve_cost, given the distance between the stops and the SC cost at the destination
+# If the number of jumps is known (e.g. from a plotted route) it's used instead of an estimate
+def solve_cost_for_distance(hs_jdist, sc, jump_range, witchspace_time = default_ws_time, jump_count = None, slf = None):
+  if jump_count is None:
+    _, jump_count = jump_count_range_for_distance(hs_jdist, jump_range, slf)
+  hs_jumps = time_for_jumps(jump_count, witchspace_time) * 2
   return (hs_jumps + hs_jdist + sc)
 
 # Gets the cumulative solve cost for a set of legs
@@ -74,6 +89,14 @@ def trundle_cost(route, ship):
     var = math.sqrt(sum(l*l for l in [route[i+1].distance_to(route[i]) for i in range(len(route)-1)]))
   return (jump_count + var)
 
+# Gets the cost of a single jump in a trundle/trunkle route
+# Unlike trundle_cost this is additive along a route, so it can be used to rank partial routes of the same length
+def trundle_jump_cost(dist, ship):
+  if ship is not None:
+    return ship.cost(dist)
+  else:
+    return dist * dist
+
 # Gets the route cost for an A* route
 def astar_cost(a, b, route, jump_range, dist_threshold = None, witchspace_time = default_ws_time):
   jcount = jump_count(a, b, jump_range)
@@ -155,7 +178,7 @@ def _route_sd_or_var(route, dist, power):
   return cvar
 
 
-def astar(stars, sys_from, sys_to, valid_neighbour_fn, cost_fn):
+def astar(stars, sys_from, sys_to, valid_neighbour_fn, cost_fn, neighbours_fn = None, budget = None, stats = None):
   closedset = set()          # The set of nodes already evaluated.
   openset = set([sys_from])  # The set of tentative nodes to be evaluated, initially containing the start node
   came_from = dict()
@@ -172,8 +195,16 @@ def astar(stars, sys_from, sys_to, valid_neighbour_fn, cost_fn):
 
     openset.remove(current)
     closedset.add(current)
+    # A* has no complete route until it finishes, so there's nothing to return if we run out of budget
+    if budget is not None and budget.expand():
+      return None
 
-    neighbor_nodes = [n for n in stars if valid_neighbour_fn(n, current)]
+    # If we have a way of only getting the nearby stars, use it rather than checking every star
+    candidates = neighbours_fn(current) if neighbours_fn is not None else stars
+    neighbor_nodes = [n for n in candidates if valid_neighbour_fn(n, current)]
+    if stats is not None:
+      stats.expansions += 1
+      stats.neighbours += len(neighbor_nodes)
 
     path = _astar_reconstruct_path(came_from, current)
 
@@ -193,6 +224,9 @@ def astar(stars, sys_from, sys_to, valid_neighbour_fn, cost_fn):
         f_score[neighbor] = cost_fn(neighbor, sys_to, _astar_reconstruct_path(came_from, neighbor))
         openset.add(neighbor)
 
+    if stats is not None:
+      stats.update_openset_peak(len(openset))
+
   return None
 
 def _astar_reconstruct_path(came_from, current):
@@ -0,0 +1,98 @@
+import bisect
+import math
+
+from . import env
+from . import util
+
+log = util.get_logger("corridor")
+
+default_segment_ly = 250.0
+default_keep_behind_ly = 250.0
+
+
+# A cylinder of systems around a straight line, loaded lazily in segments along the line
+# Segments are fetched as they're first needed and evicted once the search has moved far enough past them
+class Corridor(object):
+  def __init__(self, vec_from, vec_to, buffer_ly, segment_ly = default_segment_ly, keep_behind_ly = default_keep_behind_ly, stats = None):
+    self._from = util.get_as_position(vec_from)
+    self._to = util.get_as_position(vec_to)
+    self._axis = (self._to - self._from).get_normalised()
+    self._length = (self._to - self._from).length
+    self._buffer = buffer_ly
+    self._segment_ly = segment_ly
+    self._keep_behind_ly = keep_behind_ly
+    self._segment_count = max(1, int(math.ceil(self._length / segment_ly)))
+    # index --> (sorted offsets, systems)
+    self._segments = {}
+    self._frontier = None
+    self.rows_fetched = 0
+    self.segments_loaded = 0
+    # Optionally also record how much work we do in a routing.RouteStats
+    self._stats = stats
+
+  @property
+  def length(self):
+    return self._length
+
+  def offset(self, pos):
+    return (util.get_as_position(pos) - self._from).dot(self._axis)
+
+  def distance_from_line(self, pos):
+    pos = util.get_as_position(pos)
+    return (pos - (self._from + self._axis * self.offset(pos))).length
+
+  def _get_segment_index(self, offset):
+    return min(self._segment_count - 1, max(0, int(math.floor(offset / self._segment_ly))))
+
+  def _load_segment(self, index):
+    if index in self._segments:
+      return self._segments[index]
+    start = index * self._segment_ly
+    end = min(self._length, (index + 1) * self._segment_ly)
+    timer = util.start_timer()
+    with env.use() as envdata:
+      stars_tmp = envdata.find_systems_by_aabb(self._from + self._axis * start, self._from + self._axis * end, self._buffer, self._buffer)
+    fetch_time = util.get_timer(timer)
+    self.rows_fetched += len(stars_tmp)
+    self.segments_loaded += 1
+    timer = util.start_timer()
+    stars = []
+    for s in stars_tmp:
+      offset = self.offset(s.position)
+      # Neighbouring boxes overlap, so only keep systems whose closest point on the line is in this segment
+      if self._get_segment_index(offset) != index:
+        continue
+      if self.distance_from_line(s.position) < self._buffer:
+        stars.append((offset, s))
+    stars.sort(key=lambda t: t[0])
+    if self._stats is not None:
+      self._stats.rows_fetched += len(stars_tmp)
+      self._stats.stars += len(stars)
+      self._stats.timings['fetch'] += fetch_time
+      self._stats.timings['filter'] += util.get_timer(timer)
+    self._segments[index] = ([t[0] for t in stars], [t[1] for t in stars])
+    log.debug("Loaded corridor segment {}/{}: {} systems from {} rows", index + 1, self._segment_count, len(stars), len(stars_tmp))
+    return self._segments[index]
+
+  def get_systems(self, offset_min, offset_max):
+    result = []
+    for index in range(self._get_segment_index(offset_min), self._get_segment_index(offset_max) + 1):
+      offsets, stars = self._load_segment(index)
+      result += stars[bisect.bisect_left(offsets, offset_min):bisect.bisect_right(offsets, offset_max)]
+    return result
+
+  def get_systems_near(self, pos, radius):
+    pos = util.get_as_position(pos)
+    offset = self.offset(pos)
+    return [s for s in self.get_systems(offset - radius, offset + radius) if (s.position - pos).length < radius]
+
+  def advance(self, pos):
+    # Move the frontier forward to pos, and drop any segments which are now far enough behind it
+    offset = self.offset(pos)
+    if self._frontier is not None and offset <= self._frontier:
+      return
+    self._frontier = offset
+    for index in list(self._segments.keys()):
+      if (index + 1) * self._segment_ly < offset - self._keep_behind_ly:
+        log.debug("Evicting corridor segment {}/{}", index + 1, self._segment_count)
+        del self._segments[index]
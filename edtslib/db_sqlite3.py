@@ -77,6 +77,11 @@ class SQLite3DBConnection(eb.EnvBackend):
     self._is_closed = True
     log.debug("DB connection closed")
 
+  def set_read_only(self, read_only):
+    c = self._conn.cursor()
+    c.execute('PRAGMA query_only = {}'.format('ON' if read_only else 'OFF'))
+    log.debug("DB connection set to {}", "read-only" if read_only else "read-write")
+
   def _create_tables(self):
     log.debug("Creating tables...")
     c = self._conn.cursor()
@@ -115,6 +120,19 @@ class SQLite3DBConnection(eb.EnvBackend):
     c.executemany('REPLACE INTO systems VALUES (?, ?, ?, ?, ?, NULL, ?, NULL, NULL, NULL)', self._generate_systems(many))
     self._conn.commit()
     log.debug("Done, {} rows inserted.", c.rowcount)
+    self._create_systems_indexes()
+
+  def populate_table_systems_full(self, many):
+    # Each item is a complete row: (edsm_id, name, x, y, z, eddb_id, id64, needs_permit, allegiance, data)
+    c = self._conn.cursor()
+    log.debug("Going for REPLACE INTO systems with full rows...")
+    c.executemany('REPLACE INTO systems VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', ((s[0], s[1], s[2], s[3], s[4], s[5], s[6], s[7], s[8], json.dumps(s[9]) if s[9] is not None else None) for s in many))
+    self._conn.commit()
+    log.debug("Done, {} rows inserted.", c.rowcount)
+    self._create_systems_indexes()
+
+  def _create_systems_indexes(self):
+    c = self._conn.cursor()
     log.debug("Going to add indexes to systems for name, pos_x/pos_y/pos_z, edsm_id...")
     c.execute('CREATE INDEX idx_systems_name ON systems (name COLLATE NOCASE)')
     c.execute('CREATE INDEX idx_systems_pos ON systems (pos_x, pos_y, pos_z)')
@@ -158,6 +176,12 @@ class SQLite3DBConnection(eb.EnvBackend):
     self._conn.commit()
     log.debug("Indexes added.")
 
+  def get_db_mtime(self):
+    c = self._conn.cursor()
+    c.execute('SELECT db_mtime FROM edts_info')
+    (db_mtime, ) = c.fetchone()
+    return db_mtime
+
   def retrieve_fsd_list(self):
     c = self._conn.cursor()
     cmd = 'SELECT id, data FROM coriolis_fsds'
@@ -7,7 +7,9 @@ import sys
 from . import env
 from . import calc
 from . import ship
+from . import routecache
 from . import routing as rx
+from . import slftable
 from . import util
 from . import solver
 from .station import Station
@@ -48,13 +50,24 @@ class Application(object):
     ap.add_argument("--reverse", default=False, action='store_true', help="Whether to reverse the generated route")
     ap.add_argument("--jump-time", type=float, default=calc.default_jump_time, help="Seconds taken per hyperspace jump")
     ap.add_argument("--diff-limit", type=float, default=1.5, help="The multiplier of the fastest route which a route must be over to be discounted")
-    ap.add_argument("--slf", type=float, default=calc.default_slf, help="The multiplier to apply to multi-jump legs to account for imperfect system positions")
+    ap.add_argument("--slf", type=float, default=None, help="The multiplier to apply to multi-jump legs to account for imperfect system positions, instead of the one measured for their region or {}".format(calc.default_slf))
+    ap.add_argument("--no-slf-table", dest='slf_table', action='store_false', default=True, help="Don't use the straight-line factors measured by 'update.py --build-slf-table', even if they're available")
     ap.add_argument("--route-strategy", default=rx.default_strategy, choices=rx.strategies, help="The strategy to use for route plotting")
     ap.add_argument("--rbuffer", type=float, default=rx.default_rbuffer_ly, help="A minimum buffer distance, in LY, used to search for valid stars for routing")
     ap.add_argument("--hbuffer", type=float, default=rx.default_hbuffer_ly, help="A minimum buffer distance, in LY, used to search for valid next legs. Not used by the 'astar' strategy.")
+    ap.add_argument("--beam-width", type=int, default=rx.default_trundle_beam_width, help="The number of partial routes kept per jump by the 'trundle' and 'trunkle' strategies, or 0 to check every viable route")
+    ap.add_argument("--route-time-limit", type=float, default=None, help="The maximum time in seconds to spend plotting routes, after which the best routes found so far are used")
+    ap.add_argument("--processes", type=int, default=1, help="The number of worker processes used to plot route legs and run clustered-repeat solves in parallel, or 0 to use one per CPU")
+    ap.add_argument("--route-cache", metavar="filename", nargs='?', const='', default=None, help="Reuse and store plotted routes in an on-disk cache, optionally giving the cache file to use")
+    ap.add_argument("--route-cache-bucket", type=float, default=routecache.default_range_bucket, help="The size, in LY, of the jump range buckets which share cached routes")
+    ap.add_argument("--route-cache-size", type=int, default=routecache.default_max_entries, help="The maximum number of routes to keep in the route cache")
     ap.add_argument("--solve-mode", type=str, default=solver.CLUSTERED, choices=solver.modes, help="The mode used by the travelling salesman solver")
+    ap.add_argument("--solve-time-limit", type=float, default=None, help="The maximum time in seconds to spend finding the best order to visit stations in, after which the best order found so far is used")
+    ap.add_argument("--local-search-time", type=float, default=solver.local_search_time_limit, help="The maximum time in seconds to spend improving the solver's route with local search, or 0 to not do so")
     ap.add_argument("stations", metavar="system[/station]", nargs="*", help="A station to travel via, in the form 'system/station' or 'system'")
     self.args = ap.parse_args(arg)
+    # Within edi, keep hold of what we can between runs, so that changing a plan a bit doesn't mean starting again
+    self.state = state if hosted else None
 
     if self.args.fsd is not None and self.args.mass is not None and self.args.tank is not None:
       # If user has provided full ship data in this invocation, use it
@@ -109,9 +122,25 @@ class Application(object):
       self.stations += stations
 
     # If the user hasn't provided a number of stops to use, assume we're stopping at all provided
+    # Keep what was asked for, as the default changes whenever the stations do
+    self.num_jumps_given = self.args.num_jumps
     if self.args.num_jumps is None:
       self.args.num_jumps = len(self.stations)
 
+  # Gets the cargo carried on the leg ending at the ith stop
+  def _get_leg_cargo(self, i):
+    return self.args.initial_cargo + self.args.cargo * (i-1)
+
+  # Gets the (full, current) jump ranges for the leg ending at the ith stop
+  def _get_leg_ranges(self, i):
+    if self.args.jump_range is not None:
+      full_max_jump = self.args.jump_range - (self.args.jump_decay * (i-1))
+      cur_max_jump = full_max_jump
+    else:
+      full_max_jump = self.ship.range(cargo = self._get_leg_cargo(i))
+      cur_max_jump = self.ship.max_range(cargo = self._get_leg_cargo(i)) if self.args.long_jumps else full_max_jump
+    return (full_max_jump, cur_max_jump)
+
   def run(self):
     timer = util.start_timer()
     with env.use() as envdata:
@@ -125,8 +154,22 @@ class Application(object):
         log.error("Error: end system/station {0} could not be found. Stopping.", self.args.end)
         return
 
+      # Estimate how many jumps legs take using the straight-line factors measured for each region, if they have been
+      slf_table = None
+      if self.args.slf_table:
+        if self.state is not None and 'edts_slf_table' in self.state:
+          slf_table = self.state['edts_slf_table']
+        else:
+          slf_table = slftable.load(db_mtime=envdata.db_mtime)
+          if self.state is not None:
+            self.state['edts_slf_table'] = slf_table
+
       # Locate all the systems/stations provided and ensure they're valid for our ship
-      stations = envdata.parse_stations(self.stations)
+      known = self.state.setdefault('edts_stations', {}) if self.state is not None else {}
+      unknown = [sname for sname in self.stations if sname not in known]
+      stations = envdata.parse_stations(unknown) if unknown else {}
+      stations.update((sname, known[sname]) for sname in self.stations if sname in known)
+      known.update((sname, sobj) for sname, sobj in stations.items() if sobj is not None)
       for sname in self.stations:
         if sname in stations and stations[sname] is not None:
           sobj = stations[sname]
@@ -150,14 +193,44 @@ class Application(object):
       full_jump_range = self.ship.range()
       jump_range = self.ship.max_range() if self.args.long_jumps else full_jump_range
 
-    r = rx.Routing(self.ship, self.args.rbuffer, self.args.hbuffer, self.args.route_strategy, witchspace_time=self.args.witchspace_time)
-    s = solver.Solver(jump_range, self.args.diff_limit, witchspace_time=self.args.witchspace_time)
+    cache = routecache.RouteCache(self.args.route_cache, self.args.route_cache_bucket, self.args.route_cache_size) if self.args.route_cache is not None else None
+    r = rx.Routing(self.ship, self.args.rbuffer, self.args.hbuffer, self.args.route_strategy, witchspace_time=self.args.witchspace_time, beam_width=self.args.beam_width, route_cache=cache)
+    # Routed solving plots legs as it goes; the ones it has plotted stay useful for as long as the ship and routing settings don't change
+    leg_cache = None
+    if self.args.solve_mode == solver.ROUTED:
+      leg_key = (jump_range, full_jump_range, self.args.rbuffer, self.args.witchspace_time)
+      if self.state is not None and self.state.get('edts_leg_cache', (None, None))[0] == leg_key:
+        leg_cache = self.state['edts_leg_cache'][1]
+      else:
+        leg_cache = rx.LegCache(r, jump_range, full_jump_range)
+        if self.state is not None:
+          self.state['edts_leg_cache'] = (leg_key, leg_cache)
+
+    # The solver keeps the costs it has worked out, so reuse the last one if it was set up the same way
+    solver_key = (jump_range, self.args.diff_limit, self.args.witchspace_time, self.args.local_search_time, self.args.processes, leg_cache, slf_table)
+    if self.state is not None and self.state.get('edts_solver', (None, None))[0] == solver_key:
+      s = self.state['edts_solver'][1]
+    else:
+      s = solver.Solver(jump_range, self.args.diff_limit, witchspace_time=self.args.witchspace_time, local_search_time=self.args.local_search_time, processes=self.args.processes, leg_cache=leg_cache, slf_table=slf_table)
+      if self.state is not None:
+        self.state['edts_solver'] = (solver_key, s)
+        self.state.pop('edts_route', None)
 
     if len(tours) == 1:
       route = [start] + stations + [end]
     else:
       # Add 2 to the jump count for start + end
-      route, is_definitive = s.solve(tours, stations, start, end, self.args.num_jumps + 2, self.args.solve_mode)
+      solve_budget = util.Budget(seconds=self.args.solve_time_limit) if self.args.solve_time_limit is not None else None
+      # The last route is only worth updating if it was solved the same way, for the same number of stops and the same tours
+      route_key = (self.args.solve_mode, self.num_jumps_given, solver.get_tour_key(tours))
+      previous = self.state.get('edts_route', (None, None, None, None, False)) if self.state is not None else (None, None, None, None, False)
+      if previous[0] == route_key:
+        route, is_definitive = s.solve_incremental(previous[1], tours, stations, start, end, self.args.num_jumps + 2, self.args.solve_mode, budget=solve_budget, previous_tours=previous[2], previous_status=previous[3], previous_definitive=previous[4])
+      else:
+        route, is_definitive = s.solve(tours, stations, start, end, self.args.num_jumps + 2, self.args.solve_mode, budget=solve_budget)
+      log.debug("Solved station order with status {}", s.status)
+      if self.state is not None and route is not None:
+        self.state['edts_route'] = (route_key, route, tours, s.status, is_definitive)
 
     if self.args.reverse:
       route = [route[0]] + list(reversed(route[1:-1])) + [route[-1]]
@@ -176,21 +249,28 @@ class Application(object):
     if route is not None and len(route) > 0:
       output_data.append({'src': route[0].to_string()})
 
+      # Plot all the legs needing a full route up front, so they can be done in parallel
+      plotted_legs = {}
+      if self.args.route:
+        legs = []
+        budget = util.Budget(seconds=self.args.route_time_limit) if self.args.route_time_limit is not None else None
+        for i in range(1, len(route)):
+          full_max_jump, cur_max_jump = self._get_leg_ranges(i)
+          _, jcount_max = calc.jump_count_range(route[i-1], route[i], cur_max_jump, slf=self.args.slf, slf_table=slf_table)
+          if route[i-1].system != route[i].system and jcount_max > 1:
+            log.debug("Doing route plot for {0} --> {1}", route[i-1].system_name, route[i].system_name)
+            legs.append((i, (route[i-1].system, route[i].system, cur_max_jump, full_max_jump, self._get_leg_cargo(i))))
+        plotted_legs = dict(zip([i for i, _ in legs], r.plot_legs([leg for _, leg in legs], processes=self.args.processes, budget=budget)))
+
       for i in range(1, len(route)):
         cur_data = {'src': route[i-1], 'dst': route[i]}
 
-        if self.args.jump_range is not None:
-          full_max_jump = self.args.jump_range - (self.args.jump_decay * (i-1))
-          cur_max_jump = full_max_jump
-        else:
-          full_max_jump = self.ship.range(cargo = self.args.initial_cargo + self.args.cargo * (i-1))
-          cur_max_jump = self.ship.max_range(cargo = self.args.initial_cargo + self.args.cargo * (i-1)) if self.args.long_jumps else full_max_jump
+        full_max_jump, cur_max_jump = self._get_leg_ranges(i)
 
-        cur_data['jumpcount_min'], cur_data['jumpcount_max'] = calc.jump_count_range(route[i-1], route[i], cur_max_jump, slf=self.args.slf)
+        cur_data['jumpcount_min'], cur_data['jumpcount_max'] = calc.jump_count_range(route[i-1], route[i], cur_max_jump, slf=self.args.slf, slf_table=slf_table)
         if self.args.route:
-          log.debug("Doing route plot for {0} --> {1}", route[i-1].system_name, route[i].system_name)
-          if route[i-1].system != route[i].system and cur_data['jumpcount_max'] > 1:
-            leg_route = r.plot(route[i-1].system, route[i].system, cur_max_jump, full_max_jump)
+          if i in plotted_legs:
+            leg_route = plotted_legs[i]
           else:
             leg_route = [route[i-1].system, route[i].system]
 
@@ -227,14 +307,17 @@ class Application(object):
             min_tank = None
             max_tank = None
             if cur_fuel is not None:
-              fuel_cost = min(self.ship.cost(ldist, cur_fuel), self.ship.fsd.maxfuel)
-              min_tank, max_tank = self.ship.fuel_weight_range(ldist, self.args.initial_cargo + self.args.cargo * (i-1))
+              fuel_cost = min(self.ship.cost(ldist, cur_fuel, self._get_leg_cargo(i)), self.ship.fsd.maxfuel)
+              min_tank, max_tank = self.ship.fuel_weight_range(ldist, self._get_leg_cargo(i))
               if max_tank is not None and max_tank >= self.ship.tank_size:
                 max_tank = None
               total_fuel_cost += fuel_cost
               cur_fuel -= fuel_cost
+              if self.args.route_strategy == 'fuel' and leg_route[j].is_scoopable:
+                # Fuel-aware routes are plotted assuming we top up at every scoopable star
+                cur_fuel = self.ship.tank_size
               # TODO: Something less arbitrary than this?
-              if cur_fuel < 0:
+              elif cur_fuel < 0:
                 cur_fuel = self.ship.tank_size if self.ship is not None else self.args.tank
             # Write all data about this jump to the current leg info
             cur_data['leg_route'].append({
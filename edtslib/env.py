@@ -87,6 +87,10 @@ class Env(object):
   def backend_name(self):
     return (self._backend.backend_name if self._backend else None)
 
+  @property
+  def db_mtime(self):
+    return self._backend.get_db_mtime()
+
   @property
   def filter_converters(self):
     return {'system': self.parse_system, 'station': self.parse_station}
@@ -268,6 +272,9 @@ class Env(object):
     for (sy, st) in self._backend.find_stations_by_name(name, mode=eb.FIND_REGEX, filters=self._get_as_filters(filters)):
       yield _make_station(sy, st, keep_data)
 
+  def set_read_only(self, read_only):
+    self._backend.set_read_only(read_only)
+
   def _load_data(self):
     try:
       self._load_coriolis_data()
@@ -328,6 +335,15 @@ def start(path = default_path, backend = default_backend_name):
     return True
 
 
+def start_worker(path = default_path, backend = default_backend_name):
+  # Any environments inherited from a parent process must not be used here, so forget them and open our own
+  _open_backends.clear()
+  if not start(path, backend):
+    return False
+  _open_backends[(backend, path)].set_read_only(True)
+  return True
+
+
 def is_started(path = default_path, backend = default_backend_name):
   return ((backend, path) in _open_backends and _open_backends[(backend, path)].is_data_loaded)
 
@@ -11,6 +11,14 @@ class EnvBackend(object):
   def __init__(self, backend_name):
     self.backend_name = backend_name
 
+  def set_read_only(self, read_only):
+    # Optional; backends which cannot enforce this may ignore it
+    pass
+
+  def get_db_mtime(self):
+    # return int or None
+    raise NotImplementedError("Invalid use of base EnvBackend get_db_mtime method")
+
   def retrieve_fsd_list(self):
     # return {"fsd_class": fsd_object}
     raise NotImplementedError("Invalid use of base EnvBackend retrieve_fsd_list method")
@@ -0,0 +1,87 @@
+import math
+import random
+
+from . import db_sqlite3 as db
+from . import util
+from . import vector3
+
+log = util.get_logger("galaxygen")
+
+default_star_count = 60000
+default_seed = 1
+# Star positions in the real data are on a 1/32Ly grid
+position_grid = 32.0
+# Arrival star classes and how often they turn up; roughly half of them are scoopable
+star_class_weights = [('M', 30), ('K', 10), ('G', 6), ('F', 3), ('A', 1), ('B', 1), ('L', 15), ('T', 12), ('Y', 6), ('DA', 8), ('N', 4), ('H', 4)]
+# Offset for synthetic id64s, so they can't be mistaken for real ones
+synthetic_id64_base = 1 << 48
+
+# FSDs with similar characteristics to the real Coriolis data, so that ship calculations behave sensibly
+_fsd_class_data = {2: (90.0, 0.9, 2.0, 2.5), 3: (150.0, 1.8, 2.15, 5.0), 4: (525.0, 3.0, 2.3, 10.0), 5: (1050.0, 5.0, 2.45, 20.0), 6: (1800.0, 8.0, 2.6, 40.0), 7: (2700.0, 12.8, 2.75, 80.0)}
+_fsd_rating_data = {'A': (1.0, 0.012, 1.0), 'B': (0.833, 0.01, 1.6), 'C': (0.667, 0.008, 1.0), 'D': (0.6, 0.01, 0.4), 'E': (0.533, 0.011, 1.0)}
+
+
+def get_fsds():
+  fsds = []
+  for fclass, (optmass, maxfuel, fuelpower, mass) in sorted(_fsd_class_data.items()):
+    for rating, (optmass_mul, fuelmul, mass_mul) in sorted(_fsd_rating_data.items()):
+      maxfuel_mul = 1.0 if rating in 'AB' else 0.8 if rating in 'CD' else 0.6
+      fsds.append({'class': fclass, 'rating': rating, 'optmass': optmass * optmass_mul, 'maxfuel': maxfuel * maxfuel_mul, 'fuelmul': fuelmul, 'fuelpower': fuelpower, 'mass': mass * mass_mul})
+  return fsds
+
+
+# A simple model of a galaxy: a disc with a sparse halo of stars, a dense bubble in the middle and some voids
+# Densities are relative to each other; the total number of stars is decided when generating
+class GalaxyModel(object):
+  def __init__(self, bubble_radius = 250.0, bubble_density = 20.0, halo_radius = 1200.0, halo_height = 100.0, halo_density = 1.0, voids = None):
+    self.bubble_radius = bubble_radius
+    self.bubble_density = bubble_density
+    self.halo_radius = halo_radius
+    self.halo_height = halo_height
+    self.halo_density = halo_density
+    # Each void is a tuple of (centre, radius)
+    self.voids = voids if voids is not None else [(vector3.Vector3(600.0, 0.0, 400.0), 200.0), (vector3.Vector3(-500.0, 0.0, -600.0), 250.0)]
+
+  @property
+  def max_density(self):
+    return max(self.halo_density, self.halo_density + self.bubble_density)
+
+  def density(self, pos):
+    if abs(pos.y) > self.halo_height or math.hypot(pos.x, pos.z) > self.halo_radius:
+      return 0.0
+    if any((pos - centre).length < radius for centre, radius in self.voids):
+      return 0.0
+    # The bubble gets gradually sparser towards its edge, eventually just being part of the halo
+    return self.halo_density + self.bubble_density * max(0.0, 1.0 - pos.length / self.bubble_radius)
+
+  def generate_positions(self, count, rng):
+    generated = 0
+    while generated < count:
+      pos = vector3.Vector3(rng.uniform(-self.halo_radius, self.halo_radius), rng.uniform(-self.halo_height, self.halo_height), rng.uniform(-self.halo_radius, self.halo_radius))
+      # Rejection sampling, so the chance of keeping a position is proportional to its density
+      if rng.random() * self.max_density < self.density(pos):
+        yield vector3.Vector3(*[round(v * position_grid) / position_grid for v in pos])
+        generated += 1
+
+
+def generate_systems(count = default_star_count, seed = default_seed, model = None):
+  model = model if model is not None else GalaxyModel()
+  rng = random.Random(seed)
+  classes = [c for c, w in star_class_weights for _ in range(w)]
+  # Always have a Sol at the origin, to give queries somewhere familiar to start from
+  yield (0, 'Sol', 0.0, 0.0, 0.0, 0, synthetic_id64_base, False, None, {'id': 0, 'name': 'Sol', 'x': 0.0, 'y': 0.0, 'z': 0.0, 'arrival_star_class': 'G'})
+  for i, pos in enumerate(model.generate_positions(count, rng), 1):
+    name = 'Synthetic {}'.format(i)
+    data = {'id': i, 'name': name, 'x': pos.x, 'y': pos.y, 'z': pos.z, 'arrival_star_class': rng.choice(classes)}
+    yield (i, name, pos.x, pos.y, pos.z, i, synthetic_id64_base + i, False, None, data)
+
+
+def generate_db(filename, count = default_star_count, seed = default_seed, model = None):
+  timer = util.start_timer()
+  dbc = db.initialise_db(filename)
+  try:
+    dbc.populate_table_systems_full(generate_systems(count, seed, model))
+    dbc.populate_table_coriolis_fsds(get_fsds())
+  finally:
+    dbc.close()
+  log.info("Generated synthetic database {} with {} systems in {}", filename, count + 1, util.format_timer(timer))
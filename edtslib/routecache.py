@@ -0,0 +1,109 @@
+import json
+import math
+import os
+import sqlite3
+import time
+
+from . import env
+from . import util
+from .system_internal import KnownSystem
+
+log = util.get_logger("routecache")
+
+default_cache_file = 'routecache.db'
+default_range_bucket = 0.5
+default_max_entries = 10000
+
+
+def get_default_path():
+  # Keep the cache alongside the database it was generated from
+  db_path = os.path.join(os.path.normpath(env.default_path), os.path.normpath(env.global_args.db_file))
+  return os.path.join(os.path.dirname(db_path), default_cache_file)
+
+
+class RouteCache(object):
+  def __init__(self, filename = None, range_bucket = default_range_bucket, max_entries = default_max_entries, db_mtime = None):
+    self._filename = filename if filename else get_default_path()
+    self._range_bucket = range_bucket
+    self._max_entries = max_entries
+    self._db_mtime = db_mtime
+    self._conn = None
+
+  def __getstate__(self):
+    # Connections can't be shared between processes; each one opens its own when first used
+    state = self.__dict__.copy()
+    state['_conn'] = None
+    return state
+
+  def close(self):
+    if self._conn is not None:
+      self._conn.close()
+      self._conn = None
+
+  def _open(self):
+    if self._conn is None:
+      self._conn = sqlite3.connect(self._filename, timeout=30.0)
+      c = self._conn.cursor()
+      c.execute('CREATE TABLE IF NOT EXISTS cache_info (db_mtime INTEGER)')
+      c.execute('CREATE TABLE IF NOT EXISTS routes (key TEXT NOT NULL PRIMARY KEY, route TEXT NOT NULL, last_used REAL NOT NULL)')
+      c.execute('CREATE INDEX IF NOT EXISTS idx_routes_last_used ON routes (last_used)')
+      self._conn.commit()
+      self._check_db_mtime()
+    return self._conn
+
+  def _check_db_mtime(self):
+    if self._db_mtime is None:
+      with env.use() as envdata:
+        self._db_mtime = envdata.db_mtime
+    c = self._conn.cursor()
+    c.execute('SELECT db_mtime FROM cache_info')
+    result = c.fetchone()
+    if result is None or result[0] != self._db_mtime:
+      log.debug("Route cache was built from a different database, clearing it")
+      c.execute('DELETE FROM cache_info')
+      c.execute('DELETE FROM routes')
+      c.execute('INSERT INTO cache_info VALUES (?)', (self._db_mtime, ))
+      self._conn.commit()
+
+  def _get_key(self, sys_from, sys_to, params, jump_range, full_range):
+    if sys_from.id64 is None or sys_to.id64 is None:
+      return None
+    range_key = int(math.floor(jump_range / self._range_bucket))
+    full_range_key = int(math.floor(full_range / self._range_bucket))
+    return '/'.join(str(k) for k in [sys_from.id64, sys_to.id64] + list(params) + [range_key, full_range_key])
+
+  def get(self, sys_from, sys_to, params, jump_range, full_range):
+    key = self._get_key(sys_from, sys_to, params, jump_range, full_range)
+    if key is None:
+      return None
+    conn = self._open()
+    c = conn.cursor()
+    c.execute('SELECT route FROM routes WHERE key = ?', (key, ))
+    result = c.fetchone()
+    if result is None:
+      return None
+    route = [sys_from] + [KnownSystem(s) for s in json.loads(result[0])[1:-1]] + [sys_to]
+    # Routes are shared by a range of jump ranges, so make sure this one is still valid for ours
+    if any(route[i-1].distance_to(route[i]) > jump_range for i in range(1, len(route))):
+      log.debug("Cached route {} is not valid for jump range {:.2f}LY", key, jump_range)
+      return None
+    c.execute('UPDATE routes SET last_used = ? WHERE key = ?', (time.time(), key))
+    conn.commit()
+    return route
+
+  def put(self, sys_from, sys_to, params, jump_range, full_range, route):
+    key = self._get_key(sys_from, sys_to, params, jump_range, full_range)
+    if key is None or route is None:
+      return
+    # Keep the star class too, as fuel routes depend on which systems can be refuelled at
+    data = json.dumps([{'name': s.name, 'x': s.position.x, 'y': s.position.y, 'z': s.position.z, 'id64': s.id64, 'arrival_star_class': s.arrival_star_class} for s in route])
+    conn = self._open()
+    c = conn.cursor()
+    c.execute('REPLACE INTO routes VALUES (?, ?, ?)', (key, data, time.time()))
+    # Evict the least recently used routes if we're over our size limit
+    c.execute('SELECT COUNT(*) FROM routes')
+    (count, ) = c.fetchone()
+    if count > self._max_entries:
+      c.execute('DELETE FROM routes WHERE key IN (SELECT key FROM routes ORDER BY last_used ASC, rowid ASC LIMIT ?)', (count - self._max_entries, ))
+      log.debug("Evicted {} routes from the route cache", count - self._max_entries)
+    conn.commit()
@@ -1,29 +1,93 @@
+import bisect
+import collections
+import contextlib
+import heapq
 import math
+import multiprocessing
 import sys
 
 from . import calc
+from . import corridor
 from . import env
+from . import spatial
 from . import util
+from . import vector3
 
 log = util.get_logger("route")
 
-strategies = ["astar", "trunkle", "trundle"]
+strategies = ["astar", "trunkle", "trundle", "fuel"]
 default_strategy = "astar"
 default_rbuffer_ly = 40.0
 default_hbuffer_ly = 10.0
 hbuffer_relax_increment = 5.0
 hbuffer_relax_max = 31.0
+# Routes longer than this load their stars in segments along the route rather than all at once
+corridor_min_length_ly = 1000.0
+# Fuel amounts closer than this are treated as equal when checking if one route is better than another
+fuel_dominance_epsilon = 0.01
+# The number of partial routes kept per jump when trundling; None or 0 enumerates every viable route instead
+default_trundle_beam_width = 32
+# Legs which couldn't be plotted are given this many jumps, so that solvers stay away from them
+unplottable_leg_jumps = 1000
+
+
+# Counters and timings describing how much work a route plot did
+class RouteStats(object):
+  phases = ['fetch', 'filter', 'search']
+
+  def __init__(self):
+    self.rows_fetched = 0
+    self.stars = 0
+    self.expansions = 0
+    self.neighbours = 0
+    self.openset_peak = 0
+    self.hbuffer_relaxations = 0
+    self.timings = collections.OrderedDict((p, 0.0) for p in self.phases)
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    start = util.start_timer()
+    try:
+      yield
+    finally:
+      self.timings[name] += util.get_timer(start)
+
+  def update_openset_peak(self, size):
+    self.openset_peak = max(self.openset_peak, size)
+
+  def add(self, other):
+    self.rows_fetched += other.rows_fetched
+    self.stars += other.stars
+    self.expansions += other.expansions
+    self.neighbours += other.neighbours
+    self.openset_peak = max(self.openset_peak, other.openset_peak)
+    self.hbuffer_relaxations += other.hbuffer_relaxations
+    for p in other.timings:
+      self.timings[p] = self.timings.get(p, 0.0) + other.timings[p]
+
+  def to_dict(self):
+    return {
+      'rows_fetched': self.rows_fetched, 'stars': self.stars, 'expansions': self.expansions, 'neighbours': self.neighbours,
+      'openset_peak': self.openset_peak, 'hbuffer_relaxations': self.hbuffer_relaxations, 'timings': dict(self.timings)
+    }
+
+  def __str__(self):
+    return "rows fetched: {}, stars: {}, expansions: {}, neighbours: {}, openset peak: {}, hbuffer relaxations: {}, {}".format(
+      self.rows_fetched, self.stars, self.expansions, self.neighbours, self.openset_peak, self.hbuffer_relaxations,
+      ", ".join("{}: {:.4f}s".format(p, t) for p, t in self.timings.items()))
 
 
 class Routing(object):
 
-  def __init__(self, ship, rbuf_base = default_rbuffer_ly, hbuf_base = default_hbuffer_ly, route_strategy = default_strategy, witchspace_time = calc.default_ws_time):
+  def __init__(self, ship, rbuf_base = default_rbuffer_ly, hbuf_base = default_hbuffer_ly, route_strategy = default_strategy, witchspace_time = calc.default_ws_time, beam_width = default_trundle_beam_width, route_cache = None):
     self._ship = ship
     self._rbuffer_base = rbuf_base
     self._hbuffer_base = hbuf_base
     self._route_strategy = route_strategy
     self._ws_time = witchspace_time
+    self._route_cache = route_cache
     self._trundle_max_addjumps = 4
+    self._trundle_beam_width = beam_width
     self._trunkle_max_addjumps_mul = 1.0
     self._ocount_initial_boost = 1.0
     self._ocount_relax_inc_mul = 0.01
@@ -32,6 +96,8 @@ class Routing(object):
     self._trunkle_leg_size = 5.0
     self._trunkle_search_radius = 10.0
     self._trunkle_search_radius_relax_mul = 0.01
+    self._corridor_min_length = corridor_min_length_ly
+    self._corridor_segment_ly = corridor.default_segment_ly
 
   def lerp(self, in_min, in_max, out_min, out_max, value):
     if in_max == in_min:
@@ -58,46 +124,275 @@ class Routing(object):
 
     return candidates
 
-  def plot(self, sys_from, sys_to, jump_range, full_range = None):
+  def plot(self, sys_from, sys_to, jump_range, full_range = None, cargo = 0, budget = None, stats = None):
     if full_range is None:
       full_range = jump_range
+    if stats is None:
+      stats = RouteStats()
     timer = util.start_timer()
+    phase_time = stats.timings['fetch'] + stats.timings['filter']
+
+    if self._route_cache is not None:
+      result = self._route_cache.get(sys_from, sys_to, self._get_cache_params(cargo), jump_range, full_range)
+      if result is not None:
+        log.debug("Route plot from {} to {} found in route cache after {}", sys_from, sys_to, util.format_timer(timer))
+        return result
 
     if self._route_strategy == "trundle":
       # My algorithm - slower but pinpoint
-      result = self.plot_trundle(sys_from, sys_to, jump_range, full_range)
+      result = self.plot_trundle(sys_from, sys_to, jump_range, full_range, budget=budget, stats=stats)
     elif self._route_strategy == "trunkle":
       # Hybrid - splits route up into N-jump blocks, and runs trundle on each block
-      result = self.plot_trunkle(sys_from, sys_to, jump_range, full_range)
+      result = self.plot_trunkle(sys_from, sys_to, jump_range, full_range, budget=budget, stats=stats)
+    elif self._route_strategy == "fuel":
+      # A* over fuel levels as well as systems - only plots routes which can actually be flown, refuelling where possible
+      result = self.plot_fuel(sys_from, sys_to, jump_range, full_range, cargo=cargo, budget=budget, stats=stats)
     elif self._route_strategy == "astar":
       # A* search - faster but worse fuel efficiency
-      result = self.plot_astar(sys_from, sys_to, jump_range, full_range)
+      result = self.plot_astar(sys_from, sys_to, jump_range, full_range, budget=budget, stats=stats)
     else:
       log.error("Tried to use invalid route strategy {0}", self._route_strategy)
       result = None
+    # Whatever wasn't spent fetching or filtering stars was spent searching them
+    stats.timings['search'] += util.get_timer(timer) - (stats.timings['fetch'] + stats.timings['filter'] - phase_time)
+
+    if budget is not None and budget.exceeded:
+      # Don't cache anything we found, as a full search might well find something better
+      log.warning("Route plot from {} to {} ran out of budget after {}, {}", sys_from, sys_to, util.format_timer(timer), "returning the best route found so far" if result is not None else "no route found")
+    elif self._route_cache is not None and result is not None:
+      self._route_cache.put(sys_from, sys_to, self._get_cache_params(cargo), jump_range, full_range, result)
 
     log.debug("Route plot from {} to {} using strategy {} finished after {}", sys_from, sys_to, self._route_strategy, util.format_timer(timer))
+    log.debug("Route plot stats: {}", stats)
     return result
 
-  def plot_astar(self, sys_from, sys_to, jump_range, full_range):
+  def _get_cache_params(self, cargo = 0):
+    # Everything other than the jump range which the route plotted depends on
+    params = [self._route_strategy, self._rbuffer_base, self._hbuffer_base, self._ws_time]
+    if self._route_strategy in ["trundle", "trunkle"]:
+      params.append(self._trundle_beam_width)
+    elif self._route_strategy == "fuel" and self._ship is not None:
+      # Fuel routes are only any good for the same ship
+      fsd = self._ship.fsd
+      params += [fsd.optmass, fsd.maxfuel, fsd.fuelmul, fsd.fuelpower, fsd.boost, self._ship.mass, self._ship.tank_size, cargo]
+    return tuple(params)
+
+  def plot_legs(self, legs, processes = 1, budget = None, stats = None):
+    # Each leg is a tuple of (sys_from, sys_to, jump_range, full_range), optionally followed by the cargo carried
+    # The budget is shared by all legs; worker processes get their own copy, so can't be cancelled from here
+    # If given, stats are collected across all of the legs
+    if processes == 1 or len(legs) < 2:
+      return [self.plot(*leg, budget=budget, stats=stats) for leg in legs]
+
+    timer = util.start_timer()
+    # Legs are independent and CPU-bound, so spread them over worker processes which open their own environment
+    pool = multiprocessing.Pool(processes or None, initializer=_init_leg_worker)
+    try:
+      results = pool.map(_plot_leg, [(self, leg, budget) for leg in legs], chunksize=1)
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+    log.debug("Plotted {} legs using {} processes in {}", len(legs), processes or multiprocessing.cpu_count(), util.format_timer(timer))
+    if stats is not None:
+      for _, leg_stats in results:
+        stats.add(leg_stats)
+    return [route for route, _ in results]
+
+  def get_cylinder(self, vec_from, vec_to, buffer_ly, stats = None, starcache = None):
+    # Gets the stars within buffer_ly of the line between two points, either from the database or a cache of stars
+    if stats is None:
+      stats = RouteStats()
+    if starcache is not None:
+      stars_tmp = starcache
+    else:
+      with stats.phase('fetch'):
+        with env.use() as envdata:
+          stars_tmp = envdata.find_systems_by_aabb(vec_from, vec_to, buffer_ly, buffer_ly)
+      stats.rows_fetched += len(stars_tmp)
+    with stats.phase('filter'):
+      stars = list(self.cylinder(stars_tmp, vec_from, vec_to, buffer_ly))
+    if starcache is None:
+      stats.stars += len(stars)
+    return stars
+
+  def plot_many(self, sys_from, targets, jump_range, full_range = None, starcache = None, budget = None, stats = None):
+    # Plots routes from one system to many at once, sharing the stars between them
+    # Returns a dict of target --> route, where the route is None if the target couldn't be reached
+    if full_range is None:
+      full_range = jump_range
+    if stats is None:
+      stats = RouteStats()
+    timer = util.start_timer()
     rbuffer_ly = self._rbuffer_base
-    with env.use() as envdata:
-      stars_tmp = envdata.find_systems_by_aabb(sys_from.position, sys_to.position, rbuffer_ly, rbuffer_ly)
-    stars = list(self.cylinder(stars_tmp, sys_from.position, sys_to.position, rbuffer_ly))
+    if starcache is not None:
+      stars_tmp = starcache
+    else:
+      # One fetch of the box around the source and every target covers all of their cylinders
+      positions = [sys_from.position] + [t.position for t in targets]
+      vec_min = vector3.Vector3(*[min(p[axis] for p in positions) for axis in range(3)])
+      vec_max = vector3.Vector3(*[max(p[axis] for p in positions) for axis in range(3)])
+      with stats.phase('fetch'):
+        with env.use() as envdata:
+          stars_tmp = envdata.find_systems_by_aabb(vec_min, vec_max, rbuffer_ly, rbuffer_ly)
+      stats.rows_fetched += len(stars_tmp)
+    stars = set()
+    with stats.phase('filter'):
+      for t in targets:
+        stars.update(self.cylinder(stars_tmp, sys_from.position, t.position, rbuffer_ly))
+    if starcache is None:
+      stats.stars += len(stars)
+    # Ensure the targets are present, in case they're "fake" systems not in the main list
+    stars.update(targets)
+    with stats.phase('filter'):
+      grid = spatial.Grid(stars, jump_range)
+    search_timer = util.start_timer()
+    log.debug("Plotting from {} to {} targets using {} stars", sys_from, len(targets), len(stars))
+
+    # Dijkstra's algorithm costing each jump by its time and distance, with a penalty for jumps beyond full_range
+    # There's no heuristic or route variance, so stopping once every target has been reached gives each its cheapest route
+    # Running out of budget just leaves the targets we haven't reached yet without a route
+    remaining = set(targets)
+    came_from = {}
+    g_score = {sys_from: 0.0}
+    closedset = set()
+    openset = [(0.0, 0, sys_from)]
+    counter = 1
+    while any(openset) and any(remaining):
+      score, _, current = heapq.heappop(openset)
+      if current in closedset:
+        continue
+      closedset.add(current)
+      remaining.discard(current)
+      if budget is not None and budget.expand():
+        break
+      stats.expansions += 1
+      neighbours = grid.get_near(current.position, jump_range)
+      stats.neighbours += len(neighbours)
+      for n in neighbours:
+        if n in closedset:
+          continue
+        dist = n.distance_to(current)
+        tentative_g_score = score + calc.time_for_jumps(1, self._ws_time) + dist + (20 if dist > full_range else 0)
+        if tentative_g_score < g_score.get(n, sys.float_info.max):
+          g_score[n] = tentative_g_score
+          came_from[n] = current
+          heapq.heappush(openset, (tentative_g_score, counter, n))
+          counter += 1
+      stats.update_openset_peak(len(openset))
+
+    stats.timings['search'] += util.get_timer(search_timer)
+    result = {}
+    for t in targets:
+      result[t] = calc._astar_reconstruct_path(came_from, t) if t in closedset else None
+    log.debug("Plotted from {} to {} targets ({} unreachable) after {}", sys_from, len(targets), len(remaining), util.format_timer(timer))
+    return result
+
+  def get_corridor(self, sys_from, sys_to, buffer_ly, stats = None):
+    # Only worth streaming stars in for long routes; shorter ones just load the whole cylinder up front
+    if sys_from.distance_to(sys_to) < self._corridor_min_length:
+      return None
+    return corridor.Corridor(sys_from.position, sys_to.position, buffer_ly, self._corridor_segment_ly, stats=stats)
+
+  def plot_astar(self, sys_from, sys_to, jump_range, full_range, budget = None, stats = None):
+    rbuffer_ly = self._rbuffer_base
+    valid_neighbour_fn = lambda n, current: n != current and n.distance_to(current) < jump_range
+    cost_fn = lambda cur, neighbour, path: calc.astar_cost(cur, neighbour, path, jump_range, full_range, witchspace_time=self._ws_time)
+
+    cr = self.get_corridor(sys_from, sys_to, rbuffer_ly, stats)
+    if cr is not None:
+      def neighbours_fn(current):
+        cr.advance(current.position)
+        # Ensure the target system is present, in case it's a "fake" system not in the main list
+        return cr.get_systems_near(current.position, jump_range) + [sys_to]
+      return calc.astar(None, sys_from, sys_to, valid_neighbour_fn, cost_fn, neighbours_fn, budget=budget, stats=stats)
+
+    stars = self.get_cylinder(sys_from.position, sys_to.position, rbuffer_ly, stats)
     # Ensure the target system is present, in case it's a "fake" system not in the main list
     if sys_to not in stars:
       stars.append(sys_to)
 
-    valid_neighbour_fn = lambda n, current: n != current and n.distance_to(current) < jump_range
-    cost_fn = lambda cur, neighbour, path: calc.astar_cost(cur, neighbour, path, jump_range, full_range, witchspace_time=self._ws_time)
-    return calc.astar(stars, sys_from, sys_to, valid_neighbour_fn, cost_fn)
+    return calc.astar(stars, sys_from, sys_to, valid_neighbour_fn, cost_fn, budget=budget, stats=stats)
+
+  def plot_fuel(self, sys_from, sys_to, jump_range, full_range, cargo = 0, budget = None, stats = None):
+    if self._ship is None:
+      log.error("The fuel route strategy requires full ship details rather than just a jump range")
+      return None
+    rbuffer_ly = self._rbuffer_base
+    if stats is None:
+      stats = RouteStats()
+    cr = corridor.Corridor(sys_from.position, sys_to.position, rbuffer_ly, self._corridor_segment_ly, stats=stats)
+    # No jump can go further than this, however much fuel we have
+    max_range = min(jump_range, self._ship.max_range(cargo))
+
+    def estimate(s):
+      return int(math.ceil(s.distance_to(sys_to) / max_range))
+
+    # Labels are (system, fuel remaining, jumps, refuels, parent label)
+    start = (sys_from, self._ship.tank_size, 0, 0, None)
+    labels = {sys_from: [start]}
+    # Prefer the fewest possible total jumps, then the fewest refuels, then whichever is closest to the end
+    openset = [((estimate(sys_from), 0, sys_from.distance_to(sys_to)), 0, start)]
+    counter = 1
+    while any(openset):
+      _, _, label = heapq.heappop(openset)
+      cur, fuel, jcount, refuels, _ = label
+      # Skip labels which have been beaten since they were added
+      if not any(l is label for l in labels.get(cur, [])):
+        continue
+      if budget is not None and budget.expand():
+        return None
+      stats.expansions += 1
+      if cur == sys_to:
+        route = []
+        while label is not None:
+          route.append(label[0])
+          label = label[4]
+        return list(reversed(route))
+
+      cr.advance(cur.position)
+      reach = min(max_range, self._ship.range(fuel=fuel, cargo=cargo))
+      candidates = cr.get_systems_near(cur.position, reach)
+      if cur.distance_to(sys_to) < reach:
+        candidates.append(sys_to)
+      stats.neighbours += len(candidates)
+      for n in candidates:
+        if n == cur:
+          continue
+        cost = self._ship.cost(n.distance_to(cur), fuel, cargo)
+        if cost > min(fuel, self._ship.fsd.maxfuel):
+          continue
+        n_fuel = self._ship.tank_size if n.is_scoopable else fuel - cost
+        n_refuels = refuels + (1 if n.is_scoopable and n != sys_to else 0)
+        # A label is pointless if another reaches the same system in no more jumps with at least as much fuel
+        existing = labels.get(n, [])
+        if any(l[2] <= jcount + 1 and l[1] >= n_fuel - fuel_dominance_epsilon for l in existing):
+          continue
+        new_label = (n, n_fuel, jcount + 1, n_refuels, label)
+        labels[n] = [l for l in existing if not (l[2] >= jcount + 1 and l[1] <= n_fuel)] + [new_label]
+        heapq.heappush(openset, ((jcount + 1 + estimate(n), n_refuels, n.distance_to(sys_to)), counter, new_label))
+        counter += 1
+      stats.update_openset_peak(len(openset))
+
+    log.debug("No fuel-viable route found")
+    return None
 
-  def plot_trunkle(self, sys_from, sys_to, jump_range, full_range):
+  def plot_trunkle(self, sys_from, sys_to, jump_range, full_range, budget = None, stats = None):
+    if stats is None:
+      stats = RouteStats()
     rbuffer_ly = self._rbuffer_base
-    # Get full cylinder to work from
-    with env.use() as envdata:
-      stars_tmp = envdata.find_systems_by_aabb(sys_from.position, sys_to.position, rbuffer_ly, rbuffer_ly)
-    stars = list(self.cylinder(stars_tmp, sys_from.position, sys_to.position, rbuffer_ly))
+    # Legs are trundled using stars around their own line, which may stray outside our cylinder, so load a wider one
+    cr = self.get_corridor(sys_from, sys_to, rbuffer_ly * 2, stats)
+    if cr is None:
+      # Get full cylinder to work from
+      with stats.phase('fetch'):
+        with env.use() as envdata:
+          stars_tmp = envdata.find_systems_by_aabb(sys_from.position, sys_to.position, rbuffer_ly, rbuffer_ly)
+      stats.rows_fetched += len(stars_tmp)
+      stars = self.get_cylinder(sys_from.position, sys_to.position, rbuffer_ly, stats, stars_tmp)
+      stats.stars += len(stars)
 
     best_jump_count = int(math.ceil(sys_from.distance_to(sys_to) / jump_range))
 
@@ -119,6 +414,10 @@ class Routing(object):
     route = [sys_from]
     # While we haven't hit our limit to bomb out...
     while optimistic_count - best_jump_count <= (self._trunkle_max_addjumps_mul * best_jump_count):
+      # We only have a complete route once we reach the end, so there's nothing to return if we stop early
+      if budget is not None and budget.expand():
+        log.debug("Out of budget after plotting {0} jumps", len(route)-1)
+        return None
       # If this isn't our final leg...
       if next_stars is None or len(next_stars) == 0:
         if force_intermediate or self.best_jump_count(sys_cur, sys_to, jump_range) > trunc_jcount:
@@ -126,7 +425,10 @@ class Routing(object):
           # Work out the next position to get a circle of stars from
           next_pos = sys_cur.position + (sys_to.position - sys_cur.position).get_normalised() * factor
           # Get a circle of stars around the estimate
-          c_next_stars = self.circle(stars, next_pos, search_radius)
+          if cr is not None:
+            c_next_stars = [s for s in cr.get_systems_near(next_pos, search_radius) if cr.distance_from_line(s.position) < rbuffer_ly]
+          else:
+            c_next_stars = self.circle(stars, next_pos, search_radius)
           # Limit them to only ones where it's possible we'll get a valid route
           c_next_stars = [s for s in c_next_stars if self.best_jump_count(sys_cur, s, jump_range) <= trunc_jcount and s not in failed_attempts]
           c_next_stars.sort(key=lambda t: t.distance_to(sys_to))
@@ -148,7 +450,10 @@ class Routing(object):
       # This prevents getting stuck if we think we can get to sys_to in N, but actually need N+1
       jlimit = max(0, trunc_jcount - best_jcount) if next_star != sys_to else None
       # Use trundle to try and calculate a route
-      next_route = self.plot_trundle(sys_cur, next_star, jump_range, full_range, jlimit, starcache = stars_tmp)
+      if cr is not None:
+        offsets = sorted([cr.offset(sys_cur.position), cr.offset(next_star.position)])
+        stars_tmp = cr.get_systems(offsets[0] - rbuffer_ly, offsets[1] + rbuffer_ly)
+      next_route = self.plot_trundle(sys_cur, next_star, jump_range, full_range, jlimit, starcache = stars_tmp, budget = budget, stats = stats)
       # If our route was invalid or too long, check the next star
       if next_route is None or (next_star != sys_to and len(next_route)-1 > trunc_jcount):
         next_stars = next_stars[1:]
@@ -166,6 +471,8 @@ class Routing(object):
       # We have a valid route of the correct length, add it to the main route
       route += next_route[1:]
       sys_cur = next_star
+      if cr is not None:
+        cr.advance(sys_cur.position)
       force_intermediate = False
       search_radius = self._trunkle_search_radius
       next_stars = []
@@ -186,18 +493,15 @@ class Routing(object):
     log.debug("No full-route found")
     return None
 
-  def plot_trundle(self, sys_from, sys_to, jump_range, full_range, addj_limit = None, starcache = None):
+  def plot_trundle(self, sys_from, sys_to, jump_range, full_range, addj_limit = None, starcache = None, budget = None, stats = None):
     if sys_from == sys_to:
       return [sys_from]
 
+    if stats is None:
+      stats = RouteStats()
     rbuffer_ly = self._rbuffer_base
     hbuffer_ly = self._hbuffer_base
-    if starcache is not None:
-      stars_tmp = starcache
-    else:
-      with env.use() as envdata:
-        stars_tmp = envdata.find_systems_by_aabb(sys_from.position, sys_to.position, rbuffer_ly, rbuffer_ly)
-    stars = list(self.cylinder(stars_tmp, sys_from.position, sys_to.position, rbuffer_ly))
+    stars = self.get_cylinder(sys_from.position, sys_to.position, rbuffer_ly, stats, starcache)
 
     log.debug("{0} --> {1}: systems to search from: {2}", sys_from.name, sys_to.name, len(stars))
 
@@ -207,11 +511,18 @@ class Routing(object):
     best = None
     bestcost = None
 
-    while best is None and add_jumps <= self._trundle_max_addjumps and (addj_limit is None or add_jumps <= addj_limit):
-      while best is None and (hbuffer_ly < hbuffer_relax_max or hbuffer_ly == self._hbuffer_base):
+    # If we run out of budget we stop looking, and use the best route found so far (if any)
+    while best is None and add_jumps <= self._trundle_max_addjumps and (addj_limit is None or add_jumps <= addj_limit) and not (budget is not None and budget.exceeded):
+      while best is None and (hbuffer_ly < hbuffer_relax_max or hbuffer_ly == self._hbuffer_base) and not (budget is not None and budget.exceeded):
         log.debug("Attempt {0} at hbuffer {1:.1f}, jump count: {2}, calculating...", add_jumps, hbuffer_ly, best_jump_count + add_jumps)
+        if hbuffer_ly != self._hbuffer_base:
+          stats.hbuffer_relaxations += 1
         vrcount = 0
-        for route in self.trundle_get_viable_routes([sys_from], stars, sys_to, jump_range, add_jumps, hbuffer_ly):
+        if self._trundle_beam_width:
+          routes = self.trundle_beam_search(sys_from, stars, sys_to, jump_range, add_jumps, hbuffer_ly, budget, stats)
+        else:
+          routes = self.trundle_get_viable_routes([sys_from], stars, sys_to, jump_range, add_jumps, hbuffer_ly, budget, stats)
+        for route in routes:
           cost = calc.trundle_cost(route, self._ship)
           if bestcost is None or cost < bestcost:
             best = route
@@ -231,13 +542,16 @@ class Routing(object):
   def best_jump_count(self, sys_from, sys_to, jump_range):
     return int(math.ceil(sys_from.distance_to(sys_to) / jump_range))
 
-  def trundle_get_viable_routes(self, route, stars, sys_to, jump_range, add_jumps, hbuffer_ly):
+  def trundle_get_viable_routes(self, route, stars, sys_to, jump_range, add_jumps, hbuffer_ly, budget = None, stats = None):
     best_jcount = int(math.ceil(route[0].distance_to(sys_to) / jump_range)) + add_jumps
     vec_mult = 0.5
 
-    return self._trundle_gvr_internal(route, stars, sys_to, jump_range, add_jumps, best_jcount, vec_mult, hbuffer_ly)
+    return self._trundle_gvr_internal(route, stars, sys_to, jump_range, add_jumps, best_jcount, vec_mult, hbuffer_ly, budget, stats if stats is not None else RouteStats())
 
-  def _trundle_gvr_internal(self, route, stars, sys_to, jump_range, add_jumps, best_jcount, vec_mult, hbuffer_ly):
+  def _trundle_gvr_internal(self, route, stars, sys_to, jump_range, add_jumps, best_jcount, vec_mult, hbuffer_ly, budget, stats):
+    if budget is not None and budget.expand():
+      return
+    stats.expansions += 1
     cur_dist = route[-1].distance_to(sys_to)
     if cur_dist > jump_range:
       # dir(current_pos --> sys_to) * jump_range
@@ -247,6 +561,7 @@ class Routing(object):
       end_vec = route[-1].position + dir_vec
       # Get viable stars; if we're adding jumps, use a smaller buffer cylinder to prevent excessive searching
       mystars = self.cylinder(stars, start_vec, end_vec, hbuffer_ly)
+      stats.neighbours += len(mystars)
 
       result_count = 0
       short_stars = []
@@ -263,7 +578,7 @@ class Routing(object):
           if dist_jumpN < maxd:
             # If we're going 4 systems or further we probably won't take any jumps < 2/3 of our range
             if (best_jcount <= 3 or next_dist*1.5 >= jump_range):
-              for r in self._trundle_gvr_internal(route + [s], stars, sys_to, jump_range, add_jumps, best_jcount, vec_mult, hbuffer_ly):
+              for r in self._trundle_gvr_internal(route + [s], stars, sys_to, jump_range, add_jumps, best_jcount, vec_mult, hbuffer_ly, budget, stats):
                 yield r
                 result_count += 1
             else:
@@ -271,9 +586,133 @@ class Routing(object):
       # If we got no results at all, try the short stars too just in case
       if result_count == 0:
         for s in short_stars:
-          for r in self._trundle_gvr_internal(route + [s], stars, sys_to, jump_range, add_jumps, best_jcount, vec_mult, hbuffer_ly):
+          for r in self._trundle_gvr_internal(route + [s], stars, sys_to, jump_range, add_jumps, best_jcount, vec_mult, hbuffer_ly, budget, stats):
             yield r
             result_count += 1
     else:
       route.append(sys_to)
-      yield route
\ No newline at end of file
+      yield route
+
+  def trundle_beam_search(self, sys_from, stars, sys_to, jump_range, add_jumps, hbuffer_ly, budget = None, stats = None):
+    if stats is None:
+      stats = RouteStats()
+    best_jcount = int(math.ceil(sys_from.distance_to(sys_to) / jump_range)) + add_jumps
+    vec_mult = 0.5
+    # Sort the stars along the route so each jump only has to check those within range of it along the axis
+    axis = (sys_to.position - sys_from.position).get_normalised()
+    stars = sorted(stars, key=lambda t: (t.position - sys_from.position).dot(axis))
+    offsets = [(s.position - sys_from.position).dot(axis) for s in stars]
+    # The possible next jumps only depend on the system we're jumping from, so only find them once
+    next_cache = {}
+    # Each layer holds the best partial route found to each system using that many jumps
+    layer = {sys_from: (None, 0.0, [sys_from])}
+    complete = []
+
+    for jcount in range(0, best_jcount):
+      next_layer = {}
+      for cur, (_, cost, route) in layer.items():
+        if cur.distance_to(sys_to) <= jump_range:
+          complete.append(route + [sys_to])
+          continue
+        if budget is not None and budget.expand():
+          return complete
+        stats.expansions += 1
+        if cur not in next_cache:
+          cur_offset = (cur.position - sys_from.position).dot(axis)
+          nearby = stars[bisect.bisect_left(offsets, cur_offset - jump_range):bisect.bisect_right(offsets, cur_offset + jump_range)]
+          next_cache[cur] = self._trundle_next_candidates(cur, nearby, sys_to, jump_range, best_jcount, vec_mult, hbuffer_ly)
+        long_stars, short_stars = next_cache[cur]
+        # Is it possible for us to still hit the current total jump count with this jump?
+        maxd = (best_jcount - jcount - 1) * jump_range
+        candidates = [c for c in long_stars if c[2] < maxd]
+        # If we got no results at all, try the short stars too just in case
+        if not any(candidates):
+          candidates = [c for c in short_stars if c[2] < maxd]
+        stats.neighbours += len(candidates)
+        for s, next_dist, dist_jumpN in candidates:
+          new_cost = cost + calc.trundle_jump_cost(next_dist, self._ship)
+          key = self._trundle_beam_key(jcount + 1, new_cost, dist_jumpN, jump_range)
+          if s not in next_layer or key < next_layer[s][0]:
+            next_layer[s] = (key, new_cost, route + [s])
+      if not any(next_layer):
+        break
+      stats.update_openset_peak(len(next_layer))
+      # Only keep the most promising partial routes for the next layer
+      kept = sorted(next_layer.items(), key=lambda t: t[1][0])[0:self._trundle_beam_width]
+      layer = dict(kept)
+
+    return complete
+
+  def _trundle_next_candidates(self, cur, stars, sys_to, jump_range, best_jcount, vec_mult, hbuffer_ly):
+    dir_vec = ((sys_to.position - cur.position).get_normalised() * jump_range)
+    start_vec = cur.position + (dir_vec * vec_mult)
+    end_vec = cur.position + dir_vec
+    long_stars = []
+    short_stars = []
+    for s in self.cylinder(stars, start_vec, end_vec, hbuffer_ly):
+      next_dist = cur.distance_to(s)
+      if next_dist < jump_range:
+        entry = (s, next_dist, s.distance_to(sys_to))
+        # If we're going 4 systems or further we probably won't take any jumps < 2/3 of our range
+        if best_jcount <= 3 or next_dist*1.5 >= jump_range:
+          long_stars.append(entry)
+        else:
+          short_stars.append(entry)
+    return (long_stars, short_stars)
+
+  def _trundle_beam_key(self, jcount, cost, remaining, jump_range):
+    # Rank primarily on the fewest jumps we could still finish in, as trundle_cost does for complete routes
+    min_remaining = int(math.ceil(remaining / jump_range))
+    # Jump costs are convex, so equal-length jumps over the remaining distance give a lower bound on their cost
+    estimate = (min_remaining * calc.trundle_jump_cost(remaining / min_remaining, self._ship)) if min_remaining else 0.0
+    return (jcount + min_remaining, cost + estimate)
+
+
+# The number of jumps in routes plotted between pairs of systems, so that solving can use them instead of estimates
+# Legs are plotted from one system to many others at once, and kept for as long as the cache is, so it can be shared between solves
+class LegCache(object):
+  def __init__(self, routing, jump_range, full_range = None, starcache = None):
+    self._routing = routing
+    self._jump_range = jump_range
+    self._full_range = full_range
+    self._starcache = starcache
+    self._jumps = {}
+
+  def __len__(self):
+    return len(self._jumps)
+
+  def get_jump_count(self, sys_from, sys_to):
+    # None if the leg hasn't been plotted
+    if sys_from == sys_to:
+      return 0
+    return self._jumps.get((sys_from, sys_to))
+
+  def plot(self, sys_from, targets, budget = None):
+    # Plots any legs from sys_from to the targets which aren't known yet, and returns how many were
+    targets = [t for t in set(targets) if t != sys_from and (sys_from, t) not in self._jumps]
+    if not any(targets) or (budget is not None and budget.exceeded):
+      return 0
+    routes = self._routing.plot_many(sys_from, targets, self._jump_range, self._full_range, starcache=self._starcache, budget=budget)
+    out_of_time = budget is not None and budget.exceeded
+    count = 0
+    for t, route in routes.items():
+      if route is None and out_of_time:
+        # It might well have been reached given more time, so don't write it off
+        continue
+      # The same number of jumps will do in either direction
+      self._jumps[(sys_from, t)] = self._jumps[(t, sys_from)] = len(route) - 1 if route is not None else unplottable_leg_jumps
+      count += 1
+    return count
+
+
+#
+# Worker processes for plotting multiple legs
+#
+def _init_leg_worker():
+  env.start_worker()
+
+
+def _plot_leg(args):
+  routing, leg, budget = args
+  stats = RouteStats()
+  return (routing.plot(*leg, budget=budget, stats=stats), stats)
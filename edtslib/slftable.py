@@ -0,0 +1,166 @@
+import json
+import math
+import os
+import random
+
+from . import env
+from . import util
+from . import vector3
+
+log = util.get_logger("slftable")
+
+default_table_file = 'slf.json'
+# The size of the cubes the galaxy is split into, each with its own factors
+default_cell_size = 500.0
+# The jump ranges factors are measured at; others are interpolated between them
+default_jump_ranges = [20.0, 35.0, 50.0]
+# The number of routes plotted for each cell at each jump range
+default_samples = 6
+default_seed = 1
+# Sample routes are between this many and max_sample_jumps jumps long if flown in a straight line
+min_sample_jumps = 3
+max_sample_jumps = 8
+# How far from a sample route's ends to look for systems to plot it between, as a fraction of the jump range
+sample_search_fraction = 0.5
+# The number of directions to try for each sample route before giving up on finding somewhere to plot it to
+sample_attempts = 5
+# The time to spend plotting each sample route before giving up on it
+sample_time_limit = 5.0
+# Factors are kept within these bounds, so a cell with unlucky samples can't make estimates absurd
+min_factor = 0.3
+max_factor = 1.0
+
+
+def get_default_path():
+  # Keep the table alongside the database it was built from
+  db_path = os.path.join(os.path.normpath(env.default_path), os.path.normpath(env.global_args.db_file))
+  return os.path.join(os.path.dirname(db_path), default_table_file)
+
+
+# Straight-line factors measured from plotted routes, for each cell of the galaxy that has been sampled
+# A leg's factor comes from the cell its midpoint is in, interpolated between the jump ranges measured
+class SLFTable(object):
+  def __init__(self, cell_size = default_cell_size, jump_ranges = default_jump_ranges, factors = None, db_mtime = None):
+    self.cell_size = cell_size
+    self.jump_ranges = sorted(jump_ranges)
+    # Cell -> list of factors, one per jump range, None where there weren't enough samples
+    self.factors = factors if factors is not None else {}
+    self.db_mtime = db_mtime
+
+  def __len__(self):
+    return len(self.factors)
+
+  def get_cell(self, pos):
+    return tuple(int(math.floor(pos[axis] / self.cell_size)) for axis in range(3))
+
+  def get(self, pos_from, pos_to, jump_range):
+    # None if the table doesn't know about this part of the galaxy
+    midpoint = [(pos_from[axis] + pos_to[axis]) / 2.0 for axis in range(3)]
+    factors = self.factors.get(self.get_cell(midpoint))
+    if factors is None:
+      return None
+    known = [(r, f) for r, f in zip(self.jump_ranges, factors) if f is not None]
+    if not any(known):
+      return None
+    if jump_range <= known[0][0]:
+      return known[0][1]
+    for (r1, f1), (r2, f2) in zip(known, known[1:]):
+      if jump_range <= r2:
+        return f1 + (f2 - f1) * (jump_range - r1) / (r2 - r1)
+    return known[-1][1]
+
+  def save(self, filename = None):
+    data = {
+      'cell_size': self.cell_size,
+      'jump_ranges': self.jump_ranges,
+      'db_mtime': self.db_mtime,
+      'factors': [list(cell) + [factors] for cell, factors in sorted(self.factors.items())],
+    }
+    with open(filename if filename else get_default_path(), 'w') as f:
+      json.dump(data, f)
+
+
+def load(filename = None, db_mtime = None):
+  # Returns None if there's no table, or it was built from a different database
+  filename = filename if filename else get_default_path()
+  if not os.path.isfile(filename):
+    return None
+  try:
+    with open(filename) as f:
+      data = json.load(f)
+  except (IOError, ValueError):
+    log.warning("Could not read straight-line factor table {}, ignoring it", filename)
+    return None
+  if db_mtime is None:
+    with env.use() as envdata:
+      db_mtime = envdata.db_mtime
+  if data.get('db_mtime') != db_mtime:
+    log.warning("Straight-line factor table {} was built from a different database, ignoring it", filename)
+    return None
+  factors = dict((tuple(entry[0:3]), entry[3]) for entry in data['factors'])
+  return SLFTable(data['cell_size'], data['jump_ranges'], factors, data['db_mtime'])
+
+
+def _get_nearest_system(envdata, pos, radius, max_radius):
+  # Looks further and further out until there's a system, or it would be further away than max_radius
+  while True:
+    candidates = [s for s in envdata.find_systems_by_aabb(pos, pos, radius, radius) if (s.position - pos).length <= radius]
+    if any(candidates):
+      return min(candidates, key=lambda s: (s.position - pos).length)
+    if radius >= max_radius:
+      return None
+    radius = min(radius * 2, max_radius)
+
+
+def _sample_route(routing, envdata, cell, cell_size, jump_range, rng):
+  # Plots a route from a system in the cell in a random direction, returning its midpoint and how much of the
+  # straight-line distance each jump covered on average
+  pos = vector3.Vector3(*[(cell[axis] + rng.random()) * cell_size for axis in range(3)])
+  sys_from = _get_nearest_system(envdata, pos, jump_range * sample_search_fraction, cell_size / 2.0)
+  if sys_from is None:
+    return None
+  sys_to = None
+  # The galaxy is much flatter than it is wide, so plenty of directions lead nowhere
+  for _ in range(sample_attempts):
+    direction = vector3.Vector3(rng.gauss(0, 1), rng.gauss(0, 1), rng.gauss(0, 1))
+    if direction.length == 0.0:
+      continue
+    target = sys_from.position + direction.get_normalised() * (rng.uniform(min_sample_jumps, max_sample_jumps) * jump_range)
+    sys_to = _get_nearest_system(envdata, target, jump_range * sample_search_fraction, jump_range * sample_search_fraction)
+    if sys_to is not None and sys_to.distance_to(sys_from) > jump_range * min_sample_jumps / 2.0:
+      break
+    sys_to = None
+  if sys_to is None:
+    return None
+  route = routing.plot(sys_from, sys_to, jump_range, budget=util.Budget(sample_time_limit))
+  if route is None or len(route) < 3:
+    return None
+  midpoint = (sys_from.position + sys_to.position) / 2.0
+  return midpoint, sys_from.distance_to(sys_to) / ((len(route) - 1) * jump_range)
+
+
+def build(routing, centre, radius, cell_size = default_cell_size, jump_ranges = default_jump_ranges, samples = default_samples, seed = default_seed):
+  # Samples routes starting in every cell within radius of centre; each is counted towards the cell its midpoint is in, as
+  # that's what the table is looked up by, and cells which no routes crossed the middle of end up without factors
+  rng = random.Random(seed)
+  with env.use() as envdata:
+    table = SLFTable(cell_size, jump_ranges, db_mtime=envdata.db_mtime)
+    lo = [int(math.floor((centre[axis] - radius) / cell_size)) for axis in range(3)]
+    hi = [int(math.floor((centre[axis] + radius) / cell_size)) for axis in range(3)]
+    cells = [(x, y, z) for x in range(lo[0], hi[0] + 1) for y in range(lo[1], hi[1] + 1) for z in range(lo[2], hi[2] + 1)]
+    # Include any cell that's partly within the radius
+    half_diagonal = cell_size * math.sqrt(3) / 2.0
+    cells = [c for c in cells if (vector3.Vector3(*[(c[axis] + 0.5) * cell_size for axis in range(3)]) - centre).length <= radius + half_diagonal]
+    values = {}
+    for n, cell in enumerate(cells):
+      for r, jump_range in enumerate(table.jump_ranges):
+        for _ in range(samples):
+          result = _sample_route(routing, envdata, cell, cell_size, jump_range, rng)
+          if result is not None:
+            midpoint, factor = result
+            values.setdefault(table.get_cell(midpoint), [[] for _ in table.jump_ranges])[r].append(factor)
+      log.debug("Sampled cell {}/{} {}", n + 1, len(cells), cell)
+  for cell, cell_values in values.items():
+    # The median route is more typical than the mean if a few samples found an unusually direct or indirect one
+    table.factors[cell] = [max(min_factor, min(max_factor, sorted(v)[len(v) // 2])) if any(v) else None for v in cell_values]
+  return table
@@ -1,29 +1,75 @@
+import array
+import collections
+import heapq
 import math
+import multiprocessing
 import random
 import sys
 import time
 
 from . import calc
+from . import spatial
 from . import util
 from . import vector3
 
 log = util.get_logger("solver")
 
-max_single_solve_size = 8
+# Held-Karp is exact, but its time and memory grow exponentially with the number of stops
+held_karp_auto_size = 14
+held_karp_max_size = 18
+# Branch and bound is also exact, but gives up and reports how far from optimal its best route could be after this long
+branch_and_bound_time_limit = 10.0
 cluster_size_max = 8
 cluster_size_min = 1
 cluster_divisor = 10
 cluster_iteration_limit = 50
 cluster_repeat_limit = 100
-cluster_route_search_limit = 4
+# Stop repeating once this many solves in a row haven't found anything better
+cluster_repeat_patience = 25
+# Up to this many clusters, the order to visit them in is found exactly; beyond it, a quick order is improved with local search
+cluster_route_exact_max = 12
 supercluster_size_max = 8
+# Below this many pairs of systems, finding the closest pair between two clusters just tries every pair
+closest_points_grid_min = 64
+# K-means stops once no center moves by more than this many LY in an iteration
+kmeans_tolerance = 0.01
+kmeans_iteration_limit = 100
+# Up to this many stops, every solve cost between them is calculated up front; beyond it they're filled in as needed
+cost_matrix_precompute_max = 1000
+# Local search tidies up the finished route until it stops improving, or runs out of time or moves
+local_search_time_limit = 1.0
+local_search_iteration_limit = 10000
+local_search_neighbours = 8
+local_search_segment_max = 3
+local_search_epsilon = 1e-9
+# An existing route is only updated for changed stops if no more than this fraction of them have changed; otherwise it's solved from scratch
+incremental_change_fraction = 0.2
+# Iterated local search keeps shaking up the route and tidying it again, for sets of stops too big for the other modes
+iterated_local_search_time_limit = 10.0
+# The most stops in each of the sections of the route swapped around by each shake-up
+iterated_local_search_kick_span = 30
+# Stop early once this many shake-ups in a row haven't found anything better
+iterated_local_search_patience = 1000
+# Also stop once this many shake-ups in a row couldn't be made at all, e.g. because of tour constraints
+iterated_local_search_failed_kick_limit = 100
+# Routed mode plots real routes for the legs a good route is likely to use, for up to this long before making do with estimates
+routed_plot_time_limit = 10.0
 
 
 CLUSTERED         = "clustered"
 CLUSTERED_REPEAT  = "clustered-repeat"
 BASIC             = "basic"
 NEAREST_NEIGHBOUR = "nearest-neighbour"
-modes = [CLUSTERED, CLUSTERED_REPEAT, BASIC, NEAREST_NEIGHBOUR]
+HELD_KARP         = "held-karp"
+BRANCH_AND_BOUND  = "branch-and-bound"
+ITERATED_LOCAL_SEARCH = "iterated-local-search"
+ROUTED            = "routed"
+modes = [CLUSTERED, CLUSTERED_REPEAT, BASIC, NEAREST_NEIGHBOUR, HELD_KARP, BRANCH_AND_BOUND, ITERATED_LOCAL_SEARCH, ROUTED]
+
+# How good the last solve's route is known to be: proved optimal, better than a quick initial route, or only that initial route
+STATUS_OPTIMAL  = "optimal"
+STATUS_IMPROVED = "improved"
+STATUS_INITIAL  = "initial"
 
 
 class _Cluster(object):
@@ -55,51 +101,490 @@ class _Cluster(object):
     return "Cluster(size={}, pos={})".format(len(self.systems), self.position)
 
 
-class Solver(object):
-  def __init__(self, jump_range, diff_limit, witchspace_time = calc.default_ws_time):
-    self._diff_limit = diff_limit
+# The solve costs between pairs of stops, each calculated at most once
+# Stops are given indices in the order they're added, so hot loops can work with those instead of the stops
+# If given a routing.LegCache, the number of jumps in any leg it has plotted is used instead of an estimate
+# If given a slftable.SLFTable, estimates use the straight-line factor for each leg's region
+class _CostMatrix(object):
+  def __init__(self, jump_range, witchspace_time = calc.default_ws_time, leg_cache = None, slf_table = None):
     self._jump_range = jump_range
     self._ws_time = witchspace_time
+    self._leg_cache = leg_cache
+    self._slf_table = slf_table
+    self.stops = []
+    self._index = {}
+    self._positions = []
+    self._sc = []
+    # Each row only holds the costs which have been needed, so large sets of stops don't need space for every pair
+    self._rows = []
+
+  def __len__(self):
+    return len(self.stops)
+
+  def add(self, stop):
+    idx = self._index.get(stop)
+    if idx is None:
+      idx = len(self.stops)
+      self._index[stop] = idx
+      self.stops.append(stop)
+      self._positions.append((stop.position.x, stop.position.y, stop.position.z))
+      # The SC part of the cost only depends on the destination
+      self._sc.append(calc.sc_cost(stop.distance if stop.uses_sc else 0.0))
+      self._rows.append({})
+    return idx
+
+  def add_all(self, stops, precompute = False):
+    indices = [self.add(s) for s in stops]
+    if precompute and len(self.stops) <= cost_matrix_precompute_max:
+      for i, row in enumerate(self._rows):
+        for j in range(len(self._rows)):
+          if j not in row:
+            row[j] = self._calculate(i, j)
+    return indices
+
+  def cost_index(self, i, j):
+    row = self._rows[i]
+    cost = row.get(j)
+    if cost is None:
+      cost = row[j] = self._calculate(i, j)
+    return cost
+
+  def cost(self, a, b):
+    return self.cost_index(self.add(a), self.add(b))
+
+  def sc_index(self, i):
+    return self._sc[i]
+
+  def travel_cost_index(self, i, j):
+    # The cost without the destination's SC part, which is the same in either direction
+    return self.cost_index(i, j) - self._sc[j]
+
+  def route_cost_index(self, indices):
+    return sum(self.cost_index(indices[i], indices[i+1]) for i in range(len(indices)-1))
+
+  def route_cost(self, route):
+    return self.route_cost_index([self.add(s) for s in route])
+
+  def lower_bound(self, dist, sc):
+    # The least any leg of this length could cost, as no route can take fewer jumps than one flown at full range
+    return calc.solve_cost_for_distance(dist, sc, self._jump_range, self._ws_time, slf=1.0)
+
+  def forget(self):
+    # Drops every cost calculated so far, for when the legs they're based on have changed
+    self._rows = [{} for _ in self.stops]
+
+  def _calculate(self, i, j):
+    ax, ay, az = self._positions[i]
+    bx, by, bz = self._positions[j]
+    dist = math.sqrt((ax - bx) * (ax - bx) + (ay - by) * (ay - by) + (az - bz) * (az - bz))
+    jumps = self._leg_cache.get_jump_count(self.stops[i].system, self.stops[j].system) if self._leg_cache is not None else None
+    slf = calc.get_slf(self._positions[i], self._positions[j], self._jump_range, self._slf_table) if jumps is None and self._slf_table is not None and dist > self._jump_range else None
+    return calc.solve_cost_for_distance(dist, self._sc[j], self._jump_range, self._ws_time, jump_count=jumps, slf=slf)
+
+
+# Where each stop appears in the tours, so that checking a route against them needs no searching
+# Stops are cost matrix indices; a route's progress through the tours is kept as a count of the stops visited in each one
+class _TourIndex(object):
+  def __init__(self, tours):
+    self._tours = [list(t) for t in (tours or []) if len(t) >= 2]
+    self._positions = {}
+    for t, tour in enumerate(self._tours):
+      for p, stop in enumerate(tour):
+        positions = self._positions.setdefault(stop, [])
+        # Only the first time a stop is in a tour counts
+        if not any(pt == t for pt, _ in positions):
+          positions.append((t, p))
+
+  def __bool__(self):
+    return len(self._tours) > 0
+  __nonzero__ = __bool__
+
+  def start(self):
+    return [0] * len(self._tours)
+
+  def can_visit(self, progress, stop):
+    # A stop can only be visited once every stop before it in each of its tours has been
+    for t, p in self._positions.get(stop, ()):
+      if progress[t] < p:
+        return False
+    return True
+
+  def visit(self, progress, stop):
+    # Returns the tours which were advanced, so that the visit can be undone
+    advanced = [t for t, p in self._positions.get(stop, ()) if progress[t] == p]
+    for t in advanced:
+      progress[t] += 1
+    return advanced
+
+  def unvisit(self, progress, advanced):
+    for t in advanced:
+      progress[t] -= 1
+
+  def check_route(self, route):
+    progress = self.start()
+    for stop in route:
+      if not self.can_visit(progress, stop):
+        return False
+      self.visit(progress, stop)
+    return True
+
+  def get_predecessor_masks(self, stops):
+    # For each stop, a mask of the stops of which one must already be visited before it (or 0 if it can go anywhere)
+    required = [0] * len(stops)
+    for k, stop in enumerate(stops):
+      for t, p in self._positions.get(stop, ()):
+        if p > 0:
+          prev = self._tours[t][p-1]
+          required[k] |= sum(1 << i for i, s in enumerate(stops) if s == prev)
+    return required
+
+
+def get_tour_key(tours):
+  # The tours which actually constrain a route, in a form that can be compared and stored
+  return tuple(tuple(t) for t in (tours or []) if len(t) > 1)
+
+
+def _get_grid_cell_size(positions):
+  # Roughly the spacing between positions if they were spread evenly over their bounding box
+  lo = [min(p[axis] for p in positions) for axis in range(3)]
+  hi = [max(p[axis] for p in positions) for axis in range(3)]
+  volume = 1.0
+  for axis in range(3):
+    volume *= max(1.0, hi[axis] - lo[axis])
+  return max(1.0, (volume / len(positions)) ** (1.0 / 3.0))
+
+
+# 2-opt moves reverse a section of the route, and Or-opt moves shift a few stops in a row somewhere else
+# Only moves creating a link between near neighbours are tried, and the start and end always stay where they are
+# The route is kept as an order of slots (positions in the original route), so stops which appear more than once are still told apart
+class _LocalSearch(object):
+  def __init__(self, costs, nodes, tour_index):
+    self._costs = costs
+    self._nodes = nodes
+    self._tour_index = tour_index
+    self.order = list(range(len(nodes)))
+    self._pos = list(range(len(nodes)))
+    self.cost = costs.route_cost_index(nodes)
+    self._neighbours = self._get_neighbours()
+
+  def _cost(self, a, b):
+    return self._costs.travel_cost_index(self._nodes[a], self._nodes[b])
+
+  def _get_neighbours(self):
+    count = len(self._nodes)
+    if count <= local_search_neighbours + 1:
+      return [[b for b in range(count) if b != a] for a in range(count)]
+    # Travel costs only go up with distance, so the nearest stops are also the cheapest to get to
+    positions = [self._costs.stops[n].position for n in self._nodes]
+    cell_size = _get_grid_cell_size([(p.x, p.y, p.z) for p in positions])
+    grid = spatial.Grid(range(count), cell_size, key=lambda o: positions[o])
+    result = []
+    for a in range(count):
+      near = []
+      for _, b in grid.iter_nearest(positions[a]):
+        if b != a:
+          near.append(b)
+          if len(near) == local_search_neighbours:
+            break
+      result.append(near)
+    return result
 
+  @property
+  def route(self):
+    return [self._nodes[o] for o in self.order]
+
+  def set_order(self, order, cost):
+    self.order = list(order)
+    for p, o in enumerate(self.order):
+      self._pos[o] = p
+    self.cost = cost
+
+  def _apply(self, order, delta):
+    if self._tour_index and not self._tour_index.check_route([self._nodes[o] for o in order[1:-1]]):
+      return False
+    self.set_order(order, self.cost + delta)
+    return True
 
-  def solve(self, tours, stations, start, end, maxstops, preferred_mode = CLUSTERED):
+  def improve(self, budget, active = None):
+    # Keep trying moves around each slot in the queue, giving the slots next to any change another look
+    queue = collections.deque(active if active is not None else self.order[:-1])
+    queued = set(queue)
+    moves = 0
+    while queue and not budget.exceeded:
+      a = queue.popleft()
+      queued.discard(a)
+      touched = self._try_2opt(a) or self._try_oropt(a)
+      if touched:
+        moves += 1
+        budget.expand()
+        for t in touched:
+          if t not in queued:
+            queue.append(t)
+            queued.add(t)
+    return moves
+
+  def _try_2opt(self, a):
+    # Reversing order[i+1..j] replaces the links (i, i+1) and (j, j+1) with (i, j) and (i+1, j+1)
+    order, pos, cost = self.order, self._pos, self._cost
+    last = len(order) - 1
+    for c in self._neighbours[a]:
+      i, j = min(pos[a], pos[c]), max(pos[a], pos[c])
+      if j - i < 2 or j >= last:
+        continue
+      delta = cost(order[i], order[j]) + cost(order[i+1], order[j+1]) - cost(order[i], order[i+1]) - cost(order[j], order[j+1])
+      if delta < -local_search_epsilon:
+        touched = [order[i], order[i+1], order[j], order[j+1]]
+        if self._apply(order[0:i+1] + list(reversed(order[i+1:j+1])) + order[j+1:], delta):
+          return touched
+    return None
+
+  def _try_oropt(self, a):
+    # Move the run of stops starting at a to next to one of its neighbours, possibly reversing it
+    order, pos, cost = self.order, self._pos, self._cost
+    last = len(order) - 1
+    i = pos[a]
+    if i == 0:
+      return None
+    for length in range(1, local_search_segment_max + 1):
+      if i + length > last:
+        break
+      first, final = order[i], order[i+length-1]
+      prev_o, next_o = order[i-1], order[i+length]
+      removed = cost(prev_o, first) + cost(final, next_o) - cost(prev_o, next_o)
+      for c in set(self._neighbours[first] + self._neighbours[final]):
+        q = pos[c]
+        if i <= q < i + length:
+          continue
+        # The links either side of c once the run has been taken out
+        links = []
+        if q > 0:
+          links.append((order[q-1] if q != i + length else prev_o, c))
+        if q < last:
+          links.append((c, order[q+1] if q != i - 1 else next_o))
+        for x, y in links:
+          if x == prev_o and y == next_o:
+            continue
+          base = cost(x, y) + removed
+          for reverse in (False, True):
+            s0, s1 = (final, first) if reverse else (first, final)
+            delta = cost(x, s0) + cost(s1, y) - base
+            if delta < -local_search_epsilon:
+              segment = order[i:i+length]
+              if reverse:
+                segment.reverse()
+              rest = order[0:i] + order[i+length:]
+              k = pos[x] if pos[x] < i else pos[x] - length
+              if self._apply(rest[0:k+1] + segment + rest[k+1:], delta):
+                return [prev_o, next_o, first, final, x, y]
+    return None
+
+  def can_perturb(self):
+    # A double bridge needs at least three stops between the start and end
+    return len(self.order) >= 5
+
+  def perturb(self, rng):
+    # Swap two sections of the route next to each other (a double bridge), which the other moves can't easily undo
+    if not self.can_perturb():
+      return None
+    order, cost = self.order, self._cost
+    last = len(order) - 1
+    p1 = rng.randint(1, last - 2)
+    p2 = rng.randint(p1 + 1, min(last - 1, p1 + iterated_local_search_kick_span))
+    p3 = rng.randint(p2 + 1, min(last, p2 + iterated_local_search_kick_span))
+    delta = (cost(order[p1-1], order[p2]) + cost(order[p3-1], order[p1]) + cost(order[p2-1], order[p3])
+      - cost(order[p1-1], order[p1]) - cost(order[p2-1], order[p2]) - cost(order[p3-1], order[p3]))
+    touched = [order[p1-1], order[p1], order[p2-1], order[p2], order[p3-1], order[p3]]
+    if self._apply(order[0:p1] + order[p2:p3] + order[p1:p2] + order[p3:], delta):
+      return touched
+    return None
+
+
+class Solver(object):
+  def __init__(self, jump_range, diff_limit, witchspace_time = calc.default_ws_time, local_search_time = local_search_time_limit, processes = 1, leg_cache = None, slf_table = None):
+    self._diff_limit = diff_limit
+    self._jump_range = jump_range
+    self._ws_time = witchspace_time
+    self._local_search_time = local_search_time
+    self._processes = processes
+    # Only routed mode plots legs, but any it has are used by every mode
+    self._leg_cache = leg_cache
+    # How good the last route solved is: optimal, improved on the quick nearest neighbour route, or just that route
+    # Nearest neighbour mode's routes are definitive, as that's the route asked for, but can still be improved by local search
+    self.status = None
+    self._costs = _CostMatrix(jump_range, witchspace_time, leg_cache, slf_table)
+
+
+  def solve(self, tours, stations, start, end, maxstops, preferred_mode = CLUSTERED, budget = None):
+    # If a budget is given, the best route found before it runs out is used; the status attribute says how good it is
     if all(len(t) < 2 for t in tours):
       log.debug("No tours forming valid constraints detected, ignoring them all")
       tours = None
 
     timer = util.start_timer()
 
-    # If the user asked for clustered but the number of destinations is small enough, just use basic
-    if preferred_mode in (CLUSTERED_REPEAT, CLUSTERED) and len(stations) <= max_single_solve_size:
-      preferred_mode = BASIC
+    # Routed mode plots the legs most likely to matter first, then solves as usual with those in place of estimates
+    routed = (preferred_mode == ROUTED)
+    if routed:
+      preferred_mode = HELD_KARP if len(stations) <= held_karp_auto_size else ITERATED_LOCAL_SEARCH
+      plot_budget = util.Budget(routed_plot_time_limit, parent=budget)
+      if self._leg_cache is None:
+        log.warning("No routing available to plot legs with, using estimates instead")
+      else:
+        count = self._plot_legs(self._get_candidate_legs(stations, start, end), plot_budget)
+        log.debug("Plotted {} legs after {}{}", count, util.format_timer(timer), ", using estimates for the rest" if plot_budget.exceeded else "")
+
+    # If the user asked for clustered but the number of destinations is small enough, solve it exactly instead
+    if preferred_mode in (CLUSTERED_REPEAT, CLUSTERED) and len(stations) <= held_karp_auto_size:
+      preferred_mode = HELD_KARP
+    if preferred_mode == HELD_KARP and len(stations) > held_karp_max_size:
+      log.warning("Too many stops ({}) to solve exactly, using clustered mode instead", len(stations))
+      preferred_mode = CLUSTERED
+
+    # Nearest neighbour and iterated local search only look at a few of the pairs of stops, so aren't worth calculating every cost for up front
+    self._costs.add_all([start, end] + list(stations), precompute=(preferred_mode not in (NEAREST_NEIGHBOUR, ITERATED_LOCAL_SEARCH)))
+    log.debug("Cost matrix for {} stops ready after {}", len(self._costs), util.format_timer(timer))
+
+    # A quick route to fall back on if the budget runs out before anything better is found, and to compare the final route to
+    initial = self.solve_nearest_neighbour(tours, stations, start, end, maxstops)
 
     log.debug("Solving set using preferred mode '{}'", preferred_mode)
+    optimal = False
     if preferred_mode == CLUSTERED_REPEAT:
-      result = self.solve_clustered_repeat(tours, stations, start, end, maxstops), False
+      result = self.solve_clustered_repeat(tours, stations, start, end, maxstops, budget=budget), False
     elif preferred_mode == CLUSTERED:
-      result = self.solve_clustered(tours, stations, start, end, maxstops), False
+      result = self.solve_clustered(tours, stations, start, end, maxstops, budget=budget), False
     elif preferred_mode == BASIC:
-      result = self.solve_basic(tours, stations, start, end, maxstops), True
+      result = self.solve_basic(tours, stations, start, end, maxstops, budget=budget), not (budget is not None and budget.exceeded)
     elif preferred_mode == NEAREST_NEIGHBOUR:
-      result = self.solve_nearest_neighbour(tours, stations, start, end, maxstops), True
+      result = initial, True
+    elif preferred_mode == HELD_KARP:
+      result = self.solve_held_karp(tours, stations, start, end, maxstops, budget=budget), True
+      optimal = result[0] is not None
+    elif preferred_mode == ITERATED_LOCAL_SEARCH:
+      result = self.solve_iterated_local_search(tours, stations, start, end, maxstops, budget=budget), False
+    elif preferred_mode == BRANCH_AND_BOUND:
+      route, _, gap = self.solve_branch_and_bound_with_gap(tours, stations, start, end, maxstops, budget=budget)
+      result = route, (gap == 0.0)
+      optimal = (gap == 0.0)
     else:
       log.error("Tried to use invalid preferred mode {}", preferred_mode)
-      result = None
+      result = None, False
+
+    if result[0] is None and initial is not None:
+      if budget is not None and budget.exceeded:
+        log.warning("Ran out of time solving using mode {}, using a quick route instead", preferred_mode)
+      else:
+        log.warning("Could not solve using mode {}, using a quick route instead", preferred_mode)
+      result = initial, False
+
+    if routed and result[0] is not None and self._leg_cache is not None:
+      # Any legs of the route which were only estimated might be worse than thought, so plot them and tidy up around them
+      # The quick route's legs are plotted too, so the two can be compared fairly
+      legs = collections.OrderedDict()
+      for route in (result[0], initial or []):
+        for a, b in zip(route, route[1:]):
+          if self._leg_cache.get_jump_count(a.system, b.system) is None:
+            legs.setdefault(a.system, []).append(b.system)
+      if self._plot_legs(legs, plot_budget) and self._local_search_time:
+        result = self.improve_route(result[0], tours, util.Budget(self._local_search_time, local_search_iteration_limit, parent=budget)), False
+      # Only optimal if every leg it could have used was plotted
+      optimal = optimal and not plot_budget.exceeded
+      result = result[0], result[1] and optimal
+
+    # The exact modes' routes are already as good as they can be, but every other mode's can often be tidied up
+    if result[0] is not None and preferred_mode not in (HELD_KARP, BRANCH_AND_BOUND, ITERATED_LOCAL_SEARCH) and self._local_search_time and not (budget is not None and budget.exceeded):
+      result = self.improve_route(result[0], tours, util.Budget(self._local_search_time, local_search_iteration_limit, parent=budget)), result[1]
+
+    if optimal:
+      self.status = STATUS_OPTIMAL
+    elif result[0] is not None and initial is not None:
+      cost = self._costs.route_cost(result[0])
+      initial_cost = self._costs.route_cost(initial)
+      if cost < initial_cost - local_search_epsilon:
+        self.status = STATUS_IMPROVED
+      else:
+        # Never do worse than the quick route
+        self.status = STATUS_INITIAL
+        result = initial, False
+    else:
+      self.status = None if result[0] is None else STATUS_INITIAL
 
-    log.debug("Solve from {} to {} using mode {} finished after {}", start, end, preferred_mode, util.format_timer(timer))
+    log.debug("Solve from {} to {} using mode {} finished after {} with status {}", start, end, preferred_mode, util.format_timer(timer), self.status)
     return result
 
-  def solve_basic(self, tours, stations, start, end, maxstops):
-    result, _ = self.solve_basic_with_cost(tours, stations, start, end, maxstops)
+  def solve_incremental(self, previous, tours, stations, start, end, maxstops, preferred_mode = CLUSTERED, budget = None, previous_tours = None, previous_status = None, previous_definitive = False):
+    # Updates a previous route to match a new set of stations, by taking out stops which have gone and inserting new ones where they
+    # add the least cost, then tidying up with local search; falls back to a full solve when that can't be done or too much has changed
+    # If neither the stops nor the tours have changed and the previous route's tours and status are given, it's returned as it was
+    if previous is None or len(previous) < 2 or previous[0] != start or previous[-1] != end or maxstops < len(stations) + 2:
+      return self.solve(tours, stations, start, end, maxstops, preferred_mode, budget)
+    removed = collections.Counter(previous[1:-1])
+    removed.subtract(stations)
+    added = collections.Counter(stations)
+    added.subtract(previous[1:-1])
+    changes = sum(c for c in removed.values() if c > 0) + sum(c for c in added.values() if c > 0)
+    if changes > max(1, int(len(stations) * incremental_change_fraction)):
+      log.debug("Too many stops changed ({}) to update the previous route, solving from scratch", changes)
+      return self.solve(tours, stations, start, end, maxstops, preferred_mode, budget)
+
+    if preferred_mode == ROUTED and self._leg_cache is not None:
+      # Only the legs to and from new stops will need plotting
+      self._plot_legs(self._get_candidate_legs(stations, start, end), util.Budget(routed_plot_time_limit, parent=budget))
+    tour_index = self._get_tour_index(tours)
+    route = [start]
+    for stop in previous[1:-1]:
+      if removed[stop] > 0:
+        removed[stop] -= 1
+      else:
+        route.append(stop)
+    route.append(end)
+    nodes = self._costs.add_all(route)
+    for stop, count in added.items():
+      idx = self._costs.add(stop)
+      for _ in range(count):
+        best = None
+        best_delta = None
+        for p in range(1, len(nodes)):
+          delta = self._costs.cost_index(nodes[p-1], idx) + self._costs.cost_index(idx, nodes[p]) - self._costs.cost_index(nodes[p-1], nodes[p])
+          if (best_delta is None or delta < best_delta) and (not tour_index or tour_index.check_route(nodes[1:p] + [idx] + nodes[p:-1])):
+            best = p
+            best_delta = delta
+        if best is None:
+          log.debug("Could not fit {} into the previous route, solving from scratch", stop)
+          return self.solve(tours, stations, start, end, maxstops, preferred_mode, budget)
+        nodes.insert(best, idx)
+        route.insert(best, stop)
+    if tour_index and not tour_index.check_route(nodes[1:-1]):
+      log.debug("Previous route no longer keeps to the tours, solving from scratch")
+      return self.solve(tours, stations, start, end, maxstops, preferred_mode, budget)
+    if changes == 0 and previous_status is not None and previous_tours is not None and get_tour_key(previous_tours) == get_tour_key(tours):
+      self.status = previous_status
+      log.debug("No stops or tours changed, keeping the previous route with status {}", self.status)
+      return route, previous_definitive
+
+    if self._local_search_time and not (budget is not None and budget.exceeded):
+      route = self.improve_route(route, tours, util.Budget(self._local_search_time, local_search_iteration_limit, parent=budget))
+    # As with a full solve, never do worse than the quick route
+    initial = self.solve_nearest_neighbour(tours, stations, start, end, maxstops)
+    if initial is not None and self._costs.route_cost(initial) < self._costs.route_cost(route) - local_search_epsilon:
+      self.status = STATUS_INITIAL
+      route = initial
+    else:
+      self.status = STATUS_IMPROVED
+    log.debug("Updated previous route for {} changed stops, with status {}", changes, self.status)
+    return route, False
+
+  def solve_basic(self, tours, stations, start, end, maxstops, budget = None):
+    result, _ = self.solve_basic_with_cost(tours, stations, start, end, maxstops, budget)
     return result
 
 
-  def solve_basic_with_cost(self, tours, stations, start, end, maxstops):
+  def solve_basic_with_cost(self, tours, stations, start, end, maxstops, budget = None):
     if not any(stations):
       if start == end:
         return [start], 0.0
       else:
-        return [start, end], calc.solve_cost(start, end, self._jump_range, witchspace_time=self._ws_time)
+        return [start, end], self._costs.cost(start, end)
 
     count = 0
     mincost = None
@@ -111,11 +596,14 @@ class Solver(object):
     vr = self._get_viable_routes([start], tours, stations, end, maxstops)
 
     for route in vr:
+      if budget is not None and budget.expand():
+        log.debug("Ran out of time checking viable routes")
+        break
       count += 1
-      cost_normal = calc.solve_route_cost(route, self._jump_range, witchspace_time=self._ws_time)
+      cost_normal = self._costs.route_cost(route)
       if reversible:
         route_reversed = [route[0]] + list(reversed(route[1:-1])) + [route[-1]]
-        cost_reversed = calc.solve_route_cost(route_reversed, self._jump_range, witchspace_time=self._ws_time)
+        cost_reversed = self._costs.route_cost(route_reversed)
 
         cost = cost_normal if (cost_normal <= cost_reversed) else cost_reversed
         route = route if (cost_normal <= cost_reversed) else route_reversed
@@ -136,37 +624,372 @@ class Solver(object):
     return result
 
   def solve_nearest_neighbour_with_cost(self, tours, stations, start, end, maxstops):
+    # Stops are looked at nearest first using a grid, only until the rest are too far away to be any cheaper
+    if not any(stations):
+      return [start, end], self._costs.cost(start, end)
+    idx = self._costs.add_all(stations)
+    min_sc = min(self._costs.sc_index(i) for i in idx)
+    positions = [(s.position.x, s.position.y, s.position.z) for s in [start] + list(stations)]
+    grid = spatial.Grid(range(len(stations)), _get_grid_cell_size(positions), key=lambda o: stations[o].position)
+    tour_index = self._get_tour_index(tours)
+    progress = tour_index.start()
     route = [start]
-    full_cost = 0
-    remaining = stations
-    while any(remaining) and len(route)+1 < maxstops:
-      cur_cost = sys.maxsize
+    full_cost = 0.0
+    cur_idx = self._costs.add(start)
+    while len(grid) and len(route) + 1 < maxstops:
+      cur_cost = None
       cur_stop = None
-      for s in remaining:
-        if tours and not self._check_tour_route(route[1:], tours, s):
+      for dist, o in grid.iter_nearest(route[-1].position):
+        if cur_cost is not None and self._costs.lower_bound(dist, min_sc) >= cur_cost:
+          break
+        if tour_index and not tour_index.can_visit(progress, idx[o]):
           continue
-        cost = calc.solve_cost(route[-1], s, self._jump_range, witchspace_time=self._ws_time)
-        if cost < cur_cost:
-          cur_stop = s
+        cost = self._costs.cost_index(cur_idx, idx[o])
+        if cur_cost is None or cost < cur_cost:
+          cur_stop = o
           cur_cost = cost
-      if cur_stop is not None:
-        route.append(cur_stop)
-        remaining.remove(cur_stop)
-        full_cost += cur_cost
-        log.debug("Added system to current NN route: {}, new len {}, new cost {}", cur_stop, len(route), full_cost)
+      if cur_stop is None:
+        log.error("No route satisfies the tour constraints")
+        return None, None
+      grid.remove(cur_stop)
+      tour_index.visit(progress, idx[cur_stop])
+      route.append(stations[cur_stop])
+      cur_idx = idx[cur_stop]
+      full_cost += cur_cost
+      log.debug("Added system to current NN route: {}, new len {}, new cost {}", stations[cur_stop], len(route), full_cost)
     route.append(end)
-    return route, cur_cost
+    return route, full_cost + self._costs.cost_index(cur_idx, self._costs.add(end))
 
 
-  def solve_clustered(self, tours, stations, start, end, maxstops):
-    result, _ = self.solve_clustered_with_cost(tours, stations, start, end, maxstops)
+  def solve_held_karp(self, tours, stations, start, end, maxstops, budget = None):
+    result, _ = self.solve_held_karp_with_cost(tours, stations, start, end, maxstops, budget)
     return result
 
-  def solve_clustered_with_cost(self, tours, stations, start, end, maxstops):
+  def solve_held_karp_with_cost(self, tours, stations, start, end, maxstops, budget = None):
+    # There's no usable route until the very end, so if the budget runs out this gives up and returns nothing
+    # Dynamic programming over (set of stops visited, last stop), which finds the optimal route exactly
+    n = len(stations)
+    stops = min(n, maxstops - 2)
+    if n == 0 or stops <= 0:
+      return self.solve_basic_with_cost(tours, [], start, end, maxstops)
+
+    idx = self._costs.add_all(stations)
+    idx_start = self._costs.add(start)
+    idx_end = self._costs.add(end)
+    costs = [[self._costs.cost_index(a, b) for b in idx] for a in idx]
+    from_start = [self._costs.cost_index(idx_start, b) for b in idx]
+    to_end = [self._costs.cost_index(a, idx_end) for a in idx]
+    required = self._get_tour_index(tours).get_predecessor_masks(idx)
+
+    # Flattened tables indexed by (visited mask * n + last stop)
+    full = 1 << n
+    inf = float('inf')
+    best_cost = array.array('d', [inf]) * (full * n)
+    parent = array.array('b', [-1]) * (full * n)
+    for k in range(n):
+      if not required[k]:
+        best_cost[(1 << k) * n + k] = from_start[k]
+
+    result_cost = inf
+    result_state = None
+    for mask in range(1, full):
+      if budget is not None and (mask & 0x3ff) == 1 and budget.exceeded:
+        log.debug("Ran out of time solving exactly")
+        return None, None
+      base = mask * n
+      complete = (bin(mask).count('1') == stops)
+      unvisited = (full - 1) & ~mask
+      for j in range(n):
+        cost = best_cost[base + j]
+        if cost == inf:
+          continue
+        if complete:
+          if cost + to_end[j] < result_cost:
+            result_cost = cost + to_end[j]
+            result_state = (mask, j)
+          continue
+        row = costs[j]
+        remaining = unvisited
+        while remaining:
+          bit = remaining & -remaining
+          remaining ^= bit
+          k = bit.bit_length() - 1
+          # Check that adding this stop would not break any tour constraints
+          if required[k] and not (mask & required[k]):
+            continue
+          pos = (mask | bit) * n + k
+          if cost + row[k] < best_cost[pos]:
+            best_cost[pos] = cost + row[k]
+            parent[pos] = j
+
+    if result_state is None:
+      log.error("No route satisfies the tour constraints")
+      return None, None
+    route = []
+    mask, j = result_state
+    while j != -1:
+      route.append(stations[j])
+      mask, j = mask ^ (1 << j), parent[mask * n + j]
+    return [start] + list(reversed(route)) + [end], result_cost
+
+  def solve_branch_and_bound(self, tours, stations, start, end, maxstops, budget = None):
+    result, _, _ = self.solve_branch_and_bound_with_gap(tours, stations, start, end, maxstops, budget)
+    return result
+
+  def solve_branch_and_bound_with_gap(self, tours, stations, start, end, maxstops, budget = None):
+    # Best-first search over the same (set of stops visited, last stop) states as Held-Karp, but only keeping the ones which might
+    # still beat the best route found so far. Returns the route, its cost and how much better than it the optimal route could be
+    # (0.0 if it is optimal), as a fraction of its cost
+    n = len(stations)
+    stops = min(n, maxstops - 2)
+    if n == 0 or stops <= 0:
+      route, cost = self.solve_basic_with_cost(tours, [], start, end, maxstops)
+      return route, cost, 0.0
+    budget = budget if budget is not None else util.Budget(branch_and_bound_time_limit)
+
+    idx = self._costs.add_all(stations)
+    idx_start = self._costs.add(start)
+    idx_end = self._costs.add(end)
+    # Positions 0..n-1 are the stations, n is the start and n+1 the end
+    nodes = idx + [idx_start, idx_end]
+    costs = [[self._costs.cost_index(a, b) for b in nodes] for a in nodes]
+    travel = [[self._costs.travel_cost_index(a, b) for b in nodes] for a in nodes]
+    sc = [costs[n][k] - travel[n][k] for k in range(n + 2)]
+    required = self._get_tour_index(tours).get_predecessor_masks(idx)
+    # The cheapest way into each stop from anywhere, for the bound when only some of the stops are visited
+    cheapest_in = [min(costs[a][k] for a in range(n + 1) if a != k) for k in range(n)]
+
+    mst_cache = {}
+    def get_mst_cost(remaining):
+      # Prim's algorithm over the travel costs between the remaining stops
+      if remaining not in mst_cache:
+        members = [k for k in range(n) if remaining & (1 << k)]
+        total = 0.0
+        if members:
+          best = dict((k, travel[members[0]][k]) for k in members[1:])
+          while best:
+            k = min(best, key=best.get)
+            total += best.pop(k)
+            row = travel[k]
+            for j in best:
+              if row[j] < best[j]:
+                best[j] = row[j]
+        mst_cache[remaining] = total
+      return mst_cache[remaining]
+
+    def get_bound(last, mask, count):
+      # A lower bound on the cost of getting from the last stop to the end via enough of the unvisited stops
+      remaining = (full - 1) & ~mask
+      needed = stops - count
+      if needed == 0:
+        return costs[last][n+1]
+      members = [k for k in range(n) if remaining & (1 << k)]
+      # Every stop still to be visited, and the end, has to be got to from somewhere
+      in_bound = sum(sorted(cheapest_in[k] for k in members)[0:needed]) + min(costs[k][n+1] for k in members)
+      if needed < len(members):
+        return in_bound
+      # If every remaining stop must be visited, the rest of the route is a path through all of them: at least as long as a
+      # spanning tree of them plus the cheapest links from the last stop and to the end
+      tree_bound = get_mst_cost(remaining) + min(travel[last][k] for k in members) + min(travel[k][n+1] for k in members) + sum(sc[k] for k in members) + sc[n+1]
+      return max(in_bound, tree_bound)
+
+    full = 1 << n
+    # Start from a quick route, so that there's something to prune with from the beginning
+    best_route = None
+    best_cost = float('inf')
+    initial = self.solve_nearest_neighbour(tours, stations, start, end, maxstops)
+    if initial is not None and len(initial) == stops + 2:
+      initial, initial_cost = self.improve_route_with_cost(initial, tours, util.Budget(local_search_time_limit, local_search_iteration_limit, parent=budget))
+      if self._get_tour_index(tours).check_route(self._costs.add_all(initial[1:-1])):
+        for i in self._costs.add_all(initial[1:-1]):
+          best_route = (nodes.index(i), best_route)
+        best_cost = initial_cost
+
+    # Bounds are slow to work out for lots of stops, so keep one for the whole problem in case the time runs out early
+    root_bound = get_bound(n, 0, 0)
+    # Each entry is (lower bound, -stops visited, tiebreak, cost so far, last stop, visited mask, path as nested tuples)
+    best_g = {}
+    frontier = []
+    counter = 0
+    seeded = True
+    for k in range(n):
+      if budget.exceeded:
+        seeded = False
+        break
+      if not required[k]:
+        g = costs[n][k]
+        f = g + get_bound(k, 1 << k, 1)
+        if f < best_cost:
+          best_g[(1 << k, k)] = g
+          heapq.heappush(frontier, (f, -1, counter, g, k, 1 << k, (k, None)))
+          counter += 1
+
+    expanded = 0
+    while frontier and seeded:
+      f, neg_count, _, g, last, mask, path = frontier[0]
+      if f >= best_cost - local_search_epsilon:
+        # Nothing left can beat the best route, so it's optimal
+        frontier = []
+        break
+      if budget.expand():
+        break
+      entry = heapq.heappop(frontier)
+      if g > best_g.get((mask, last), g):
+        continue
+      expanded += 1
+      count = -neg_count
+      row = costs[last]
+      for k in range(n):
+        bit = 1 << k
+        if mask & bit or (required[k] and not (mask & required[k])):
+          continue
+        g2 = g + row[k]
+        mask2 = mask | bit
+        if count + 1 == stops:
+          # Route complete, so go straight to the end
+          total = g2 + costs[k][n+1]
+          if total < best_cost:
+            best_cost = total
+            best_route = (k, path)
+          continue
+        if g2 >= best_g.get((mask2, k), float('inf')):
+          continue
+        if n > held_karp_max_size and budget.exceeded:
+          # With this many stops working out bounds is slow enough to check the time for each one
+          # Put this state back, as its bound still covers the stops it didn't get round to
+          heapq.heappush(frontier, entry)
+          break
+        f2 = g2 + get_bound(k, mask2, count + 1)
+        if f2 >= best_cost:
+          continue
+        best_g[(mask2, k)] = g2
+        heapq.heappush(frontier, (f2, -(count + 1), counter, g2, k, mask2, (k, path)))
+        counter += 1
+
+    if best_route is None:
+      log.error("No route satisfies the tour constraints")
+      return None, None, None
+    order = []
+    while best_route is not None:
+      order.append(best_route[0])
+      best_route = best_route[1]
+    if not seeded:
+      lower = min(best_cost, root_bound)
+    else:
+      lower = min(best_cost, max(root_bound, frontier[0][0])) if frontier else best_cost
+    gap = (best_cost - lower) / best_cost if best_cost > 0.0 else 0.0
+    if gap > 0.0:
+      log.info("Stopped searching for the best route after {} steps; the route found is at most {:.1f}% worse than the best possible", expanded, gap * 100.0)
+    else:
+      log.debug("Found the best route after {} steps", expanded)
+    return [start] + [stations[k] for k in reversed(order)] + [end], best_cost, gap
+
+  def _get_candidate_legs(self, stations, start, end):
+    # The legs a good route is likely to use, as a dict of system --> systems: between each system and the few nearest to it, or every leg for a few systems
+    systems = list(collections.OrderedDict.fromkeys(s.system for s in [start] + list(stations) + [end]))
+    if len(systems) <= held_karp_auto_size + 2:
+      return collections.OrderedDict((a, [b for b in systems if b != a]) for a in systems)
+    grid = spatial.Grid(systems, _get_grid_cell_size([(s.position.x, s.position.y, s.position.z) for s in systems]))
+    legs = collections.OrderedDict()
+    for a in systems:
+      legs[a] = []
+      for _, b in grid.iter_nearest(a.position):
+        if b != a:
+          legs[a].append(b)
+          if len(legs[a]) == local_search_neighbours:
+            break
+    return legs
+
+  def _plot_legs(self, legs, budget):
+    # Plots legs (a dict of system --> systems) from each system to all of its others at once, until the budget runs out
+    count = 0
+    for sys_from, targets in legs.items():
+      if budget.exceeded:
+        break
+      count += self._leg_cache.plot(sys_from, targets, budget)
+    if count:
+      # Some costs will have been estimated using legs we now know better
+      self._costs.forget()
+    return count
+
+  def _get_tour_index(self, tours):
+    return _TourIndex([self._costs.add_all(t) for t in tours] if tours else None)
+
+  def improve_route(self, route, tours = None, budget = None):
+    result, _ = self.improve_route_with_cost(route, tours, budget)
+    return result
+
+  def improve_route_with_cost(self, route, tours = None, budget = None):
+    budget = budget if budget is not None else util.Budget(local_search_time_limit, local_search_iteration_limit)
+    nodes = self._costs.add_all(route)
+    if len(nodes) < 4:
+      return route, self._costs.route_cost_index(nodes)
+    search = _LocalSearch(self._costs, nodes, self._get_tour_index(tours))
+    moves = search.improve(budget)
+    log.debug("Local search made {} improvements to the route", moves)
+    return [route[o] for o in search.order], self._costs.route_cost_index(search.route)
+
+  def solve_iterated_local_search(self, tours, stations, start, end, maxstops, budget = None, callback = None):
+    result, _ = self.solve_iterated_local_search_with_cost(tours, stations, start, end, maxstops, budget, callback)
+    return result
+
+  def solve_iterated_local_search_with_cost(self, tours, stations, start, end, maxstops, budget = None, callback = None):
+    # Tidy up a quick route with local search, then keep shaking it up and tidying it again until the time runs out
+    # or it stops finding anything better
+    # Only improvements are kept; if given, callback(route, cost) is called with each one as it's found
+    budget = budget if budget is not None else util.Budget(iterated_local_search_time_limit)
+    tour_index = self._get_tour_index(tours)
+    route = self.solve_nearest_neighbour(tours, stations, start, end, maxstops)
+    if route is None:
+      return None, None
+    nodes = self._costs.add_all(route)
+    if len(nodes) < 4:
+      return route, self._costs.route_cost_index(nodes)
+
+    search = _LocalSearch(self._costs, nodes, tour_index)
+    search.improve(budget)
+    best_order = list(search.order)
+    best_cost = search.cost
+    if callback is not None:
+      callback([route[o] for o in best_order], best_cost)
+    rng = random.Random(len(nodes))
+    kicks = 0
+    unimproved = 0
+    failed = 0
+    while search.can_perturb() and not budget.exceeded:
+      if unimproved >= iterated_local_search_patience or failed >= iterated_local_search_failed_kick_limit:
+        break
+      touched = search.perturb(rng)
+      budget.expand()
+      if touched is None:
+        failed += 1
+        continue
+      failed = 0
+      kicks += 1
+      search.improve(budget, touched)
+      if search.cost < best_cost - local_search_epsilon:
+        best_order = list(search.order)
+        best_cost = search.cost
+        unimproved = 0
+        log.debug("Iterated local search found route with cost {} after {} shake-ups", best_cost, kicks)
+        if callback is not None:
+          callback([route[o] for o in best_order], best_cost)
+      else:
+        unimproved += 1
+        search.set_order(best_order, best_cost)
+    log.debug("Iterated local search finished after {} shake-ups", kicks)
+    best_route = [route[o] for o in best_order]
+    return best_route, self._costs.route_cost_index(self._costs.add_all(best_route))
+
+  def solve_clustered(self, tours, stations, start, end, maxstops, budget = None):
+    result, _ = self.solve_clustered_with_cost(tours, stations, start, end, maxstops, budget=budget)
+    return result
+
+  def solve_clustered_with_cost(self, tours, stations, start, end, maxstops, rng = None, budget = None):
     cluster_count = int(math.ceil(float(len(stations) + 2) / cluster_divisor))
     log.debug("Splitting problem into {0} clusters...", cluster_count)
-    clusters = find_centers(stations, cluster_count)
-    clusters = self._resolve_cluster_sizes(clusters)
+    clusters = find_centers(stations, cluster_count, rng)
+    clusters = self._resolve_cluster_sizes(clusters, rng)
 
     sclusters = self._get_best_supercluster_route(clusters, start, end)
 
@@ -188,44 +1011,81 @@ class Solver(object):
       cur_maxstops = min(len(from_cluster.systems), int(round(float(maxstops) * len(from_cluster.systems) / len(stations))))
       r_maxstops -= cur_maxstops
       # Solve and add to the route. DO NOT allow nested clustering, that makes it all go wrong :)
-      newroute, newcost = self.solve_basic_with_cost(tours, [c for c in from_cluster.systems if c not in [from_start, from_end]], from_start, from_end, cur_maxstops)
+      newroute, newcost = self.solve_basic_with_cost(tours, [c for c in from_cluster.systems if c not in [from_start, from_end]], from_start, from_end, cur_maxstops, budget)
+      if newroute is None or (budget is not None and budget.exceeded):
+        return None, None
       route += newroute
       cost += newcost
       from_start = to_start
-    newroute, newcost = self.solve_basic_with_cost(tours, [c for c in sclusters[-1].systems if c not in [from_start, to_end]], from_start, to_end, r_maxstops)
+    newroute, newcost = self.solve_basic_with_cost(tours, [c for c in sclusters[-1].systems if c not in [from_start, to_end]], from_start, to_end, r_maxstops, budget)
+    if newroute is None or (budget is not None and budget.exceeded):
+      return None, None
     route += newroute
     cost += newcost
     route += [end]
     return route, cost
 
 
-  def solve_clustered_repeat(self, tours, stations, start, end, maxstops, iterations = cluster_repeat_limit):
-    result, _ = self.solve_clustered_repeat_with_cost(tours, stations, start, end, maxstops, iterations)
+  def solve_clustered_repeat(self, tours, stations, start, end, maxstops, iterations = cluster_repeat_limit, patience = cluster_repeat_patience, seed = None, budget = None):
+    result, _ = self.solve_clustered_repeat_with_cost(tours, stations, start, end, maxstops, iterations, patience, seed, budget)
     return result
 
-  def solve_clustered_repeat_with_cost(self, tours, stations, start, end, maxstops, iterations = cluster_repeat_limit):
+  def solve_clustered_repeat_with_cost(self, tours, stations, start, end, maxstops, iterations = cluster_repeat_limit, patience = cluster_repeat_patience, seed = None, budget = None):
+    # Each solve gets its own seed, and results are always looked at in order, so the answer doesn't depend on how many processes are used
+    seed = seed if seed is not None else random.getrandbits(32)
+    seeds = [seed + i for i in range(iterations)]
+    args = (tours, stations, start, end, maxstops)
+    pool = None
+    if self._processes != 1 and iterations > 1:
+      # Make sure every stop has an index before the workers get their copies of the cost matrix
+      self._costs.add_all([start, end] + list(stations))
+      pool = multiprocessing.Pool(self._processes or None, initializer=_init_repeat_worker, initargs=(self, args))
+      # Workers send back indices into the cost matrix, so that the route is made up of our own copies of the stops
+      results = (([self._costs.stops[i] for i in route], cost) for route, cost in pool.imap(_solve_clustered_seeded, seeds))
+    else:
+      results = (self.solve_clustered_with_cost(*args, rng=random.Random(s), budget=budget) for s in seeds)
+
     minroute = None
     mincost = sys.float_info.max
-    for _ in range(0, iterations):
-      route, cost = self.solve_clustered_with_cost(tours, stations, start, end, maxstops)
-      if cost < mincost:
-        mincost = cost
-        minroute = route
-    return minroute, mincost
-
-
-  def _resolve_cluster_sizes(self, pclusters):
+    count = 0
+    since_improved = 0
+    try:
+      for route, _ in results:
+        # Worker processes don't know about the budget, so just stop waiting for them once it runs out
+        if route is None or (budget is not None and budget.exceeded):
+          break
+        count += 1
+        # The cost given by each clustered solve leaves out the links between clusters, so compare whole routes instead
+        cost = self._costs.route_cost(route)
+        if cost < mincost:
+          mincost = cost
+          minroute = route
+          since_improved = 0
+        else:
+          since_improved += 1
+          if patience and since_improved >= patience:
+            break
+    finally:
+      if pool is not None:
+        # Any solves still running are no longer needed
+        pool.terminate()
+        pool.join()
+    log.debug("Best of {} clustered solves has cost {}", count, mincost)
+    return minroute, (mincost if minroute is not None else None)
+
+
+  def _resolve_cluster_sizes(self, pclusters, rng = None):
     clusters = list(pclusters)
     iterations = 0
     while iterations < cluster_iteration_limit:
       iterations += 1
       for i,c in enumerate(clusters):
         if c.is_supercluster:
-          c.systems = self._resolve_cluster_sizes(c.systems)
+          c.systems = self._resolve_cluster_sizes(c.systems, rng)
         if len(c.systems) > cluster_size_max:
           log.debug("Splitting oversized cluster {} into two", c)
           del clusters[i]
-          newclusters = find_centers(c.systems, 2)
+          newclusters = find_centers(c.systems, 2, rng)
           clusters += newclusters
           break
       lengths = [len(c.systems) for c in clusters]
@@ -237,7 +1097,7 @@ class Solver(object):
           # Too many clusters, consolidate
           subdiv = int(math.ceil(float(len(clusters)) / supercluster_size_max))
           log.debug("Consolidating from {} to {} superclusters", len(clusters), subdiv)
-          clusters = find_centers(clusters, subdiv)
+          clusters = find_centers(clusters, subdiv, rng)
           lengths = [len(c.systems) for c in clusters]
           # If everything is now valid...
           if min(lengths) >= cluster_size_min and max(lengths) <= cluster_size_max and len(clusters) <= supercluster_size_max:
@@ -247,41 +1107,21 @@ class Solver(object):
     return clusters
 
 
-  def _check_tour_route(self, route, tours, station):
-    if not tours:
-      return True
-    for tour in tours:
-      # Tour must have at least two elements to form a valid constraint.
-      if len(tour) < 2:
-        continue
-      try:
-        index = tour.index(station)
-      except ValueError:
-        # This station is not part of the tour.
-        continue
-      if len(route) <= index:
-        # The station is the nth in the tour but there are at most n
-        # elements in the route already, so the station can only be
-        # valid if it's the first in the route.
-        if len(route) or index:
-          # Optimisation: The station would be rejected anyway after
-          # building the list of tour elements already in the route,
-          # but rejecting it here saves building that list, which is
-          # done more often and takes longer as the number of total
-          # stations grows.
-          return False
-      indices = []
-      for t in tour:
-        try:
-          indices.append(route.index(t))
-        except ValueError:
-          pass
-      if index > len(indices):
-        # The station would be inserted out of sequence.
-        return False
-    return True
-
   def _get_viable_routes(self, route, tours, stations, end, maxstops):
+    # Work with indices into the cost matrix rather than the stops themselves, as this is by far the hottest part of solving
+    idx_route = self._costs.add_all(route)
+    idx_stations = self._costs.add_all(stations)
+    stn_counts = {}
+    for i in idx_stations:
+      stn_counts[i] = stn_counts.get(i, 0) + 1
+    tour_index = self._get_tour_index(tours)
+    progress = tour_index.start()
+    for i in idx_route[1:]:
+      tour_index.visit(progress, i)
+    for r in self._get_viable_routes_index(idx_route, tour_index, progress, idx_stations, stn_counts, self._costs.add(end), maxstops):
+      yield [self._costs.stops[i] for i in r]
+
+  def _get_viable_routes_index(self, route, tour_index, progress, stations, stn_counts, end, maxstops):
     # If we have more non-end stops to go...
     if len(route) + 1 < maxstops:
       nexts = {}
@@ -291,16 +1131,15 @@ class Solver(object):
         if stn in route or stn == end:
           # If stn is in the route at least the number of times it's in the original list, ignore it
           # Add 1 to the count if the start station is *also* the same, since this appears in route but not in stations
-          route_matches = len([rs for rs in route if rs == stn])
-          stn_matches = len([rs for rs in stations if rs == stn]) + (1 if stn == route[0] else 0)
+          route_matches = route.count(stn)
+          stn_matches = stn_counts[stn] + (1 if stn == route[0] else 0)
           if route_matches >= stn_matches:
             continue
         # Check that adding this station would not break any tour constraints.
-        if tours and not self._check_tour_route(route[1:], tours, stn):
+        if tour_index and not tour_index.can_visit(progress, stn):
           continue
 
-        dist = calc.solve_cost(route[-1], stn, self._jump_range, witchspace_time=self._ws_time)
-        nexts[stn] = dist
+        nexts[stn] = self._costs.cost_index(route[-1], stn)
 
       if len(nexts):
         mindist = min(nexts.values())
@@ -308,8 +1147,10 @@ class Solver(object):
         for stn, dist in nexts.items():
           if dist <= (mindist * self._diff_limit):
             # For each valid next stop, run
-            for r in self._get_viable_routes(route + [stn], tours, stations, end, maxstops):
+            advanced = tour_index.visit(progress, stn)
+            for r in self._get_viable_routes_index(route + [stn], tour_index, progress, stations, stn_counts, end, maxstops):
               yield r
+            tour_index.unvisit(progress, advanced)
 
     # We're at the end
     else:
@@ -320,94 +1161,241 @@ class Solver(object):
   def _get_best_supercluster_route(self, clusters, start, end):
     if len(clusters) == 1:
       return list(clusters)
-    first = min(clusters, key=lambda t: t.get_closest(start)[1])
-    last = min([c for c in clusters if c != first], key=lambda t: t.get_closest(end)[1])
-    log.debug("Calculating supercluster route from {} --> {}", first, last)
+    log.debug("Calculating supercluster route from {} --> {}", start, end)
     log.debug("Clusters: {}", clusters)
-    if len(clusters) > 3:
-      log.debug("Calculating cluster route for {}", clusters)
-      inter, _ = self._get_best_cluster_route([c for c in clusters if c not in [first, last]], first, last)
-    else:
-      inter = [c for c in clusters if c not in [first, last]]
-    proute = [first] + inter + [last]
+    proute, _ = self._get_best_cluster_route(clusters, start, end)
     route = []
     for i,c in enumerate(proute):
       if isinstance(c, _Cluster) and c.is_supercluster:
         log.debug("Going deeper... i={}, c={}", i, c)
-        route += self._get_best_supercluster_route(c.systems, start if i == 0 else route[i-1], end if i >= len(route)-1 else route[i+1])
+        # Order the clusters inside it to get from wherever the route has got to, towards the next cluster after it
+        route += self._get_best_supercluster_route(c.systems, route[-1] if route else start, proute[i+1] if i+1 < len(proute) else end)
       else:
         route.append(c)
     return route
 
 
-  def _get_best_cluster_route(self, clusters, start, end, route = []):
-    best = None
-    bestcost = sys.float_info.max
-    if not route:
-      log.debug("In get_best_cluster_route, input = {}, start = {}, end = {}", clusters, start, end)
-    if len(route) < len(clusters):
-      startpt = route[-1].position if any(route) else start.position
-      sclusters = sorted([c for c in clusters if c not in route], key=lambda t: (startpt - t.position).length)
-      # print("route:", route, "smeans:", smeans)
-      for i in range(0, min(len(sclusters), cluster_route_search_limit)):
-        c_route, c_cost = self._get_best_cluster_route(clusters, start, end, route + [sclusters[i]])
-        if c_cost < bestcost:
-          best = c_route
-          bestcost = c_cost
+  def _get_best_cluster_route(self, clusters, start, end):
+    # The shortest order to visit clusters in from start to end, going by their centers; the start and end links go to each cluster's closest system
+    # Index 0 is the start, 1..N the clusters and N+1 the end
+    count = len(clusters)
+    dist = [[0.0] * (count + 2) for _ in range(count + 2)]
+    for i, c in enumerate(clusters, 1):
+      dist[0][i] = dist[i][0] = c.get_closest(start)[1]
+      dist[i][count+1] = dist[count+1][i] = c.get_closest(end)[1]
+      for j in range(1, i):
+        dist[i][j] = dist[j][i] = (c.position - clusters[j-1].position).length
+    if count <= cluster_route_exact_max:
+      order = _get_shortest_path_exact(dist)
     else:
-      cur_cost = (start.position - route[0].position).length
-      for i in range(1, len(route)):
-        cur_cost += (route[i-1].position - route[i].position).length
-      cur_cost += (route[-1].position - end.position).length
-      best = route
-      bestcost = cur_cost
-    return (best, bestcost)
+      order = _get_shortest_path_local(dist)
+    return [clusters[i-1] for i in order], _get_path_length(dist, order)
 
 
-  def _get_closest_points(self, cluster1, cluster2, disallowed = []):
+  def _get_closest_points(self, cluster1, cluster2, disallowed = None):
+    # If a cluster only has one system, start == end so allow it
+    disallowed = disallowed if disallowed is not None else []
+    froms = [n for n in cluster1 if len(cluster1) == 1 or n not in disallowed]
+    tos = [n for n in cluster2 if len(cluster2) == 1 or n not in disallowed]
+    from_idx = self._costs.add_all(froms)
+    to_idx = self._costs.add_all(tos)
     best = None
     bestcost = None
-    for n1 in cluster1:
-      if n1 in disallowed and len(cluster1) > 1: # If len(cluster) is 1, start == end so allow it
-        continue
-      for n2 in cluster2:
-        if n2 in disallowed and len(cluster2) > 1: # If len(cluster) is 1, start == end so allow it
-          continue
-        cost = calc.solve_cost(n1, n2, self._jump_range, witchspace_time=self._ws_time)
+    if len(froms) * len(tos) < closest_points_grid_min:
+      for n1, i in zip(froms, from_idx):
+        for n2, j in zip(tos, to_idx):
+          cost = self._costs.cost_index(i, j)
+          if best is None or cost < bestcost:
+            best = (n1, n2)
+            bestcost = cost
+      return best
+    # The straight-line distance between two systems puts a lower bound on the cost, so each system only needs to look at
+    # the other cluster's systems nearest first, until they're too far away to beat the best pair so far
+    min_sc = min(self._costs.sc_index(j) for j in to_idx)
+    positions = [(n.position.x, n.position.y, n.position.z) for n in tos]
+    grid = spatial.Grid(range(len(tos)), _get_grid_cell_size(positions), key=lambda o: tos[o].position)
+    centre = vector3.Vector3(*[sum(p[axis] for p in positions) / len(positions) for axis in range(3)])
+    # Starting with the systems nearest the other cluster should find a good pair early, so more can be ruled out
+    for a in sorted(range(len(froms)), key=lambda o: (froms[o].position - centre).length):
+      for dist, b in grid.iter_nearest(froms[a].position):
+        if best is not None and self._costs.lower_bound(dist, min_sc) >= bestcost:
+          break
+        cost = self._costs.cost_index(from_idx[a], to_idx[b])
         if best is None or cost < bestcost:
-          best = (n1, n2)
+          best = (froms[a], tos[b])
           bestcost = cost
     return best
 
 
+#
+# Shortest paths between cluster centers
+# Each takes a symmetric matrix of distances where the first and last entries are the fixed ends of the path, and returns the order to visit the rest in
+#
+def _get_path_length(dist, order):
+  path = [0] + list(order) + [len(dist) - 1]
+  return sum(dist[path[i]][path[i+1]] for i in range(len(path) - 1))
+
+
+def _get_shortest_path_exact(dist):
+  # Held-Karp over the points between the ends: best[mask][k] is the shortest path from the start through the points in mask, finishing at k
+  count = len(dist) - 2
+  if count == 0:
+    return []
+  full = (1 << count) - 1
+  best = [None] * (full + 1)
+  prev = [None] * (full + 1)
+  for k in range(count):
+    best[1 << k] = {k: dist[0][k+1]}
+    prev[1 << k] = {k: None}
+  for mask in range(1, full + 1):
+    row = best[mask]
+    if row is None or mask == full:
+      continue
+    for k, cost in row.items():
+      for n in range(count):
+        bit = 1 << n
+        if mask & bit:
+          continue
+        new_cost = cost + dist[k+1][n+1]
+        next_mask = mask | bit
+        if best[next_mask] is None:
+          best[next_mask] = {}
+          prev[next_mask] = {}
+        if n not in best[next_mask] or new_cost < best[next_mask][n]:
+          best[next_mask][n] = new_cost
+          prev[next_mask][n] = k
+  last = min(best[full], key=lambda k: best[full][k] + dist[k+1][count+1])
+  order = []
+  mask = full
+  while last is not None:
+    order.append(last + 1)
+    last, mask = prev[mask][last], mask & ~(1 << last)
+  return list(reversed(order))
+
+
+def _get_shortest_path_local(dist):
+  # Start with nearest neighbour, then use 2-opt and Or-opt moves until neither can shorten the path any more
+  count = len(dist) - 2
+  path = [0]
+  remaining = set(range(1, count + 1))
+  while remaining:
+    n = min(remaining, key=lambda o: dist[path[-1]][o])
+    path.append(n)
+    remaining.remove(n)
+  path.append(count + 1)
+  improved = True
+  while improved:
+    improved = False
+    # 2-opt: reverse path[i:j+1]
+    for i in range(1, count):
+      for j in range(i + 1, count + 1):
+        delta = dist[path[i-1]][path[j]] + dist[path[i]][path[j+1]] - dist[path[i-1]][path[i]] - dist[path[j]][path[j+1]]
+        if delta < -local_search_epsilon:
+          path[i:j+1] = reversed(path[i:j+1])
+          improved = True
+    # Or-opt: move path[i:i+length] to between two other points
+    for length in range(1, min(local_search_segment_max, count - 1) + 1):
+      i = 1
+      while i + length <= count:
+        segment = path[i:i+length]
+        rest = path[:i] + path[i+length:]
+        removed = dist[path[i-1]][segment[0]] + dist[segment[-1]][path[i+length]] - dist[path[i-1]][path[i+length]]
+        best_delta = -local_search_epsilon
+        best_move = None
+        for k in range(len(rest) - 1):
+          for seg in (segment, segment[::-1]):
+            delta = dist[rest[k]][seg[0]] + dist[seg[-1]][rest[k+1]] - dist[rest[k]][rest[k+1]] - removed
+            if delta < best_delta:
+              best_delta = delta
+              best_move = (k, seg)
+        if best_move is not None:
+          k, seg = best_move
+          path = rest[:k+1] + seg + rest[k+1:]
+          improved = True
+        i += 1
+  return path[1:-1]
+
+
 #
 # K-means clustering
 #
-def _cluster_points(X, mu):
-  clusters = [[] for i in range(len(mu))]
-  for x in X:
-    bestmukey = min([(i[0], (x.position - mu[i[0]]).length) for i in enumerate(mu)], key=lambda t: t[1])[0]
-    clusters[bestmukey].append(x)
+def _get_distance_sq(a, b):
+  return (a[0] - b[0]) * (a[0] - b[0]) + (a[1] - b[1]) * (a[1] - b[1]) + (a[2] - b[2]) * (a[2] - b[2])
+
+
+def _get_initial_centers(points, K, rng):
+  # k-means++: each new center is picked with probability proportional to its squared distance from the nearest existing one
+  mu = [points[rng.randrange(len(points))]]
+  dists = [_get_distance_sq(p, mu[0]) for p in points]
+  while len(mu) < K:
+    total = sum(dists)
+    if total <= 0.0:
+      # Every point is on top of a center already
+      mu.append(points[rng.randrange(len(points))])
+      continue
+    target = rng.random() * total
+    chosen = len(points) - 1
+    for i, d in enumerate(dists):
+      target -= d
+      if target < 0.0:
+        chosen = i
+        break
+    mu.append(points[chosen])
+    dists = [min(d, _get_distance_sq(p, points[chosen])) for p, d in zip(points, dists)]
+  return mu
+
+
+def _cluster_points(points, mu):
+  clusters = [[] for _ in mu]
+  for i, p in enumerate(points):
+    best = 0
+    bestdist = _get_distance_sq(p, mu[0])
+    for k in range(1, len(mu)):
+      d = _get_distance_sq(p, mu[k])
+      if d < bestdist:
+        best = k
+        bestdist = d
+    clusters[best].append(i)
   return clusters
 
 
-def _reevaluate_centers(mu, clusters):
-  return [vector3.mean([x.position for x in c]) for c in clusters]
+def _reevaluate_centers(points, mu, clusters):
+  result = []
+  for m, c in zip(mu, clusters):
+    if not c:
+      # Leave empty clusters where they were
+      result.append(m)
+      continue
+    result.append((sum(points[i][0] for i in c) / len(c), sum(points[i][1] for i in c) / len(c), sum(points[i][2] for i in c) / len(c)))
+  return result
 
 
-def _has_converged(mu, oldmu):
-  return (set(mu) == set(oldmu))
+def find_centers(X, K, rng = None):
+  rng = rng if rng is not None else random
+  points = [(x.position.x, x.position.y, x.position.z) for x in X]
+  mu = _get_initial_centers(points, K, rng)
+  clusters = _cluster_points(points, mu)
+  for _ in range(kmeans_iteration_limit):
+    oldmu = mu
+    mu = _reevaluate_centers(points, oldmu, clusters)
+    clusters = _cluster_points(points, mu)
+    # Stop once none of the centers are moving by any meaningful distance
+    if all(_get_distance_sq(a, b) <= kmeans_tolerance * kmeans_tolerance for a, b in zip(mu, oldmu)):
+      break
+  return [_Cluster([X[i] for i in clusters[k]], vector3.Vector3(*mu[k])) for k in range(len(mu))]
 
+#
+# Worker processes for repeated clustered solves
+#
+_repeat_worker_state = None
 
-def find_centers(X, K):
-  # Initialize to K random centers
-  oldmu = random.sample([x.position for x in X], K)
-  mu = random.sample([x.position for x in X], K)
-  clusters = _cluster_points(X, mu)
-  while not _has_converged(mu, oldmu):
-    oldmu = mu
-    # Assign all points in X to clusters
-    clusters = _cluster_points(X, mu)
-    # Reevaluate centers
-    mu = _reevaluate_centers(oldmu, clusters)
-  return [_Cluster(clusters[i], mu[i]) for i in range(len(mu))]
+
+def _init_repeat_worker(solver, args):
+  global _repeat_worker_state
+  _repeat_worker_state = (solver, args)
+
+
+def _solve_clustered_seeded(seed):
+  solver, args = _repeat_worker_state
+  route, cost = solver.solve_clustered_with_cost(*args, rng=random.Random(seed))
+  return (solver._costs.add_all(route), cost)
@@ -0,0 +1,110 @@
+import heapq
+import math
+
+from . import util
+from . import vector3
+
+log = util.get_logger("spatial")
+
+
+# A uniform grid of cubic cells over a set of objects with positions, for fast "what's near here" queries
+class Grid(object):
+  def __init__(self, objs, cell_size, key = None):
+    self._cell_size = float(cell_size)
+    self._key = key if key is not None else (lambda o: o.position)
+    self._cells = {}
+    self._count = 0
+    # The range of cells which have ever had anything in them
+    self._lo = None
+    self._hi = None
+    for o in objs:
+      self.add(o)
+
+  def __len__(self):
+    return self._count
+
+  def _get_cell(self, pos):
+    return (int(math.floor(pos.x / self._cell_size)), int(math.floor(pos.y / self._cell_size)), int(math.floor(pos.z / self._cell_size)))
+
+  def add(self, obj):
+    cell = self._get_cell(self._key(obj))
+    self._cells.setdefault(cell, []).append(obj)
+    self._count += 1
+    self._lo = cell if self._lo is None else tuple(min(a, b) for a, b in zip(self._lo, cell))
+    self._hi = cell if self._hi is None else tuple(max(a, b) for a, b in zip(self._hi, cell))
+
+  def remove(self, obj):
+    cell = self._get_cell(self._key(obj))
+    objs = self._cells[cell]
+    objs.remove(obj)
+    # Drop empty cells, so searches over a grid which is emptying out don't keep looking at them
+    if not objs:
+      del self._cells[cell]
+    self._count -= 1
+
+  def get_near(self, pos, radius):
+    pos = util.get_as_position(pos)
+    extent = vector3.Vector3(radius, radius, radius)
+    cmin = self._get_cell(pos - extent)
+    cmax = self._get_cell(pos + extent)
+    result = []
+    for cx in range(cmin[0], cmax[0] + 1):
+      for cy in range(cmin[1], cmax[1] + 1):
+        for cz in range(cmin[2], cmax[2] + 1):
+          for o in self._cells.get((cx, cy, cz), []):
+            if (self._key(o) - pos).length < radius:
+              result.append(o)
+    return result
+
+  def iter_nearest(self, pos):
+    # Yields (distance, object) for every object, nearest first, looking at rings of cells further and further out as needed
+    # The grid must not be changed until the caller has finished with this
+    pos = util.get_as_position(pos)
+    if not self._count:
+      return
+    centre = self._get_cell(pos)
+    limit = max(max(abs(centre[i] - self._lo[i]), abs(centre[i] - self._hi[i])) for i in range(3))
+    heap = []
+    counter = 0
+    for ring in range(limit + 1):
+      if (2 * ring + 1) ** 3 - (2 * ring - 1) ** 3 > len(self._cells):
+        # There are more cells in this ring than there are cells with anything in them, so just look at all of those instead
+        cells = [c for c in self._cells if max(abs(c[i] - centre[i]) for i in range(3)) >= ring]
+        ring = limit
+      else:
+        cells = self._get_ring(centre, ring)
+      for cell in cells:
+        for o in self._cells.get(cell, ()):
+          heapq.heappush(heap, ((self._key(o) - pos).length, counter, o))
+          counter += 1
+      # Anything in a cell further out than this ring is at least this far away
+      reach = ring * self._cell_size
+      while heap and heap[0][0] <= reach:
+        dist, _, o = heapq.heappop(heap)
+        yield (dist, o)
+      if ring == limit:
+        break
+    while heap:
+      dist, _, o = heapq.heappop(heap)
+      yield (dist, o)
+
+  def nearest(self, pos, condition = None):
+    # The nearest object to pos, optionally only considering objects for which condition(obj) is true
+    for _, o in self.iter_nearest(pos):
+      if condition is None or condition(o):
+        return o
+    return None
+
+  def _get_ring(self, centre, ring):
+    # The cells whose furthest distance from the centre cell along any axis is exactly ring
+    if ring == 0:
+      return [centre]
+    cx, cy, cz = centre
+    cells = []
+    for dx in range(-ring, ring + 1):
+      for dy in range(-ring, ring + 1):
+        if abs(dx) == ring or abs(dy) == ring:
+          cells += [(cx + dx, cy + dy, cz + dz) for dz in range(-ring, ring + 1)]
+        else:
+          cells += [(cx + dx, cy + dy, cz - ring), (cx + dx, cy + dy, cz + ring)]
+    return cells
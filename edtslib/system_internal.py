@@ -9,6 +9,9 @@ from . import sector
 from . import util
 from . import vector3
 
+# Star classes which can be fuel scooped
+scoopable_star_classes = ['K', 'G', 'B', 'F', 'O', 'A', 'M']
+
 class System(object):
   def __init__(self, x, y, z, name = None, id64 = None, uncertainty = 0.0):
     self._position = vector3.Vector3(float(x), float(y), float(z))
@@ -17,7 +20,15 @@ class System(object):
     self._id64 = id64
     self._uncertainty = uncertainty
     self.uses_sc = False
-    self._hash = u"{}/{},{},{}".format(self.name, self.position.x, self.position.y, self.position.z).__hash__()
+    self._hash = self._calculate_hash()
+
+  def _calculate_hash(self):
+    return u"{}/{},{},{}".format(self.name, self.position.x, self.position.y, self.position.z).__hash__()
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    # String hashes can differ between processes, so don't trust the one we were pickled with
+    self._hash = self._calculate_hash()
 
   @property
   def system_name(self):
@@ -69,6 +80,16 @@ class System(object):
   def needs_system_permit(self):
     return False
 
+  @property
+  def arrival_star_class(self):
+    return None
+
+  @property
+  def is_scoopable(self):
+    if not self.arrival_star_class:
+      return False
+    return self.arrival_star_class.split()[0].upper() in scoopable_star_classes
+
   @property
   def uncertainty(self):
     return self._uncertainty
@@ -14,6 +14,8 @@ import tempfile
 from . import db_sqlite3 as db
 from . import defs
 from . import env
+from . import routing as rx
+from . import slftable
 from . import util
 
 log = util.get_logger("update")
@@ -68,6 +70,10 @@ class Application(object):
     ap.add_argument('-s', '--batch-size', required=False, type=int, help='Batch size; higher sizes are faster but consume more memory')
     ap.add_argument('-l', '--local', required=False, action='store_true', help='Instead of downloading, update from local files in the data directory')
     ap.add_argument('--print-urls', required=False, action='store_true', help='Do not download anything, just print the URLs which we would fetch from')
+    ap.add_argument('--build-slf-table', required=False, action='store_true', help='Do not update, instead measure straight-line factors by plotting routes in the current database')
+    ap.add_argument('--slf-centre', metavar='system', required=False, type=str, default='Sol', help='The system to measure straight-line factors around')
+    ap.add_argument('--slf-radius', required=False, type=float, default=1000.0, help='How far from the centre system to measure straight-line factors, in LY')
+    ap.add_argument('--slf-samples', required=False, type=int, default=slftable.default_samples, help='The number of routes to plot for each region and jump range')
     args = ap.parse_args(sys.argv[1:])
     if args.batch or args.batch_size:
       args.batch_size = args.batch_size if args.batch_size is not None else 1024
@@ -85,6 +91,10 @@ class Application(object):
     # Get the relative path to the "edtslib" base directory from the current directory
     relpath = util.get_relative_path(os.getcwd(), os.path.dirname(__file__))
 
+    if self.args.build_slf_table:
+      self.build_slf_table()
+      return
+
     if self.args.print_urls:
       if self.args.local:
         # Local path hard-specifies "/" so do the same here
@@ -158,6 +168,18 @@ class Application(object):
 
     log.info("All done.")
 
+  def build_slf_table(self):
+    with env.use() as envdata:
+      centre = envdata.parse_system(self.args.slf_centre)
+    if centre is None:
+      log.error("Could not find centre system {}", self.args.slf_centre)
+      return
+    log.info("Measuring straight-line factors within {:.0f}LY of {}, this may take a while...", self.args.slf_radius, centre.name)
+    timer = util.start_timer()
+    table = slftable.build(rx.Routing(None), centre.position, self.args.slf_radius, samples=self.args.slf_samples)
+    table.save()
+    log.info("Measured factors for {} regions in {}.", len(table), util.format_timer(timer))
+
   def import_json_from_url(self, url, filename, description, batch_size, is_url_local = False, key = None):
     if self.args.copy_local:
       try:
@@ -309,3 +309,45 @@ def get_timer(start):
 
 def format_timer(start):
   return format_seconds(get_timer(start), True)
+
+
+# A limit on how much work a search may do, in time and/or node expansions
+# It can also be cancelled from elsewhere (e.g. another thread) to stop the search early
+class Budget(object):
+  # A parent budget running out also counts as this one running out, for a part of a search with its own smaller limits
+  def __init__(self, seconds = None, expansions = None, parent = None):
+    self._seconds = seconds
+    self._parent = parent
+    self._max_expansions = expansions
+    self._start = start_timer()
+    self._expansions = 0
+    self._cancelled = False
+    self._exceeded = False
+
+  @property
+  def expansions(self):
+    return self._expansions
+
+  @property
+  def cancelled(self):
+    return self._cancelled
+
+  @property
+  def exceeded(self):
+    return self.check()
+
+  def cancel(self):
+    self._cancelled = True
+
+  def check(self):
+    # Once a budget has run out it stays that way, so every search using it gives up consistently
+    if not self._exceeded:
+      self._exceeded = (self._cancelled
+        or (self._parent is not None and self._parent.check())
+        or (self._seconds is not None and get_timer(self._start) >= self._seconds)
+        or (self._max_expansions is not None and self._expansions >= self._max_expansions))
+    return self._exceeded
+
+  def expand(self, count = 1):
+    self._expansions += count
+    return self.check()
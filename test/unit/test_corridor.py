@@ -0,0 +1,66 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import sys
+
+sys.path.insert(0, '../..')
+from edtslib import env
+from edtslib import corridor
+from edtslib import db_sqlite3
+from edtslib import galaxygen
+from edtslib import vector3
+del sys.path[0]
+
+
+class TestCorridor(unittest.TestCase):
+  def setUp(self):
+    env.set_verbosity(0)
+    self.tmpdir = tempfile.mkdtemp()
+    self.db_file = env.global_args.db_file
+    env.stop()
+    rng = random.Random(1)
+    # Some stars sit exactly on segment boundaries, where neighbouring segments' boxes overlap
+    self.positions = [(rng.uniform(-50, 1050), rng.uniform(-30, 30), rng.uniform(-30, 30)) for _ in range(1000)]
+    self.positions += [(x, rng.uniform(-10, 10), rng.uniform(-10, 10)) for x in [0.0, 100.0, 200.0, 500.0, 1000.0]]
+    filename = os.path.join(self.tmpdir, 'test.db')
+    dbc = db_sqlite3.initialise_db(filename)
+    dbc.populate_table_systems_full((i, "Test {}".format(i), x, y, z, i, galaxygen.synthetic_id64_base + i, False, None, {'id': i, 'name': "Test {}".format(i), 'x': x, 'y': y, 'z': z}) for i, (x, y, z) in enumerate(self.positions))
+    dbc.close()
+    env.global_args.db_file = filename
+    env.start()
+    self.vec_from = vector3.Vector3(0.0, 0.0, 0.0)
+    self.vec_to = vector3.Vector3(1000.0, 0.0, 0.0)
+
+  def tearDown(self):
+    env.stop()
+    env.global_args.db_file = self.db_file
+    shutil.rmtree(self.tmpdir)
+
+  def _get_expected(self, offset_min, offset_max, buffer_ly):
+    return sorted("Test {}".format(i) for i, (x, y, z) in enumerate(self.positions)
+      if offset_min <= x <= offset_max and 0.0 <= x <= 1000.0 and (y * y + z * z) ** 0.5 < buffer_ly)
+
+  def test_get_systems(self):
+    cr = corridor.Corridor(self.vec_from, self.vec_to, 20.0, segment_ly=100.0)
+    names = [s.name for s in cr.get_systems(0.0, cr.length)]
+    # Every system is only returned once, however many segments' boxes it's in
+    self.assertEqual(len(names), len(set(names)))
+    self.assertEqual(sorted(names), self._get_expected(0.0, 1000.0, 20.0))
+    self.assertEqual(sorted(s.name for s in cr.get_systems(150.0, 420.0)), self._get_expected(150.0, 420.0, 20.0))
+
+  def test_eviction(self):
+    cr = corridor.Corridor(self.vec_from, self.vec_to, 20.0, segment_ly=100.0, keep_behind_ly=100.0)
+    first = sorted(s.name for s in cr.get_systems(0.0, 150.0))
+    self.assertEqual(cr.segments_loaded, 2)
+    cr.advance(vector3.Vector3(500.0, 0.0, 0.0))
+    cr.get_systems(450.0, 550.0)
+    # Segments well behind the frontier are gone, but are loaded again if they're needed
+    self.assertEqual(cr.segments_loaded, 4)
+    self.assertEqual(sorted(s.name for s in cr.get_systems(0.0, 150.0)), first)
+    self.assertEqual(cr.segments_loaded, 6)
+    # Going backwards doesn't evict anything
+    cr.advance(vector3.Vector3(100.0, 0.0, 0.0))
+    cr.get_systems(0.0, 150.0)
+    self.assertEqual(cr.segments_loaded, 6)
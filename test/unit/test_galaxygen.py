@@ -0,0 +1,33 @@
+import random
+import unittest
+import sys
+
+sys.path.insert(0, '../..')
+from edtslib import env
+from edtslib import galaxygen
+del sys.path[0]
+
+
+class TestGalaxyGen(unittest.TestCase):
+  def setUp(self):
+    env.set_verbosity(0)
+    self.model = galaxygen.GalaxyModel()
+
+  def test_positions(self):
+    positions = list(self.model.generate_positions(2000, random.Random(1)))
+    self.assertEqual(len(positions), 2000)
+    for pos in positions:
+      for v in pos:
+        self.assertEqual(v * galaxygen.position_grid, round(v * galaxygen.position_grid))
+      self.assertLessEqual(abs(pos.y), self.model.halo_height)
+      for centre, radius in self.model.voids:
+        # Snapping to the grid may nudge a star very slightly into a void
+        self.assertGreater((pos - centre).length, radius - 0.1)
+
+  def test_bubble_is_denser(self):
+    positions = list(self.model.generate_positions(2000, random.Random(1)))
+    in_bubble = len([p for p in positions if p.length < self.model.bubble_radius])
+    bubble_volume = 4.0 / 3.0 * 3.14159 * self.model.bubble_radius ** 3
+    total_volume = 3.14159 * self.model.halo_radius ** 2 * self.model.halo_height * 2
+    self.assertGreater(in_bubble / float(len(positions)), 2 * bubble_volume / total_volume)
+
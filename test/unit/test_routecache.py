@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+import sys
+
+sys.path.insert(0, '../..')
+from edtslib import env
+from edtslib import routecache
+from edtslib.system_internal import KnownSystem
+del sys.path[0]
+
+
+def _make_system(x, name, id64, star_class = None):
+  return KnownSystem({'name': name, 'x': x, 'y': 0.0, 'z': 0.0, 'id64': id64, 'arrival_star_class': star_class})
+
+
+class TestRouteCache(unittest.TestCase):
+  def setUp(self):
+    env.set_verbosity(0)
+    self.tmpdir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.tmpdir, 'routecache.db')
+    self.route = [_make_system(10.3 * i, "Test {}".format(i), 100 + i, "K" if i % 2 else "Y") for i in range(4)]
+    self.params = ("astar", 40.0, 10.0)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _get(self, cache, jump_range):
+    return cache.get(self.route[0], self.route[-1], self.params, jump_range, jump_range)
+
+  def test_hit_within_bucket(self):
+    cache = routecache.RouteCache(self.filename, range_bucket=0.5, db_mtime=1)
+    cache.put(self.route[0], self.route[-1], self.params, 10.4, 10.4, self.route)
+    self.assertEqual(self._get(cache, 10.45), self.route)
+    self.assertIsNone(self._get(cache, 12.0))
+    self.assertIsNone(cache.get(self.route[0], self.route[-1], ("trunkle", 40.0, 10.0), 10.4, 10.4))
+    cache.close()
+
+  def test_keeps_star_class(self):
+    cache = routecache.RouteCache(self.filename, db_mtime=1)
+    cache.put(self.route[0], self.route[-1], self.params, 10.4, 10.4, self.route)
+    route = self._get(cache, 10.4)
+    self.assertEqual([s.is_scoopable for s in route], [s.is_scoopable for s in self.route])
+    cache.close()
+
+  def test_revalidates_jump_range(self):
+    cache = routecache.RouteCache(self.filename, range_bucket=0.5, db_mtime=1)
+    cache.put(self.route[0], self.route[-1], self.params, 10.4, 10.4, self.route)
+    # Same bucket, but too short to make the cached jumps
+    self.assertIsNone(self._get(cache, 10.1))
+    cache.close()
+
+  def test_invalidated_by_db_mtime(self):
+    cache = routecache.RouteCache(self.filename, db_mtime=1)
+    cache.put(self.route[0], self.route[-1], self.params, 10.4, 10.4, self.route)
+    cache.close()
+    cache = routecache.RouteCache(self.filename, db_mtime=1)
+    self.assertEqual(self._get(cache, 10.4), self.route)
+    cache.close()
+    cache = routecache.RouteCache(self.filename, db_mtime=2)
+    self.assertIsNone(self._get(cache, 10.4))
+    cache.close()
+
+  def test_lru_eviction(self):
+    cache = routecache.RouteCache(self.filename, db_mtime=1, max_entries=2)
+    legs = [(self.route[i], self.route[i+1]) for i in range(3)]
+    for a, b in legs[0:2]:
+      cache.put(a, b, self.params, 11.0, 11.0, [a, b])
+    # Use the first leg so that the second becomes the least recently used
+    self.assertIsNotNone(cache.get(legs[0][0], legs[0][1], self.params, 11.0, 11.0))
+    cache.put(legs[2][0], legs[2][1], self.params, 11.0, 11.0, list(legs[2]))
+    self.assertIsNotNone(cache.get(legs[0][0], legs[0][1], self.params, 11.0, 11.0))
+    self.assertIsNone(cache.get(legs[1][0], legs[1][1], self.params, 11.0, 11.0))
+    self.assertIsNotNone(cache.get(legs[2][0], legs[2][1], self.params, 11.0, 11.0))
+    cache.close()
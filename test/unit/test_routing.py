@@ -0,0 +1,246 @@
+import collections
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import sys
+
+sys.path.insert(0, '../..')
+from edtslib import env
+from edtslib import calc
+from edtslib import db_sqlite3
+from edtslib import galaxygen
+from edtslib import routing
+from edtslib import ship
+from edtslib import util
+from edtslib.system_internal import System
+del sys.path[0]
+
+
+def _make_stars(seed, count, length):
+  rng = random.Random(seed)
+  return [System(rng.uniform(0, length), rng.uniform(-20, 20), rng.uniform(-20, 20), "Test {}".format(i)) for i in range(count)]
+
+
+def _make_db(filename, stars):
+  # Each star is (name, x, y, z, arrival star class)
+  dbc = db_sqlite3.initialise_db(filename)
+  rows = []
+  for i, (name, x, y, z, star_class) in enumerate(stars, 1):
+    rows.append((i, name, x, y, z, i, galaxygen.synthetic_id64_base + i, False, None, {'id': i, 'name': name, 'x': x, 'y': y, 'z': z, 'arrival_star_class': star_class}))
+  dbc.populate_table_systems_full(rows)
+  dbc.populate_table_coriolis_fsds(galaxygen.get_fsds())
+  dbc.close()
+
+
+class TestRouting(unittest.TestCase):
+  def setUp(self):
+    env.set_verbosity(0)
+    self.sys_from = System(0.0, 0.0, 0.0, "Test Start")
+    self.sys_to = System(100.0, 0.0, 0.0, "Test End")
+
+  def assertValidRoute(self, route, jump_range):
+    self.assertIsNotNone(route)
+    self.assertEqual(route[0], self.sys_from)
+    self.assertEqual(route[-1], self.sys_to)
+    for i in range(1, len(route)):
+      self.assertLessEqual(route[i-1].distance_to(route[i]), jump_range)
+
+  def test_trundle_beam_matches_exhaustive(self):
+    for seed in range(3):
+      stars = _make_stars(seed, 250, 100.0)
+      exhaustive = routing.Routing(None, route_strategy="trundle", beam_width=None)
+      beam = routing.Routing(None, route_strategy="trundle")
+      r_ex = exhaustive.plot_trundle(self.sys_from, self.sys_to, 25.0, 25.0, starcache=stars)
+      r_beam = beam.plot_trundle(self.sys_from, self.sys_to, 25.0, 25.0, starcache=stars)
+      self.assertValidRoute(r_beam, 25.0)
+      self.assertEqual(len(r_beam), len(r_ex))
+      self.assertAlmostEqual(calc.trundle_cost(r_beam, None), calc.trundle_cost(r_ex, None), 3)
+
+  def test_trundle_beam_narrow(self):
+    stars = _make_stars(0, 250, 100.0)
+    r = routing.Routing(None, route_strategy="trundle", beam_width=1)
+    self.assertValidRoute(r.plot_trundle(self.sys_from, self.sys_to, 25.0, 25.0, starcache=stars), 25.0)
+
+  def test_cache_params(self):
+    # Routes plotted with different settings can't share cache entries
+    narrow = routing.Routing(None, route_strategy="trundle", beam_width=1)
+    self.assertNotEqual(narrow._get_cache_params(), routing.Routing(None, route_strategy="trundle")._get_cache_params())
+    env.start()
+    small = routing.Routing(ship.Ship("5A", 300.0, 16.0), route_strategy="fuel")
+    large = routing.Routing(ship.Ship("5A", 300.0, 32.0), route_strategy="fuel")
+    self.assertNotEqual(small._get_cache_params(), large._get_cache_params())
+    env.stop()
+
+  def test_plot_many(self):
+    stars = _make_stars(0, 250, 100.0)
+    targets = [self.sys_to, stars[0], stars[1], System(1000.0, 0.0, 0.0, "Test Unreachable")]
+    r = routing.Routing(None, route_strategy="astar")
+    routes = r.plot_many(self.sys_from, targets, 25.0, starcache=stars)
+    self.assertValidRoute(routes[self.sys_to], 25.0)
+    for t in targets[1:3]:
+      self.assertEqual(routes[t][0], self.sys_from)
+      self.assertEqual(routes[t][-1], t)
+    self.assertIsNone(routes[targets[3]])
+
+  def test_leg_cache(self):
+    stars = _make_stars(0, 250, 100.0)
+    unreachable = System(1000.0, 0.0, 0.0, "Test Unreachable")
+    r = routing.Routing(None, route_strategy="astar")
+    # Running out of time straight away leaves the legs unknown
+    cache = routing.LegCache(r, 25.0, starcache=stars)
+    self.assertEqual(cache.plot(self.sys_from, [self.sys_to], util.Budget(expansions=0)), 0)
+    self.assertIsNone(cache.get_jump_count(self.sys_from, self.sys_to))
+    self.assertEqual(cache.plot(self.sys_from, [self.sys_to, unreachable]), 2)
+    jumps = len(r.plot_many(self.sys_from, [self.sys_to], 25.0, starcache=stars)[self.sys_to]) - 1
+    self.assertEqual(cache.get_jump_count(self.sys_from, self.sys_to), jumps)
+    self.assertEqual(cache.get_jump_count(self.sys_to, self.sys_from), jumps)
+    self.assertEqual(cache.get_jump_count(self.sys_from, unreachable), routing.unplottable_leg_jumps)
+    # Legs already known aren't plotted again
+    self.assertEqual(cache.plot(self.sys_to, [self.sys_from]), 0)
+
+  def test_trundle_budget(self):
+    stars = _make_stars(0, 250, 100.0)
+    r = routing.Routing(None, route_strategy="trundle", beam_width=None)
+    # Enough to find some complete routes, but not to check them all
+    budget = util.Budget(expansions=200)
+    self.assertValidRoute(r.plot_trundle(self.sys_from, self.sys_to, 25.0, 25.0, starcache=stars, budget=budget), 25.0)
+    self.assertTrue(budget.exceeded)
+    budget = util.Budget()
+    budget.cancel()
+    self.assertIsNone(r.plot_trundle(self.sys_from, self.sys_to, 25.0, 25.0, starcache=stars, budget=budget))
+
+  def test_trundle_stats(self):
+    stars = _make_stars(0, 250, 100.0)
+    r = routing.Routing(None, route_strategy="trundle")
+    stats = routing.RouteStats()
+    r.plot_trundle(self.sys_from, self.sys_to, 25.0, 25.0, starcache=stars, stats=stats)
+    self.assertGreater(stats.expansions, 0)
+    self.assertGreaterEqual(stats.neighbours, stats.expansions)
+    self.assertGreater(stats.openset_peak, 0)
+    # The stars were given to us rather than fetched, so nothing should be counted as fetched
+    self.assertEqual(stats.rows_fetched, 0)
+    self.assertGreater(stats.timings['filter'], 0.0)
+
+
+# Routing which fetches its stars from a database of made-up systems
+class TestRoutingDatabase(unittest.TestCase):
+  def setUp(self):
+    env.set_verbosity(0)
+    self.tmpdir = tempfile.mkdtemp()
+    self.db_file = env.global_args.db_file
+    env.stop()
+
+  def tearDown(self):
+    env.stop()
+    env.global_args.db_file = self.db_file
+    shutil.rmtree(self.tmpdir)
+
+  def _start(self, stars):
+    filename = os.path.join(self.tmpdir, 'test.db')
+    _make_db(filename, stars)
+    env.global_args.db_file = filename
+    env.start()
+    with env.use() as envdata:
+      return dict((s.name, s) for s in envdata.find_all_systems())
+
+  def _get_line(self, count, spacing, star_class):
+    return [("Test {}".format(i), i * spacing, 0.0, 0.0, star_class(i)) for i in range(count)]
+
+  def _check_fuel(self, s, route):
+    # Fly the route, refuelling at every scoopable star
+    fuel = s.tank_size
+    for i in range(1, len(route)):
+      cost = s.cost(route[i-1].distance_to(route[i]), fuel)
+      self.assertLessEqual(cost, min(fuel, s.fsd.maxfuel))
+      fuel = s.tank_size if route[i].is_scoopable else fuel - cost
+
+  def test_fuel_refuels(self):
+    # Only every fifth star can be refuelled at, and the tank runs out well before the end
+    systems = self._start(self._get_line(21, 30.0, lambda i: 'K' if i % 5 == 0 else 'Y'))
+    s = ship.Ship("5A", 300.0, 16.0)
+    r = routing.Routing(s, route_strategy="fuel")
+    route = r.plot(systems["Test 0"], systems["Test 20"], s.range())
+    self.assertIsNotNone(route)
+    self._check_fuel(s, route)
+    self.assertTrue(any(sy.is_scoopable for sy in route[1:-1]))
+    # Carrying cargo uses enough extra fuel that five jumps between refuels is too many, even though each is in range
+    self.assertIsNone(r.plot(systems["Test 0"], systems["Test 20"], s.range(cargo=50), cargo=50))
+
+  def test_fuel_unreachable(self):
+    # Nowhere to refuel, and too far to make it on one tank
+    systems = self._start(self._get_line(21, 30.0, lambda i: 'Y'))
+    s = ship.Ship("5A", 300.0, 16.0)
+    r = routing.Routing(s, route_strategy="fuel")
+    self.assertIsNone(r.plot(systems["Test 0"], systems["Test 20"], s.range()))
+
+  def test_plot_legs(self):
+    rng = random.Random(3)
+    stars = [("Test {}".format(i), rng.uniform(0, 300.0), rng.uniform(-20, 20), rng.uniform(-20, 20), 'K') for i in range(300)]
+    systems = self._start(stars)
+    names = ["Test {}".format(i) for i in range(6)]
+    legs = [(systems[names[i]], systems[names[i+1]], 25.0, 25.0) for i in range(len(names) - 1)]
+    r = routing.Routing(None, route_strategy="astar")
+    results = []
+    for processes in (1, 2):
+      stats = routing.RouteStats()
+      results.append((r.plot_legs(legs, processes=processes, stats=stats), stats))
+    # The same routes come back in the same order, with the workers' stats added up
+    self.assertEqual(results[0][0], results[1][0])
+    for leg, route in zip(legs, results[1][0]):
+      self.assertEqual(route[0], leg[0])
+      self.assertEqual(route[-1], leg[1])
+    self.assertEqual(results[0][1].expansions, results[1][1].expansions)
+    self.assertEqual(results[0][1].rows_fetched, results[1][1].rows_fetched)
+
+  def test_corridor(self):
+    # Long routes stream their stars in segments rather than fetching the whole cylinder, which shouldn't change them
+    rng = random.Random(2)
+    stars = [("Test {}".format(i), rng.uniform(0, 1200.0), rng.uniform(-30, 30), rng.uniform(-30, 30), 'K') for i in range(1500)]
+    systems = self._start(stars + [("Test Start", 0.0, 0.0, 0.0, 'K'), ("Test End", 1200.0, 0.0, 0.0, 'K')])
+    for strategy in ["astar", "trunkle"]:
+      r = routing.Routing(None, route_strategy=strategy)
+      self.assertIsNotNone(r.get_corridor(systems["Test Start"], systems["Test End"], 40.0))
+      streamed = r.plot(systems["Test Start"], systems["Test End"], 30.0)
+      r._corridor_min_length = float('inf')
+      self.assertIsNone(r.get_corridor(systems["Test Start"], systems["Test End"], 40.0))
+      whole = r.plot(systems["Test Start"], systems["Test End"], 30.0)
+      self.assertIsNotNone(whole)
+      self.assertEqual(streamed, whole)
+      self.assertEqual(len(set(streamed)), len(streamed))
+
+  def test_fuel_fewest_jumps(self):
+    rng = random.Random(1)
+    stars = [("Test {}".format(i), rng.uniform(0, 300.0), rng.uniform(-20, 20), rng.uniform(-20, 20), 'K') for i in range(200)]
+    systems = self._start(stars + [("Test Start", 0.0, 0.0, 0.0, 'K'), ("Test End", 300.0, 0.0, 0.0, 'K')])
+    s = ship.Ship("5A", 300.0, 16.0)
+    r = routing.Routing(s, route_strategy="fuel")
+    route = r.plot(systems["Test Start"], systems["Test End"], s.range())
+    self._check_fuel(s, route)
+    # Every star can be refuelled at, so the fewest jumps possible is the shortest path at full range
+    jumps = {systems["Test Start"]: 0}
+    queue = collections.deque([systems["Test Start"]])
+    while queue:
+      cur = queue.popleft()
+      for sy in systems.values():
+        if sy not in jumps and cur.distance_to(sy) < s.range():
+          jumps[sy] = jumps[cur] + 1
+          queue.append(sy)
+    self.assertEqual(len(route) - 1, jumps[systems["Test End"]])
+
+  def test_plot_many_fetch(self):
+    # Targets in different directions are all plotted from one fetch of the box around them
+    rng = random.Random(3)
+    stars = [("Test {}".format(i), rng.uniform(-20, 220.0), rng.uniform(-20, 220.0), rng.uniform(-20, 20), 'K') for i in range(1500)]
+    systems = self._start(stars + [("Test Start", 0.0, 0.0, 0.0, 'K'), ("Test A", 200.0, 0.0, 0.0, 'K'), ("Test B", 0.0, 200.0, 0.0, 'K')])
+    targets = [systems["Test A"], systems["Test B"]]
+    r = routing.Routing(None, route_strategy="astar")
+    stats = routing.RouteStats()
+    routes = r.plot_many(systems["Test Start"], targets, 25.0, stats=stats)
+    self.assertEqual(stats.rows_fetched, len(systems))
+    # Only the stars near the lines to the targets are searched
+    self.assertLess(stats.stars, stats.rows_fetched)
+    self.assertEqual(routes, r.plot_many(systems["Test Start"], targets, 25.0, starcache=list(systems.values())))
+    for t in targets:
+      self.assertEqual(routes[t][-1], t)
@@ -0,0 +1,58 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import sys
+
+sys.path.insert(0, '../..')
+from edtslib import env
+from edtslib import calc
+from edtslib import slftable
+from edtslib import solver
+from edtslib.station import Station
+from edtslib.system_internal import System
+del sys.path[0]
+
+
+class TestSLFTable(unittest.TestCase):
+  def setUp(self):
+    env.set_verbosity(0)
+    self.tmpdir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.tmpdir, 'slf.json')
+    self.table = slftable.SLFTable(500.0, [20.0, 40.0], {(0, 0, 0): [0.5, 0.7], (1, 0, 0): [None, 0.8]}, db_mtime=1)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_get(self):
+    # Looked up by the leg's midpoint, interpolating between jump ranges
+    self.assertAlmostEqual(self.table.get((-100.0, 0.0, 0.0), (300.0, 0.0, 0.0), 30.0), 0.6)
+    self.assertAlmostEqual(self.table.get((0.0, 0.0, 0.0), (100.0, 0.0, 0.0), 10.0), 0.5)
+    self.assertAlmostEqual(self.table.get((600.0, 0.0, 0.0), (700.0, 0.0, 0.0), 20.0), 0.8)
+    self.assertIsNone(self.table.get((-600.0, 0.0, 0.0), (-700.0, 0.0, 0.0), 20.0))
+
+  def test_load(self):
+    self.table.save(self.filename)
+    loaded = slftable.load(self.filename, db_mtime=1)
+    self.assertEqual(loaded.factors, self.table.factors)
+    self.assertIsNone(slftable.load(self.filename, db_mtime=2))
+
+  def test_jump_count_range(self):
+    a = System(0.0, 0.0, 0.0, "Test A")
+    b = System(200.0, 0.0, 0.0, "Test B")
+    c = System(-1200.0, 0.0, 0.0, "Test C")
+    d = System(-1000.0, 0.0, 0.0, "Test D")
+    self.assertEqual(calc.jump_count_range(a, b, 20.0, slf_table=self.table), (10, 20))
+    # Given factors and regions the table doesn't know about don't use it
+    self.assertEqual(calc.jump_count_range(a, b, 20.0, slf=0.9, slf_table=self.table), (10, 12))
+    self.assertEqual(calc.jump_count_range(c, d, 20.0, slf_table=self.table), (10, 12))
+    self.assertEqual(calc.jump_count_range(a, b, 20.0), (10, 12))
+
+  def test_solver(self):
+    stations = [Station.none(System(x, 0.0, 0.0, "Test {}".format(x))) for x in [0.0, 200.0]]
+    s = solver.Solver(20.0, 1.5, slf_table=self.table)
+    cost = s._costs.cost(stations[0], stations[1])
+    self.assertGreater(cost, solver.Solver(20.0, 1.5)._costs.cost(stations[0], stations[1]))
+    # Worker processes get their own copy of the solver, which needs to cost legs the same way
+    self.assertEqual(pickle.loads(pickle.dumps(s, pickle.HIGHEST_PROTOCOL))._costs.cost(stations[0], stations[1]), cost)
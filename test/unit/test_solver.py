@@ -0,0 +1,274 @@
+import itertools
+import random
+import unittest
+import sys
+
+sys.path.insert(0, '../..')
+from edtslib import env
+from edtslib import calc
+from edtslib import routing
+from edtslib import solver
+from edtslib import util
+from edtslib import vector3
+from edtslib.station import Station
+from edtslib.system_internal import System
+del sys.path[0]
+
+
+def _make_stations(seed, count, spread = 200.0):
+  rng = random.Random(seed)
+  result = []
+  for i in range(count):
+    sy = System(rng.uniform(-spread, spread), rng.uniform(-20, 20), rng.uniform(-spread, spread), "Test {}".format(i))
+    result.append(Station({'name': "Station {}".format(i), 'distance_to_star': rng.randint(10, 5000), 'type': None, 'has_refuel': True, 'max_landing_pad_size': 'L', 'is_planetary': False}, sy))
+  return result
+
+
+class TestSolver(unittest.TestCase):
+  def setUp(self):
+    env.set_verbosity(0)
+    self.jump_range = 30.0
+    stations = _make_stations(0, 10)
+    self.start = stations[0]
+    self.end = stations[1]
+    self.stations = stations[2:]
+
+  def solve(self, mode, stations = None):
+    stations = stations if stations is not None else self.stations
+    s = solver.Solver(self.jump_range, 1.5)
+    route, _ = s.solve([[stn] for stn in stations], list(stations), self.start, self.end, len(stations) + 2, mode)
+    return route
+
+  def assertValidRoute(self, route, stations):
+    self.assertEqual(route[0], self.start)
+    self.assertEqual(route[-1], self.end)
+    self.assertEqual(sorted(str(s) for s in route[1:-1]), sorted(str(s) for s in stations))
+
+  def test_cost_matrix(self):
+    costs = solver._CostMatrix(self.jump_range)
+    costs.add_all(self.stations, precompute=True)
+    for a in self.stations:
+      for b in self.stations:
+        self.assertAlmostEqual(costs.cost(a, b), calc.solve_cost(a, b, self.jump_range))
+    route = [self.start] + self.stations + [self.end]
+    self.assertAlmostEqual(costs.route_cost(route), calc.solve_route_cost(route, self.jump_range))
+
+  def test_basic(self):
+    self.assertValidRoute(self.solve(solver.BASIC), self.stations)
+
+  def test_nearest_neighbour(self):
+    stations = _make_stations(2, 300, 500.0)
+    s = solver.Solver(self.jump_range, 1.5)
+    route, cost = s.solve_nearest_neighbour_with_cost(None, stations, self.start, self.end, len(stations) + 2)
+    self.assertValidRoute(route, stations)
+    self.assertAlmostEqual(cost, calc.solve_route_cost(route, self.jump_range))
+    # Each stop should be the cheapest one not yet visited to get to from the one before
+    for i in range(1, len(route) - 1):
+      best = min(calc.solve_cost(route[i-1], stn, self.jump_range) for stn in route[i:-1])
+      self.assertAlmostEqual(calc.solve_cost(route[i-1], route[i], self.jump_range), best)
+
+  def test_closest_points(self):
+    stations = _make_stations(3, 60)
+    s = solver.Solver(self.jump_range, 1.5)
+    for cluster1, cluster2, disallowed in ((stations[:30], stations[30:], []), (stations[:5], stations[5:], stations[:2] + stations[5:10])):
+      n1, n2 = s._get_closest_points(cluster1, cluster2, disallowed)
+      self.assertNotIn(n1, disallowed)
+      self.assertNotIn(n2, disallowed)
+      best = min(calc.solve_cost(a, b, self.jump_range) for a in cluster1 for b in cluster2 if a not in disallowed and b not in disallowed)
+      self.assertAlmostEqual(calc.solve_cost(n1, n2, self.jump_range), best)
+
+  def test_cluster_route(self):
+    rng = random.Random(5)
+    positions = [vector3.Vector3(rng.uniform(-100, 100), rng.uniform(-10, 10), rng.uniform(-100, 100)) for _ in range(8)]
+    dist = [[(a - b).length for b in positions] for a in positions]
+    best = min(solver._get_path_length(dist, perm) for perm in itertools.permutations(range(1, 7)))
+    order = solver._get_shortest_path_exact(dist)
+    self.assertEqual(sorted(order), list(range(1, 7)))
+    self.assertAlmostEqual(solver._get_path_length(dist, order), best)
+    order = solver._get_shortest_path_local(dist)
+    self.assertEqual(sorted(order), list(range(1, 7)))
+    self.assertGreaterEqual(solver._get_path_length(dist, order), best - 1e-6)
+
+  def test_solve_incremental(self):
+    stations = _make_stations(6, 11)
+    s = solver.Solver(self.jump_range, 1.5)
+    route, _ = s.solve([[stn] for stn in stations[:10]], stations[:10], self.start, self.end, 12)
+    # Swap a stop for another; the old route should be updated rather than solved again
+    new_stations = stations[1:11]
+    route, definitive = s.solve_incremental(route, [[stn] for stn in new_stations], new_stations, self.start, self.end, 12)
+    self.assertValidRoute(route, new_stations)
+    self.assertFalse(definitive)
+    self.assertIn(s.status, (solver.STATUS_IMPROVED, solver.STATUS_INITIAL))
+    # A new tour the old route doesn't keep to needs a full solve
+    tour = [new_stations[5], new_stations[0]]
+    tours = [tour] + [[stn] for stn in new_stations if stn not in tour]
+    route, _ = s.solve_incremental(route, tours, new_stations, self.start, self.end, 12)
+    self.assertValidRoute(route, new_stations)
+    self.assertEqual([stn for stn in route if stn in tour], tour)
+
+  def test_solve_incremental_unchanged(self):
+    stations = _make_stations(6, 8)
+    tours = [[stn] for stn in stations]
+    s = solver.Solver(self.jump_range, 1.5)
+    route, definitive = s.solve(tours, stations, self.start, self.end, 10, solver.HELD_KARP)
+    self.assertTrue(definitive)
+    status = s.status
+    # The same stops again keep the previous route, and it's still as good as it was
+    again, again_definitive = s.solve_incremental(route, tours, list(reversed(stations)), self.start, self.end, 10, solver.HELD_KARP, previous_tours=tours, previous_status=status, previous_definitive=definitive)
+    self.assertEqual(again, route)
+    self.assertTrue(again_definitive)
+    self.assertEqual(s.status, status)
+
+  def test_solve_incremental_tours_changed(self):
+    stations = _make_stations(6, 8)
+    s = solver.Solver(self.jump_range, 1.5)
+    free, _ = s.solve([[stn] for stn in stations], stations, self.start, self.end, 10, solver.HELD_KARP)
+    # Visiting the first and last stops the other way round makes the best route worse
+    tour = [free[-2], free[1]]
+    tours = [tour] + [[stn] for stn in stations if stn not in tour]
+    route, definitive = s.solve(tours, stations, self.start, self.end, 10, solver.HELD_KARP)
+    self.assertTrue(definitive)
+    self.assertEqual(s.status, solver.STATUS_OPTIMAL)
+    self.assertGreater(s._costs.route_cost(route), s._costs.route_cost(free))
+    # Without the tour the same stops aren't optimal any more, so the previous status can't be kept
+    untoured = [[stn] for stn in stations]
+    route, definitive = s.solve_incremental(route, untoured, stations, self.start, self.end, 10, solver.HELD_KARP, previous_tours=tours, previous_status=s.status, previous_definitive=definitive)
+    self.assertValidRoute(route, stations)
+    self.assertFalse(definitive)
+    self.assertNotEqual(s.status, solver.STATUS_OPTIMAL)
+
+  def test_routed(self):
+    rng = random.Random(7)
+    stars = [System(rng.uniform(-200, 200), rng.uniform(-20, 20), rng.uniform(-200, 200), "Star {}".format(i)) for i in range(400)]
+    stations = [Station.none(sy) for sy in stars[:8]]
+    start = Station.none(stars[8])
+    cache = routing.LegCache(routing.Routing(None), self.jump_range, starcache=stars)
+    s = solver.Solver(self.jump_range, 1.5, leg_cache=cache)
+    route, _ = s.solve([[stn] for stn in stations], list(stations), start, start, len(stations) + 2, solver.ROUTED)
+    self.assertEqual(sorted(str(stn) for stn in route[1:-1]), sorted(str(stn) for stn in stations))
+    # Every leg has been plotted, so the costs use real jump counts
+    for a, b in zip(route, route[1:]):
+      jumps = cache.get_jump_count(a.system, b.system)
+      self.assertIsNotNone(jumps)
+      self.assertAlmostEqual(s._costs.cost(a, b), calc.solve_cost_for_distance(a.distance_to(b), calc.sc_cost(0.0), self.jump_range, jump_count=jumps))
+
+  def test_held_karp(self):
+    tours = [[self.stations[3], self.stations[1], self.stations[5]]] + [[stn] for stn in self.stations if stn not in (self.stations[3], self.stations[1], self.stations[5])]
+    for maxstops in (len(self.stations) + 2, 5):
+      s = solver.Solver(self.jump_range, 1.5)
+      route, cost = s.solve_held_karp_with_cost(tours, list(self.stations), self.start, self.end, maxstops)
+      self.assertEqual(len(route), maxstops)
+      self.assertAlmostEqual(cost, calc.solve_route_cost(route, self.jump_range))
+      # Check against every permutation which keeps the tour in order
+      best = None
+      for perm in itertools.permutations(self.stations, maxstops - 2):
+        order = [p for p in perm if p in tours[0]]
+        if order != tours[0][0:len(order)]:
+          continue
+        perm_cost = calc.solve_route_cost([self.start] + list(perm) + [self.end], self.jump_range)
+        best = perm_cost if best is None else min(best, perm_cost)
+      self.assertAlmostEqual(cost, best)
+
+
+  def test_branch_and_bound(self):
+    stations = _make_stations(4, 12)
+    tours = [stations[0:3]] + [[stn] for stn in stations[3:]]
+    s = solver.Solver(self.jump_range, 1.5)
+    _, best = s.solve_held_karp_with_cost(tours, list(stations), self.start, self.end, len(stations) + 2)
+    route, cost, gap = s.solve_branch_and_bound_with_gap(tours, list(stations), self.start, self.end, len(stations) + 2)
+    self.assertValidRoute(route, stations)
+    self.assertAlmostEqual(cost, best)
+    self.assertEqual(gap, 0.0)
+    # Stopping straight away still gives a valid route, and says how far from optimal it might be
+    route, cost, gap = s.solve_branch_and_bound_with_gap(tours, list(stations), self.start, self.end, len(stations) + 2, util.Budget(expansions=0))
+    self.assertValidRoute(route, stations)
+    self.assertEqual([stn for stn in route if stn in tours[0]], tours[0])
+    self.assertGreaterEqual(cost, best - 1e-6)
+    self.assertLessEqual(cost * (1.0 - gap), best + 1e-6)
+
+  def test_solve_budget(self):
+    s = solver.Solver(self.jump_range, 1.5)
+    route, definitive = s.solve([], list(self.stations), self.start, self.end, len(self.stations) + 2, solver.HELD_KARP)
+    self.assertEqual(s.status, solver.STATUS_OPTIMAL)
+    self.assertTrue(definitive)
+    # Running out straight away still gives a route to use
+    budget = util.Budget(expansions=0)
+    route, definitive = s.solve([], list(self.stations), self.start, self.end, len(self.stations) + 2, solver.HELD_KARP, budget=budget)
+    self.assertValidRoute(route, self.stations)
+    self.assertEqual(s.status, solver.STATUS_INITIAL)
+    self.assertFalse(definitive)
+    # Budgets within a budget run out with it
+    budget.cancel()
+    self.assertTrue(util.Budget(seconds=60, parent=budget).exceeded)
+
+  def test_tours(self):
+    tour = [self.stations[6], self.stations[2], self.stations[0]]
+    tours = [tour] + [[stn] for stn in self.stations if stn not in tour]
+    s = solver.Solver(self.jump_range, 1000.0)
+    _, best = s.solve_held_karp_with_cost(tours, list(self.stations), self.start, self.end, len(self.stations) + 2)
+    route, cost = s.solve_basic_with_cost(tours, list(self.stations), self.start, self.end, len(self.stations) + 2)
+    self.assertAlmostEqual(cost, best)
+    route_nn, _ = s.solve_nearest_neighbour_with_cost(tours, list(self.stations), self.start, self.end, len(self.stations) + 2)
+    for r in (route, route_nn):
+      self.assertValidRoute(r, self.stations)
+      self.assertEqual([stn for stn in r if stn in tour], tour)
+
+  def test_improve_route(self):
+    stations = _make_stations(1, 30)
+    tour = [stations[4], stations[20], stations[9]]
+    tours = [tour] + [[stn] for stn in stations if stn not in tour]
+    s = solver.Solver(self.jump_range, 1.5)
+    route = [self.start] + stations + [self.end]
+    improved, cost = s.improve_route_with_cost(route, tours)
+    self.assertValidRoute(improved, stations)
+    self.assertAlmostEqual(cost, calc.solve_route_cost(improved, self.jump_range))
+    self.assertLess(cost, calc.solve_route_cost(route, self.jump_range))
+    self.assertEqual([stn for stn in improved if stn in tour], tour)
+
+  def test_clustered_repeat(self):
+    stations = _make_stations(2, 40)
+    routes = []
+    for processes in (1, 2):
+      s = solver.Solver(self.jump_range, 1.5, processes=processes)
+      route, cost = s.solve_clustered_repeat_with_cost(None, list(stations), self.start, self.end, len(stations) + 2, iterations=8, seed=3)
+      self.assertValidRoute(route, stations)
+      self.assertAlmostEqual(cost, calc.solve_route_cost(route, self.jump_range))
+      routes.append(route)
+    # The same seed gives the same result however many processes are used
+    self.assertEqual(routes[0], routes[1])
+
+  def test_iterated_local_search(self):
+    stations = _make_stations(5, 80, spread=400.0)
+    tour = stations[10:15]
+    s = solver.Solver(self.jump_range, 1.5)
+    found = []
+    route, cost = s.solve_iterated_local_search_with_cost([tour], list(stations), self.start, self.end, len(stations) + 2, util.Budget(expansions=2000), callback=lambda r, c: found.append(c))
+    self.assertValidRoute(route, stations)
+    self.assertEqual([stn for stn in route if stn in tour], tour)
+    self.assertAlmostEqual(cost, calc.solve_route_cost(route, self.jump_range))
+    self.assertAlmostEqual(cost, found[-1])
+    self.assertEqual(found, sorted(found, reverse=True))
+    # Only visiting some of the stations
+    route = s.solve_iterated_local_search([tour], list(stations), self.start, self.end, 22, util.Budget(expansions=500))
+    self.assertEqual(len(route), 22)
+    # Too few stops to shake up, or a tour that rules out every shake-up, shouldn't use up the whole budget
+    budget = util.Budget(60.0)
+    route, _ = s.solve_iterated_local_search_with_cost([], stations[0:2], self.start, self.end, 4, budget)
+    self.assertValidRoute(route, stations[0:2])
+    route, _ = s.solve_iterated_local_search_with_cost([stations[0:6]], stations[0:6], self.start, self.end, 8, budget)
+    self.assertEqual(route[1:-1], stations[0:6])
+    self.assertFalse(budget.exceeded)
+
+  def test_find_centers(self):
+    # Three well separated groups of systems should always be found exactly
+    rng = random.Random(3)
+    offsets = [(0, 0), (500, 0), (0, 500)]
+    systems = []
+    for i in range(30):
+      ox, oz = offsets[i % 3]
+      systems.append(System(ox + rng.uniform(-10, 10), rng.uniform(-10, 10), oz + rng.uniform(-10, 10), "Test {}".format(i)))
+    for seed in range(5):
+      clusters = solver.find_centers(systems, 3, random.Random(seed))
+      self.assertEqual(sorted(sorted(s.name for s in c.systems) for c in clusters), sorted(sorted(s.name for s in systems[i::3]) for i in range(3)))
+      for c in clusters:
+        self.assertAlmostEqual((c.position - vector3.mean([s.position for s in c.systems])).length, 0.0, places=1)